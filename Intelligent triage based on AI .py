@@ -1,882 +1,4215 @@
-from flask import Flask, render_template_string, request, jsonify
+from flask import Flask, Response, g, request, jsonify, make_response
 import os
 import json
 import re
 import ast
-from openai import OpenAI
+import asyncio
+import atexit
+import contextlib
+import contextvars
+import gzip
+import hashlib
+import hmac
+import heapq
+import itertools
+import math
+import mimetypes
+import posixpath
+import random
+import sqlite3
+import threading
+import time
+import unicodedata
+import uuid
+import zlib
+from collections import OrderedDict
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient, NOT_GIVEN
+from openai import APIConnectionError, InternalServerError, RateLimitError
 from openai.types.chat.chat_completion import Choice
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed, wait
 from datetime import datetime
 import logging
+import httpx
+import jinja2
+import numpy as np
 import speech_recognition as sr
 import wave
 import io
 
+try:
+    import quart
+except ImportError:  # 未安装 quart 时只提供同步（WSGI）服务
+    quart = None
+
+try:
+    from flask_sock import Sock, ConnectionClosed
+except ImportError:  # 未安装 flask-sock 时 Flask 服务不提供流式语音接口
+    Sock = None
+
+try:
+    import brotli
+except ImportError:  # 未安装 brotli 时静态资源只提供 gzip 压缩版本
+    brotli = None
+
+try:
+    import orjson
+except ImportError:  # 未安装 orjson 时用标准库解析 JSON
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，sqlite 后端只在进程内加锁
+    fcntl = None
+
 # 配置日志记录
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO"), format="%(asctime)s - %(process)d - %(levelname)s - %(message)s"
+)
+
+# Moonshot API 配置：从环境变量读取，密钥不写进代码
+MOONSHOT_BASE_URL = os.environ.get("MOONSHOT_BASE_URL", "https://api.moonshot.cn/v1")
+MOONSHOT_API_KEY = os.environ.get("MOONSHOT_API_KEY", "")
+
+# HTTP 连接池配置，同步与异步客户端使用相同的上限
+HTTP_MAX_CONNECTIONS = 200  # 同时在途的请求数上限
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 50  # 保留的空闲长连接数
+HTTP_KEEPALIVE_EXPIRY = 30.0  # 空闲长连接保留秒数
+
+# 模型调用的超时、重试、对冲与熔断配置
+LLM_TIMEOUT_SECONDS = float(os.environ.get("LLM_TIMEOUT_SECONDS", 20))  # 单次请求的超时；流式请求为等待每个分段的超时
+LLM_DEADLINE_SECONDS = float(os.environ.get("LLM_DEADLINE_SECONDS", 45))  # 含重试在内的总时限
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 2))  # 超时、连接失败、429、5xx 的最多重试次数
+LLM_BACKOFF_BASE = 0.5  # 指数退避的初始间隔（秒），实际等待在 [0, 间隔] 内随机
+LLM_BACKOFF_MAX = 8.0  # 单次退避的上限
+LLM_HEDGE_MODE = os.environ.get("LLM_HEDGE_MODE", "") == "1"  # 非流式调用超过近期 p95 耗时仍未返回时，再发一个相同请求
+LLM_HEDGE_QUANTILE = 0.95
+LLM_HEDGE_MIN_SAMPLES = 20  # 同类调用的耗时样本不足该数目时不对冲
+LLM_HEDGE_WINDOW = 200  # 每类调用保留的最近耗时样本数
+LLM_BREAKER_FAILURES = 5  # 连续失败这么多次即熔断，改用本地规则
+LLM_BREAKER_COOLDOWN = 30  # 熔断后经过该秒数放行一个探测请求
+
+# 服务模式："wsgi" 使用 Flask 开发服务器，"asgi" 使用 uvicorn + quart 的异步服务
+# （只影响 python 直接运行；生产环境通过 wsgi.py / asgi.py 交给 gunicorn 启动）
+SERVING_MODE = os.environ.get("SERVING_MODE", "wsgi")
+DEBUG = os.environ.get("DEBUG", "") == "1"  # 开发服务器的调试模式与自动重载
+
+http_limits = httpx.Limits(
+    max_connections=HTTP_MAX_CONNECTIONS,
+    max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+)
+
+# 初始化 OpenAI 客户端（未配置密钥时仍可启动，模型调用会返回认证错误）
+client = OpenAI(
+    base_url=MOONSHOT_BASE_URL,
+    api_key=MOONSHOT_API_KEY,
+    http_client=DefaultHttpxClient(limits=http_limits),
+    timeout=LLM_TIMEOUT_SECONDS,
+    max_retries=0,  # 重试由 call_with_retries 统一处理
+)
+
+# 异步客户端，所有协程共享同一个长连接池，不再为每个在途请求占用一个线程
+async_client = AsyncOpenAI(
+    base_url=MOONSHOT_BASE_URL,
+    api_key=MOONSHOT_API_KEY,
+    http_client=DefaultAsyncHttpxClient(limits=http_limits),
+    timeout=LLM_TIMEOUT_SECONDS,
+    max_retries=0,
+)
+
+# 指标配置：进程内统计，/metrics 按 Prometheus 文本格式输出
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # 耗时直方图的桶（秒）
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "") == "1"  # 非流式响应附带 Server-Timing 头，列出各环节耗时
+
+METRIC_HELP = {
+    "triage_http_request_seconds": ("histogram", "HTTP 请求耗时（流式接口只计到开始推送）"),
+    "triage_turn_seconds": ("histogram", "一轮问诊的总耗时"),
+    "triage_turn_first_delta_seconds": ("histogram", "流式问诊首个分段的耗时"),
+    "triage_turns_total": ("counter", "问诊轮次，按结果分类"),
+    "triage_turn_prompt_tokens_total": ("counter", "各轮问诊的提示 token 数，按是否命中上下文缓存分类"),
+    "triage_llm_call_seconds": ("histogram", "模型调用耗时（不含排队，含重试）"),
+    "triage_llm_queue_wait_seconds": ("histogram", "模型调用在调度器中的排队时间"),
+    "triage_llm_tokens_total": ("counter", "模型调用的 token 数（服务端未返回用量时为估算值）"),
+    "triage_llm_cached_tokens_total": ("counter", "提示中命中服务商上下文缓存的 token 数（已含在 prompt 中）"),
+    "triage_llm_cache_requests_total": ("counter", "回复缓存的查询次数"),
+    "triage_llm_errors_total": ("counter", "模型调用失败次数，按错误类型分类"),
+    "triage_asr_seconds": ("histogram", "语音解码与识别耗时"),
+    "triage_record_job_seconds": ("histogram", "后台病历任务从提交到完成的耗时"),
+}
+
+
+class MetricsRegistry:
+    """进程内的计数器与直方图；每个工作进程各自统计，输出时带上 worker 标签"""
+
+    def __init__(self, help_texts: dict = METRIC_HELP, buckets: tuple = METRICS_BUCKETS):
+        self.help_texts = help_texts
+        self.buckets = buckets
+        self._counters = {}  # (名称, 标签) -> 值
+        self._histograms = {}  # (名称, 标签) -> [各桶计数..., 总和, 次数]
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    entry[i] += 1
+            entry[-2] += seconds
+            entry[-1] += 1
+
+    def add_collector(self, collector) -> None:
+        """注册抓取时调用的函数，返回 (名称, 类型, 说明, 标签, 值) 的列表，用于汇入各组件已有的统计"""
+        self._collectors.append(collector)
+
+    @staticmethod
+    def _format_labels(labels) -> str:
+        pairs = []
+        for key, value in labels:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            pairs.append(f'{key}="{value}"')
+        return "{" + ",".join(pairs) + "}"
+
+    def render(self) -> str:
+        worker = (("worker", str(os.getpid())),)
+        families = {}  # 名称 -> (类型, 说明, [行])
+
+        def family(name: str, kind: str, help_text: str) -> list:
+            return families.setdefault(name, (kind, help_text, []))[2]
+
+        with self._lock:
+            counters = list(self._counters.items())
+            histograms = [(key, list(entry)) for key, entry in self._histograms.items()]
+        for (name, labels), value in counters:
+            kind, help_text = self.help_texts[name]
+            family(name, kind, help_text).append(f"{name}{self._format_labels(worker + labels)} {value}")
+        for (name, labels), entry in histograms:
+            kind, help_text = self.help_texts[name]
+            lines = family(name, kind, help_text)
+            for bound, count in zip(self.buckets, entry):
+                lines.append(f"{name}_bucket{self._format_labels(worker + labels + (('le', bound),))} {count}")
+            lines.append(f"{name}_bucket{self._format_labels(worker + labels + (('le', '+Inf'),))} {entry[-1]}")
+            lines.append(f"{name}_sum{self._format_labels(worker + labels)} {entry[-2]:.6f}")
+            lines.append(f"{name}_count{self._format_labels(worker + labels)} {entry[-1]}")
+        for collector in self._collectors:
+            for name, kind, help_text, labels, value in collector():
+                labels = tuple(sorted(labels.items()))
+                family(name, kind, help_text).append(f"{name}{self._format_labels(worker + labels)} {value}")
+
+        output = []
+        for name, (kind, help_text, lines) in families.items():
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(lines)
+        return "\n".join(output) + "\n"
+
+
+metrics = MetricsRegistry()
+
+# 当前请求各环节的耗时，用于 Server-Timing 头；推测请求的线程通过 submit_with_context 继承
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def add_server_timing(name: str, seconds: float) -> None:
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+# 当前这一轮问诊的提示 token 数与其中命中上下文缓存的部分，随本轮耗时一起记录
+_turn_tokens = contextvars.ContextVar("turn_tokens", default=None)
+
+
+def add_turn_tokens(prompt_tokens: int, cached_tokens: int) -> None:
+    tokens = _turn_tokens.get()
+    if tokens is not None:
+        tokens["prompt"] = tokens.get("prompt", 0) + prompt_tokens
+        tokens["cached"] = tokens.get("cached", 0) + cached_tokens
+
+
+def server_timing_header(timings: dict, total: float) -> str:
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def submit_with_context(executor: ThreadPoolExecutor, fn, *args):
+    """在线程池中执行，并带上当前请求的上下文（Server-Timing 记录）"""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+# 回复缓存配置
+CACHE_MAX_ENTRIES = 2048  # 超出后按最近最少使用淘汰
+CACHE_TTL_SECONDS = 6 * 60 * 60  # 缓存条目的有效期
+CACHE_PATH = os.environ.get("CACHE_PATH") or None  # 设置为文件路径（如 "completion_cache.json"）即持久化到磁盘
+CACHE_PERSIST_EVERY = 50  # 每新增多少条写一次磁盘
+CACHE_EARLY_TURN_KEYS = False  # 首轮主诉按归一化文本命中缓存（忽略患者基本信息的差异）
+
+# 归一化时去掉的标点、空白和语气词
+_CACHE_NOISE_RE = re.compile(r"[\s\W_]+|[了啊呢吧呀哦嘛哈]+(?=[\s\W_]|$)")
+
+
+class CompletionCache:
+    """模型回复缓存，按 (模型, 温度, 消息) 归一化后的摘要做键，LRU + TTL 淘汰"""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL_SECONDS, path: str = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self._entries = OrderedDict()  # key -> (过期时间, 回复文本)
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path:
+            self.load()
+            atexit.register(self.save)
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        """全角转半角、去掉标点空白和句末语气词，使 "头痛。" 与 "头痛了" 得到相同的键"""
+        return _CACHE_NOISE_RE.sub("", unicodedata.normalize("NFKC", text)).lower()
+
+    @staticmethod
+    def make_key(model: str, temperature: float, messages: list, early_text: str = None) -> str:
+        """生成缓存键；给出 early_text 时只用系统提示与归一化后的主诉做键"""
+        if early_text is not None:
+            payload = [model, round(temperature, 2), messages[0]["content"], CompletionCache.normalize_text(early_text)]
+        else:
+            payload = [model, round(temperature, 2),
+                       [[m["role"], _WHITESPACE_RE.sub(" ", m["content"]).strip()] for m in messages]]
+        return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._unsaved += 1
+            should_save = self.path and self._unsaved >= CACHE_PERSIST_EVERY
+        if should_save:
+            self.save()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        with self._lock:
+            for key, expires_at, value in entries:
+                if expires_at > now:
+                    self._entries[key] = (expires_at, value)
+
+    def save(self) -> None:
+        with self._lock:
+            entries = [[key, expires_at, value] for key, (expires_at, value) in self._entries.items()]
+            self._unsaved = 0
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)  # 原子替换，写到一半崩溃也不会损坏旧文件
+
+
+completion_cache = CompletionCache(path=CACHE_PATH)
+
+
+# 模型调用调度配置（每个工作进程各自计数，多进程部署时按进程数分摊服务商的限额）
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 16))  # 同时在途的模型请求上限
+LLM_RATE_PER_SECOND = float(os.environ.get("LLM_RATE_PER_SECOND", 8))  # 令牌桶每秒补充的请求数，0 表示不限速
+LLM_BURST = 16  # 令牌桶容量，允许的瞬时突发请求数
+LLM_MAX_QUEUE = 64  # 排队请求数上限，超出后直接拒绝并提示稍后重试
+LLM_QUEUE_TIMEOUT = 15  # 排队超过该秒数即放弃
+
+# 调度优先级，数值越小越先执行：收尾的病历优先于新一轮的追问
+PRIORITY_RECORD = 0
+PRIORITY_CHECK = 1
+PRIORITY_FOLLOW_UP = 2
+PRIORITY_SUMMARY = 3
+PRIORITY_NAMES = {PRIORITY_RECORD: "record", PRIORITY_CHECK: "check", PRIORITY_FOLLOW_UP: "follow_up", PRIORITY_SUMMARY: "summary"}
+
+
+class LLMOverloaded(Exception):
+    """模型调用排队已满或等待超时，调用方应返回 503 并提示稍后重试"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"模型调用繁忙，请 {retry_after} 秒后重试")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """令牌桶限速：按固定速率补充令牌，每次请求消耗一个"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self) -> float:
+        """距离下一个可用令牌的秒数，已有令牌时返回 0"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        if self.rate > 0:
+            self.tokens -= 1
+
+
+class _Ticket:
+    """一个排队中的模型调用；同步调用方等待 event，异步调用方等待 future"""
+
+    __slots__ = ("priority", "seq", "enqueued", "state", "event", "loop", "future")
+
+    def __init__(self, priority: int, seq: int, loop=None):
+        self.priority = priority
+        self.seq = seq
+        self.enqueued = time.monotonic()
+        self.state = "waiting"  # waiting / granted / rejected / abandoned
+        self.loop = loop
+        self.event = threading.Event() if loop is None else None
+        self.future = loop.create_future() if loop is not None else None
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def wake(self) -> None:
+        if self.loop is None:
+            self.event.set()
+            return
+        try:
+            self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(None))
+        except RuntimeError:  # 事件循环已关闭，等待方已不存在
+            pass
+
+
+class LLMDispatcher:
+    """模型调用的统一入口：限制并发、令牌桶限速、按优先级排队，排队满时快速失败
+
+    一个后台线程按 (优先级, 到达顺序) 依次放行排队的调用；队列已满时，
+    新到的高优先级调用挤掉队尾优先级最低的调用，否则直接拒绝。
+    """
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, rate: float = LLM_RATE_PER_SECOND,
+                 burst: float = LLM_BURST, max_queue: int = LLM_MAX_QUEUE, queue_timeout: float = LLM_QUEUE_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._bucket = TokenBucket(rate, burst)
+        self._cond = threading.Condition()
+        self._waiting = []  # 小顶堆，已放弃的条目惰性删除
+        self._queued = 0
+        self._in_flight = 0
+        self._seq = itertools.count()
+        self._thread_pid = None
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._wait_totals = {name: [0, 0.0] for name in PRIORITY_NAMES.values()}  # 名称 -> [放行数, 累计等待秒数]
+
+    def _ensure_thread(self) -> None:
+        # 延迟到首次使用时启动，fork 出的工作进程各自启动自己的调度线程
+        if self._thread_pid != os.getpid():
+            self._thread_pid = os.getpid()
+            threading.Thread(target=self._run, name="llm-dispatcher", daemon=True).start()
+
+    def _run(self) -> None:
+        with self._cond:
+            while True:
+                while self._waiting and self._waiting[0].state != "waiting":
+                    heapq.heappop(self._waiting)
+                if not self._waiting or self._in_flight >= self.max_concurrency:
+                    self._cond.wait()
+                    continue
+                delay = self._bucket.delay()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                ticket = heapq.heappop(self._waiting)
+                self._bucket.take()
+                self._queued -= 1
+                self._in_flight += 1
+                self.admitted += 1
+                waited = time.monotonic() - ticket.enqueued
+                totals = self._wait_totals[PRIORITY_NAMES[ticket.priority]]
+                totals[0] += 1
+                totals[1] += waited
+                metrics.observe("triage_llm_queue_wait_seconds", waited, route=PRIORITY_NAMES[ticket.priority])
+                ticket.state = "granted"
+                ticket.wake()
+
+    def retry_after(self) -> int:
+        """按当前积压与限速估算的建议重试间隔（秒）"""
+        backlog = self._queued + self._in_flight
+        rate = self._bucket.rate if self._bucket.rate > 0 else self.max_concurrency
+        return max(1, math.ceil(backlog / rate))
+
+    def busy(self) -> bool:
+        """已有调用在排队，说明并发或速率已到上限"""
+        with self._cond:
+            return self._queued > 0
+
+    def check_admission(self) -> None:
+        """队列已满时立即抛出 LLMOverloaded，供流式接口在开始响应之前检查"""
+        with self._cond:
+            if self._queued >= self.max_queue:
+                self.rejected += 1
+                raise LLMOverloaded(self.retry_after())
+
+    def _enqueue(self, priority: int, loop=None) -> _Ticket:
+        self._ensure_thread()
+        ticket = _Ticket(priority, next(self._seq), loop)
+        with self._cond:
+            if self._queued >= self.max_queue:
+                pending = [t for t in self._waiting if t.state == "waiting"]
+                victim = max(pending) if pending else None
+                if victim is None or victim.priority <= priority:
+                    self.rejected += 1
+                    raise LLMOverloaded(self.retry_after())
+                # 挤掉优先级最低、到达最晚的调用
+                victim.state = "rejected"
+                self._queued -= 1
+                self.rejected += 1
+                victim.wake()
+            heapq.heappush(self._waiting, ticket)
+            self._queued += 1
+            self._cond.notify()
+        return ticket
+
+    def _abandon(self, ticket: _Ticket) -> bool:
+        """等待方放弃排队；已被放行时返回 True，调用方需照常执行并释放"""
+        with self._cond:
+            if ticket.state == "granted":
+                return True
+            if ticket.state == "waiting":
+                ticket.state = "abandoned"
+                self._queued -= 1
+            return False
+
+    def _release(self) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify()
+
+    def _granted(self, ticket: _Ticket) -> None:
+        if ticket.state == "rejected":
+            raise LLMOverloaded(self.retry_after())
+        if ticket.state != "granted":
+            with self._cond:
+                self.timeouts += 1
+            logging.warning(f"模型调用排队超过 {self.queue_timeout}s，已放弃（{PRIORITY_NAMES[ticket.priority]}）")
+            raise LLMOverloaded(self.retry_after())
+
+    @contextlib.contextmanager
+    def slot(self, priority: int = PRIORITY_FOLLOW_UP):
+        """占用一个调用名额，直到离开 with 块"""
+        ticket = self._enqueue(priority)
+        if not ticket.event.wait(self.queue_timeout):
+            self._abandon(ticket)
+        self._granted(ticket)
+        try:
+            yield
+        finally:
+            self._release()
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, priority: int = PRIORITY_FOLLOW_UP):
+        """slot 的异步版本，排队时不占用事件循环"""
+        ticket = self._enqueue(priority, asyncio.get_running_loop())
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._abandon(ticket)
+        except asyncio.CancelledError:
+            # 推测调用被取消：仍在排队则撤下，已放行则归还名额
+            if self._abandon(ticket):
+                self._release()
+            raise
+        self._granted(ticket)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> dict:
+        with self._cond:
+            queued_by_priority = {name: 0 for name in PRIORITY_NAMES.values()}
+            for ticket in self._waiting:
+                if ticket.state == "waiting":
+                    queued_by_priority[PRIORITY_NAMES[ticket.priority]] += 1
+            return {
+                "in_flight": self._in_flight,
+                "queued": self._queued,
+                "queued_by_priority": queued_by_priority,
+                "max_concurrency": self.max_concurrency,
+                "max_queue": self.max_queue,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "avg_wait_ms": {
+                    name: round(total / count * 1000, 1) if count else 0.0
+                    for name, (count, total) in self._wait_totals.items()
+                },
+            }
+
+
+llm_dispatcher = LLMDispatcher()
+
+BUSY_MESSAGE = "当前咨询人数较多，请 {retry_after} 秒后重新发送。"
+
+
+def discard_turn(history: list) -> None:
+    """模型繁忙时撤回本轮已写入的患者消息，患者重发时不会重复"""
+    metrics.inc("triage_turns_total", outcome="overloaded")
+    if len(history) > 1 and history[-1]["role"] == "user":
+        history.pop()
+
+
+class LLMUnavailable(Exception):
+    """模型服务不可用（熔断中或重试用尽），调用方改用本地规则兜底"""
+
+
+# 可重试的错误：超时、连接失败、限流与服务端 5xx；流式读取中途断开时抛出的是 httpx 的传输错误
+RETRYABLE_ERRORS = (APIConnectionError, RateLimitError, InternalServerError, httpx.TransportError)
+
+
+class CircuitBreaker:
+    """熔断器：连续失败达到阈值后打开，冷却期内直接失败；冷却结束放行一个探测请求，成功即恢复"""
+
+    def __init__(self, failures: int = LLM_BREAKER_FAILURES, cooldown: float = LLM_BREAKER_COOLDOWN):
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.state = "closed"  # closed / open / half_open
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            # 冷却结束（或上一个探测请求迟迟没有结论）时放行一个探测请求
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = "half_open"
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def success(self) -> None:
+        with self._lock:
+            if self.state != "closed":
+                logging.info("模型服务已恢复，关闭熔断")
+            self.state = "closed"
+            self.failures = 0
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold):
+                if self.state == "closed":
+                    self.trips += 1
+                    logging.warning(f"模型调用连续失败 {self.failures} 次，熔断 {self.cooldown}s")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.failures, "trips": self.trips}
+
+
+class LatencyTracker:
+    """按调用类型保留最近的请求耗时，用于计算对冲阈值"""
+
+    def __init__(self, window: int = LLM_HEDGE_WINDOW, min_samples: int = LLM_HEDGE_MIN_SAMPLES):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, kind: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._samples.setdefault(kind, [])
+            samples.append(seconds)
+            if len(samples) > self.window:
+                del samples[0]
+
+    def quantile(self, kind: str, q: float = LLM_HEDGE_QUANTILE):
+        """同类调用耗时的 q 分位数（秒），样本不足时返回 None"""
+        with self._lock:
+            samples = sorted(self._samples.get(kind, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+llm_breaker = CircuitBreaker()
+llm_latency = LatencyTracker()
+hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="llm-hedge")
+
+llm_call_counters = {"attempts": 0, "retries": 0, "failures": 0, "hedged": 0, "hedge_wins": 0,
+                     "short_circuited": 0, "fallbacks": 0, "follow_ups_reused": 0}
+_llm_call_counters_lock = threading.Lock()
+
+
+def count_llm_event(name: str) -> None:
+    with _llm_call_counters_lock:
+        llm_call_counters[name] += 1
+
+
+def llm_call_stats() -> dict:
+    with _llm_call_counters_lock:
+        counters = dict(llm_call_counters)
+    return {**llm_dispatcher.stats(), **counters, "breaker": llm_breaker.stats(), "routes": route_stats.stats()}
+
+
+def backoff_delay(attempt: int, error: Exception) -> float:
+    """第 attempt 次失败后的等待秒数：指数退避加随机抖动；服务端给出 Retry-After 时不早于该值"""
+    delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            delay = max(delay, float(response.headers.get("retry-after", 0)))
+        except ValueError:
+            pass
+    return delay
+
+
+def _retry_plan():
+    """逐次产出本次尝试可用的超时秒数；熔断中抛出 LLMUnavailable，时限用尽时结束"""
+    deadline = time.monotonic() + LLM_DEADLINE_SECONDS
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        if not llm_breaker.allow():
+            count_llm_event("short_circuited")
+            raise LLMUnavailable("模型服务熔断中")
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        count_llm_event("attempts")
+        yield attempt, min(LLM_TIMEOUT_SECONDS, remaining), deadline
+
+
+def _record_failure(kind: str, attempt: int, error: Exception, deadline: float):
+    """记录一次可重试的失败，返回重试前应等待的秒数；不应再重试时返回 None"""
+    llm_breaker.failure()
+    count_llm_event("failures")
+    metrics.inc("triage_llm_errors_total", route=kind, error=type(error).__name__)
+    logging.warning(f"模型调用失败（{kind}，第 {attempt + 1} 次）: {error!r}")
+    if attempt >= LLM_MAX_RETRIES:
+        return None
+    delay = backoff_delay(attempt, error)
+    if time.monotonic() + delay >= deadline:
+        return None
+    count_llm_event("retries")
+    return delay
+
+
+def call_with_retries(request, kind: str):
+    """执行 request(timeout)：可重试的错误按退避重试，熔断中或重试用尽时抛出 LLMUnavailable"""
+    error = None
+    for attempt, timeout, deadline in _retry_plan():
+        started = time.monotonic()
+        try:
+            result = request(timeout)
+        except RETRYABLE_ERRORS as e:
+            error = e
+            delay = _record_failure(kind, attempt, e, deadline)
+            if delay is None:
+                break
+            time.sleep(delay)
+            continue
+        except Exception as e:
+            metrics.inc("triage_llm_errors_total", route=kind, error=type(e).__name__)
+            raise
+        llm_breaker.success()
+        llm_latency.record(kind, time.monotonic() - started)
+        return result
+    raise LLMUnavailable(f"模型调用失败: {error!r}") from error
+
+
+async def acall_with_retries(request, kind: str):
+    """call_with_retries 的异步版本，request(timeout) 返回可等待对象"""
+    error = None
+    for attempt, timeout, deadline in _retry_plan():
+        started = time.monotonic()
+        try:
+            result = await request(timeout)
+        except RETRYABLE_ERRORS as e:
+            error = e
+            delay = _record_failure(kind, attempt, e, deadline)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+            continue
+        except Exception as e:
+            metrics.inc("triage_llm_errors_total", route=kind, error=type(e).__name__)
+            raise
+        llm_breaker.success()
+        llm_latency.record(kind, time.monotonic() - started)
+        return result
+    raise LLMUnavailable(f"模型调用失败: {error!r}") from error
+
+
+def _hedge_delay(kind: str, timeout: float):
+    """需要对冲时返回发出第二个请求前的等待秒数，否则返回 None"""
+    if not LLM_HEDGE_MODE:
+        return None
+    threshold = llm_latency.quantile(kind)
+    if threshold is None or threshold >= timeout:
+        return None
+    return threshold
+
+
+def hedged(request, kind: str):
+    """包装 request(timeout)：首个请求超过同类调用的 p95 耗时仍未返回时再发一个，取先成功的结果
+
+    另一路的结果直接丢弃；已有调用在排队时不对冲，避免重复请求挤占名额。
+    """
+    def attempt(timeout: float):
+        delay = _hedge_delay(kind, timeout)
+        if delay is None:
+            return request(timeout)
+        primary = hedge_executor.submit(request, timeout)
+        try:
+            return primary.result(delay)
+        except FutureTimeoutError:
+            pass
+        if llm_dispatcher.busy():
+            return primary.result()
+        count_llm_event("hedged")
+        backup = hedge_executor.submit(request, timeout - delay)
+        pending = {primary, backup}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is backup:
+                        count_llm_event("hedge_wins")
+                    return future.result()
+        return primary.result()  # 两路都失败时抛出首个请求的错误
+
+    return attempt
+
+
+def ahedged(request, kind: str):
+    """hedged 的异步版本，落选的一路直接取消"""
+    async def attempt(timeout: float):
+        delay = _hedge_delay(kind, timeout)
+        if delay is None:
+            return await request(timeout)
+        primary = asyncio.ensure_future(request(timeout))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done or llm_dispatcher.busy():
+                return await primary
+            count_llm_event("hedged")
+            backup = asyncio.ensure_future(request(timeout - delay))
+            tasks.add(backup)
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is backup:
+                            count_llm_event("hedge_wins")
+                        return task.result()
+            return primary.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return attempt
+
+
+# 模型路由：按调用类型选择模型与输出上限。moonshot-v1 各型号能力相同、只差上下文窗口，
+# 默认都用最便宜的 8k，提示加输出超出窗口时自动换用更大的型号（见 route_model）；
+# 对话记录只在最大的型号也放不下时才截断（见 transcript_token_budget）
+MODEL_CONTEXT_WINDOWS = {"moonshot-v1-8k": 8192, "moonshot-v1-32k": 32768, "moonshot-v1-128k": 131072}
+MODEL_ROUTES = {
+    "check": (os.environ.get("LLM_MODEL_CHECK", "moonshot-v1-8k"), 192),  # 结论、缺项与一个追问问题的 JSON
+    "follow_up": (os.environ.get("LLM_MODEL_FOLLOW_UP", "moonshot-v1-8k"), 160),  # 一个简短的问题
+    "summary": (os.environ.get("LLM_MODEL_SUMMARY", "moonshot-v1-8k"), 512),  # 六项摘要的 JSON
+    "record": (os.environ.get("LLM_MODEL_RECORD", "moonshot-v1-8k"), 800),  # 病历各字段的 JSON，排版在本地完成
+}
+MESSAGE_OVERHEAD_TOKENS = 4  # 每条消息的角色与分隔符开销
+
+
+def estimate_prompt_tokens(messages: list) -> int:
+    return sum(estimate_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def route_model(route: str, messages: list) -> tuple:
+    """返回 (模型, max_tokens)：按路由表选择，放不下时换用能放下的最小型号"""
+    model, max_tokens = MODEL_ROUTES[route]
+    needed = estimate_prompt_tokens(messages) + max_tokens
+    if needed <= MODEL_CONTEXT_WINDOWS.get(model, needed):
+        return model, max_tokens
+    for candidate, window in sorted(MODEL_CONTEXT_WINDOWS.items(), key=lambda item: item[1]):
+        if window >= needed:
+            logging.info(f"提示约 {needed} tokens，超出 {model} 的上下文，改用 {candidate}（{route}）")
+            return candidate, max_tokens
+    return max(MODEL_CONTEXT_WINDOWS, key=MODEL_CONTEXT_WINDOWS.get), max_tokens
+
+
+class RouteStats:
+    """按路由统计调用次数、耗时与 token 用量（不含命中回复缓存的调用）"""
+
+    def __init__(self, window: int = LLM_HEDGE_WINDOW):
+        self.window = window
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def record(self, route: str, model: str, seconds: float, prompt_tokens: int, completion_tokens: int,
+               truncated: bool = False, cached_tokens: int = 0) -> None:
+        with self._lock:
+            entry = self._routes.setdefault(route, {
+                "calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "truncated": 0,
+                "models": {}, "latencies": [],
+            })
+            entry["calls"] += 1
+            entry["prompt_tokens"] += prompt_tokens
+            entry["cached_tokens"] += cached_tokens
+            entry["completion_tokens"] += completion_tokens
+            entry["truncated"] += truncated
+            entry["models"][model] = entry["models"].get(model, 0) + 1
+            entry["latencies"].append(seconds)
+            if len(entry["latencies"]) > self.window:
+                del entry["latencies"][0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            result = {}
+            for route, entry in self._routes.items():
+                latencies = sorted(entry["latencies"])
+                result[route] = {
+                    "calls": entry["calls"],
+                    "models": dict(entry["models"]),
+                    "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1),
+                    "p95_ms": round(latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))] * 1000, 1),
+                    "avg_prompt_tokens": round(entry["prompt_tokens"] / entry["calls"]),
+                    "avg_cached_tokens": round(entry["cached_tokens"] / entry["calls"]),
+                    "cached_ratio": round(entry["cached_tokens"] / entry["prompt_tokens"], 3) if entry["prompt_tokens"] else 0.0,
+                    "avg_completion_tokens": round(entry["completion_tokens"] / entry["calls"]),
+                    "truncated": entry["truncated"],
+                }
+            return result
+
+
+route_stats = RouteStats()
+
+
+def _usage_field(usage, name: str):
+    # SDK 解析出的用量是对象，服务商扩展的字段（如流式分段里附带的 usage）是原样的字典
+    return usage.get(name) if isinstance(usage, dict) else getattr(usage, name, None)
+
+
+def usage_tokens(usage, messages: list, content: str) -> tuple:
+    """返回 (提示 token, 其中命中上下文缓存的 token, 输出 token)；服务端未返回用量时按文本估算，命中数记为 0
+
+    命中数取 OpenAI 格式的 prompt_tokens_details.cached_tokens，或 Moonshot 直接给出的 cached_tokens。
+    """
+    if not usage:
+        return estimate_prompt_tokens(messages), 0, estimate_tokens(content or "")
+    details = _usage_field(usage, "prompt_tokens_details")
+    cached = (_usage_field(details, "cached_tokens") if details else None) or _usage_field(usage, "cached_tokens")
+    return _usage_field(usage, "prompt_tokens") or 0, cached or 0, _usage_field(usage, "completion_tokens") or 0
+
+
+def record_completion(route: str, model: str, seconds: float, messages: list, completion) -> str:
+    """记录一次非流式调用的耗时与用量并返回回复文本"""
+    choice = completion.choices[0]
+    content = choice.message.content
+    prompt_tokens, cached_tokens, completion_tokens = usage_tokens(completion.usage, messages, content)
+    truncated = choice.finish_reason == "length"
+    if truncated:
+        logging.warning(f"模型输出达到 max_tokens 被截断（{route}，{model}）")
+    observe_llm_call(route, model, seconds, prompt_tokens, completion_tokens, truncated=truncated,
+                     cached_tokens=cached_tokens)
+    return content
+
+
+def observe_llm_call(route: str, model: str, seconds: float, prompt_tokens: int, completion_tokens: int,
+                     stream: bool = False, truncated: bool = False, cached_tokens: int = 0) -> None:
+    """一次模型调用完成后更新路由统计、指标、Server-Timing 与本轮的提示用量"""
+    route_stats.record(route, model, seconds, prompt_tokens, completion_tokens, truncated, cached_tokens)
+    metrics.observe("triage_llm_call_seconds", seconds, route=route, model=model, stream=str(stream).lower())
+    metrics.inc("triage_llm_tokens_total", prompt_tokens, route=route, model=model, type="prompt")
+    metrics.inc("triage_llm_tokens_total", completion_tokens, route=route, model=model, type="completion")
+    metrics.inc("triage_llm_cached_tokens_total", cached_tokens, route=route, model=model)
+    add_server_timing(f"llm-{route}", seconds)
+    add_turn_tokens(prompt_tokens, cached_tokens)
+
+
+def lookup_cache(route: str, key: str):
+    """查询回复缓存并按路由计数命中情况"""
+    cached = completion_cache.get(key)
+    metrics.inc("triage_llm_cache_requests_total", route=route, result="miss" if cached is None else "hit")
+    return cached
+
+
+def _cache_key(model: str, temperature: float, messages: list, early_text: str = None) -> str:
+    use_early = CACHE_EARLY_TURN_KEYS and early_text is not None
+    return CompletionCache.make_key(model, temperature, messages, early_text if use_early else None)
+
+
+def chat_completion(messages: list, temperature: float, early_text: str = None,
+                    priority: int = PRIORITY_FOLLOW_UP, json_mode: bool = False) -> str:
+    """调用模型并返回回复文本；相同输入命中缓存时不再请求，否则经调度器排队
+
+    模型与 max_tokens 由调用类型（priority）决定；json_mode 要求模型只输出一个 JSON 对象。
+    每次请求都有超时，可重试的错误按退避重试；服务不可用时抛出 LLMUnavailable。
+    """
+    route = PRIORITY_NAMES[priority]
+    model, max_tokens = route_model(route, messages)
+    key = _cache_key(model, temperature, messages, early_text)
+    cached = lookup_cache(route, key)
+    if cached is not None:
+        return cached
+
+    def request(timeout: float):
+        return client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            response_format={"type": "json_object"} if json_mode else NOT_GIVEN,
+            timeout=timeout,
+        )
+
+    with llm_dispatcher.slot(priority):
+        started = time.monotonic()
+        completion = call_with_retries(hedged(request, route), route)
+    content = record_completion(route, model, time.monotonic() - started, messages, completion)
+    completion_cache.put(key, content)
+    return content
+
+
+async def achat_completion(messages: list, temperature: float, early_text: str = None,
+                           priority: int = PRIORITY_FOLLOW_UP, json_mode: bool = False) -> str:
+    """chat_completion 的异步版本，与同步版本共用缓存、调度器、熔断器和路由统计"""
+    route = PRIORITY_NAMES[priority]
+    model, max_tokens = route_model(route, messages)
+    key = _cache_key(model, temperature, messages, early_text)
+    cached = lookup_cache(route, key)
+    if cached is not None:
+        return cached
+
+    def request(timeout: float):
+        return async_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            response_format={"type": "json_object"} if json_mode else NOT_GIVEN,
+            timeout=timeout,
+        )
+
+    async with llm_dispatcher.aslot(priority):
+        started = time.monotonic()
+        completion = await acall_with_retries(ahedged(request, route), route)
+    content = record_completion(route, model, time.monotonic() - started, messages, completion)
+    completion_cache.put(key, content)
+    return content
+
+
+# 系统消息内容
+SYSTEM_MESSAGE = """
+你是一位专业的导诊员，由 Moonshot AI 提供支持。请通过多轮对话的方式，逐步了解患者的症状和情况。
+
+Role: 专业导诊员
+Background: 用户可能对自身病情描述不够清晰，需要通过引导性的提问来获取更多信息。
+Skills: 
+1. 善于倾听和提问，通过追问获取关键信息
+2. 能够根据用户的回答动态调整提问方向
+3. 具备专业的医学知识，能准确理解症状描述
+
+Workflow:
+1. 首先让患者描述主要症状
+2. 根据症状进行有针对性的追问：
+   - 症状持续时间
+   - 是否有诱因
+   - 是否伴随其他不适
+   - 是否有既往病史
+3. 获取足够信息后，推荐最合适的就诊科室
+
+注意事项：
+- 每次对话要有重点，避免一次性问太多问题
+- 提问要通俗易懂，避免专业术语
+- 如发现危急症状，及时建议就医
+"""
+
+# 会话存储配置
+SESSION_COOKIE_NAME = "triage_session"
+SESSION_TTL_SECONDS = 30 * 60  # 空闲超过该时长的问诊会被淘汰
+MAX_LIVE_SESSIONS = 1000  # 同时保留的问诊会话上限
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory")  # 可选 "memory"、"sqlite" 或 "redis"
+SESSION_DB_PATH = os.environ.get("SESSION_DB_PATH", "sessions.db")  # sqlite 后端的数据库文件
+SESSION_REDIS_URL = os.environ.get("SESSION_REDIS_URL", "redis://localhost:6379/0")  # redis 后端的地址
+SESSION_LOCK_TIMEOUT = 120  # redis 会话锁的自动过期秒数，防止进程崩溃后锁不释放
+
+
+def new_history() -> list:
+    """返回只包含系统消息的新对话历史"""
+    return [{"role": "system", "content": SYSTEM_MESSAGE}]
+
+
+class ConversationStore:
+    """按会话 ID 保存问诊记录的存储基类
+
+    存储的是精简后的对话记录：系统消息不落盘，只保存 (角色, 内容) 列表，
+    读取时再补回系统消息。子类只需实现 exists / _get / _put / _delete / _evict。
+    """
+
+    # 分段数远大于同时在途的问诊数，不同会话落到同一把锁上的概率很低
+    LOCK_STRIPES = 1024
+
+    def __init__(self, ttl: float = SESSION_TTL_SECONDS, max_sessions: int = MAX_LIVE_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        # 分段锁：同一会话的多次提交串行处理，不同会话互不阻塞
+        self._locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+        self._async_locks = [asyncio.Lock() for _ in range(self.LOCK_STRIPES)]
+
+    def _stripe(self, session_id: str) -> int:
+        # 用稳定的哈希而不是 hash()，多个工作进程对同一会话算出相同的分段
+        return zlib.crc32(session_id.encode()) % self.LOCK_STRIPES
+
+    def lock(self, session_id: str):
+        return self._locks[self._stripe(session_id)]
+
+    def async_lock(self, session_id: str):
+        """异步服务模式下使用的分段锁，等待时不占用事件循环"""
+        return self._async_locks[self._stripe(session_id)]
+
+    @staticmethod
+    def _pack(session: dict) -> str:
+        data = dict(session)
+        data["history"] = [[m["role"], m["content"]] for m in session["history"] if m["role"] != "system"]
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+    @staticmethod
+    def _unpack(packed: str) -> dict:
+        data = json.loads(packed)
+        history = new_history()
+        history.extend({"role": role, "content": content} for role, content in data["history"])
+        data["history"] = history
+        return data
+
+    def load(self, session_id: str) -> dict:
+        """读取会话，不存在或已过期时返回新的会话"""
+        packed = self._get(session_id)
+        if packed is None:
+            return {"history": new_history()}
+        return self._unpack(packed)
+
+    def save(self, session_id: str, session: dict) -> None:
+        self._put(session_id, self._pack(session))
+        self._evict()
+
+    def delete(self, session_id: str) -> None:
+        self._delete(session_id)
+
+    def exists(self, session_id: str) -> bool:
+        """会话是否存在且未过期；只做检查，不刷新最后访问时间"""
+        raise NotImplementedError
+
+    def save_job(self, job_id: str, state: dict) -> None:
+        """保存后台病历任务的状态，与会话共用存储与过期时间，多个工作进程都能读到"""
+        self._put(f"job:{job_id}", json.dumps(state, ensure_ascii=False))
+
+    def load_job(self, job_id: str):
+        packed = self._get(f"job:{job_id}")
+        return json.loads(packed) if packed is not None else None
+
+    def _get(self, session_id: str):
+        raise NotImplementedError
+
+    def _put(self, session_id: str, packed: str) -> None:
+        raise NotImplementedError
+
+    def _delete(self, session_id: str) -> None:
+        raise NotImplementedError
+
+    def _evict(self) -> None:
+        raise NotImplementedError
+
+
+class MemoryConversationStore(ConversationStore):
+    """进程内存后端，按最近访问顺序做 LRU + TTL 淘汰"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sessions = OrderedDict()  # session_id -> (最后访问时间, 打包数据)
+        self._guard = threading.Lock()
+
+    def _get(self, session_id):
+        with self._guard:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            last_access, packed = entry
+            if time.time() - last_access > self.ttl:
+                del self._sessions[session_id]
+                return None
+            self._sessions.move_to_end(session_id)
+            return packed
+
+    def exists(self, session_id):
+        with self._guard:
+            entry = self._sessions.get(session_id)
+            return entry is not None and time.time() - entry[0] <= self.ttl
+
+    def _put(self, session_id, packed):
+        with self._guard:
+            self._sessions[session_id] = (time.time(), packed)
+            self._sessions.move_to_end(session_id)
+
+    def _delete(self, session_id):
+        with self._guard:
+            self._sessions.pop(session_id, None)
+
+    def _evict(self):
+        deadline = time.time() - self.ttl
+        with self._guard:
+            # OrderedDict 头部即最久未访问的会话
+            while self._sessions:
+                session_id, (last_access, _) = next(iter(self._sessions.items()))
+                if last_access >= deadline and len(self._sessions) <= self.max_sessions:
+                    break
+                self._sessions.popitem(last=False)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class SQLiteConversationStore(ConversationStore):
+    """SQLite 后端，会话落盘，进程重启后仍可继续问诊
+
+    同一台机器上的多个工作进程可以共享同一个数据库文件：会话锁在进程内的分段锁之外，
+    再对数据库旁的锁文件加字节范围锁（fcntl），同一会话的提交在所有进程间串行处理。
+    """
+
+    def __init__(self, path: str = SESSION_DB_PATH, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = path
+        self._local = threading.local()
+        self._lock_fd = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT, 0o600) if fcntl is not None else None
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(updated_at)")
+        conn.commit()
+
+    @contextlib.contextmanager
+    def lock(self, session_id):
+        stripe = self._stripe(session_id)
+        with self._locks[stripe]:
+            if self._lock_fd is None:
+                yield
+                return
+            # 字节范围锁归属于进程，先用线程锁保证本进程内只有一个线程去争用
+            fcntl.lockf(self._lock_fd, fcntl.LOCK_EX, 1, stripe)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._lock_fd, fcntl.LOCK_UN, 1, stripe)
+
+    @contextlib.asynccontextmanager
+    async def async_lock(self, session_id):
+        stripe = self._stripe(session_id)
+        async with self._async_locks[stripe]:
+            if self._lock_fd is None:
+                yield
+                return
+            # 等待其他进程释放时会阻塞，放到线程里进行
+            await asyncio.get_running_loop().run_in_executor(
+                None, fcntl.lockf, self._lock_fd, fcntl.LOCK_EX, 1, stripe
+            )
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._lock_fd, fcntl.LOCK_UN, 1, stripe)
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 连接不能跨线程共享，每个线程各自持有一个；fork 之后也不能沿用父进程的连接
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _get(self, session_id):
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT data FROM sessions WHERE id = ? AND updated_at >= ?",
+            (session_id, time.time() - self.ttl),
+        ).fetchone()
+        if row is None:
+            return None
+        with conn:
+            conn.execute("UPDATE sessions SET updated_at = ? WHERE id = ?", (time.time(), session_id))
+        return row[0]
+
+    def exists(self, session_id):
+        row = self._conn().execute(
+            "SELECT 1 FROM sessions WHERE id = ? AND updated_at >= ?", (session_id, time.time() - self.ttl)
+        ).fetchone()
+        return row is not None
+
+    def _put(self, session_id, packed):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, updated_at) VALUES (?, ?, ?)",
+                (session_id, packed, time.time()),
+            )
+
+    def _delete(self, session_id):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def _evict(self):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.ttl,))
+            conn.execute(
+                "DELETE FROM sessions WHERE id IN ("
+                "SELECT id FROM sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_sessions,),
+            )
+
+
+class RedisConversationStore(ConversationStore):
+    """Redis 后端，供分布在多台机器上的工作进程共享会话
+
+    过期交给 Redis 的 TTL 处理，会话锁使用 Redis 分布式锁。
+    会话数上限由 Redis 的 maxmemory 策略控制，不再单独淘汰。
+    """
+
+    def __init__(self, url: str = SESSION_REDIS_URL, *args, **kwargs):
+        import redis  # 可选依赖，只有选用 redis 后端时才需要安装
+        import redis.asyncio
+
+        super().__init__(*args, **kwargs)
+        self._redis = redis.Redis.from_url(url)
+        self._async_redis = redis.asyncio.Redis.from_url(url)
+        self._redis.ping()
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"triage:session:{session_id}"
+
+    def lock(self, session_id):
+        return self._redis.lock(f"{self._key(session_id)}:lock", timeout=SESSION_LOCK_TIMEOUT)
+
+    def async_lock(self, session_id):
+        return self._async_redis.lock(f"{self._key(session_id)}:lock", timeout=SESSION_LOCK_TIMEOUT)
+
+    def _get(self, session_id):
+        # 读取的同时刷新过期时间，与其他后端“空闲超时”的语义一致
+        packed = self._redis.getex(self._key(session_id), ex=int(self.ttl))
+        return packed.decode() if packed is not None else None
+
+    def exists(self, session_id):
+        return bool(self._redis.exists(self._key(session_id)))
+
+    def _put(self, session_id, packed):
+        self._redis.set(self._key(session_id), packed, ex=int(self.ttl))
+
+    def _delete(self, session_id):
+        self._redis.delete(self._key(session_id))
+
+    def _evict(self):
+        pass
+
+
+def create_conversation_store(backend: str = SESSION_BACKEND) -> ConversationStore:
+    """根据配置创建会话存储"""
+    if backend == "memory":
+        return MemoryConversationStore()
+    if backend == "sqlite":
+        return SQLiteConversationStore(SESSION_DB_PATH)
+    if backend == "redis":
+        return RedisConversationStore(SESSION_REDIS_URL)
+    raise ValueError(f"未知的会话存储后端: {backend}")
+
+
+conversation_store = create_conversation_store()
+
+# 对话记录序列化配置：对话记录的 token 上限由各调用类型所用模型的上下文窗口推算
+TRANSCRIPT_RESERVE_TOKENS = 256  # 另外留出的余量，容纳估算误差与摘要生效后的摘要部分
+ROLE_LABELS = {"user": "患者", "assistant": "导诊员"}
+
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u9fff\uff00-\uffef]")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的 token 数：中文字符按 1 个计，其余字符约 4 个计 1 个，结果偏保守"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def transcript_token_budget() -> int:
+    """嵌入提示的对话记录上限：最大型号的上下文窗口减去任务说明、输出上限与余量，各类调用取最小值
+
+    同一份对话记录会用于完整性检查、追问和病历，必须对每一类都放得下；
+    超出默认型号窗口的提示由 route_model 换用更大的型号，只有最大的型号也放不下时才截断。
+    """
+    window = max(MODEL_CONTEXT_WINDOWS.values())
+    budgets = []
+    for route, build in (("check", build_check_messages), ("follow_up", build_follow_up_messages),
+                         ("record", build_medical_record_messages)):
+        _, max_tokens = MODEL_ROUTES[route]
+        budgets.append(window - max_tokens - estimate_prompt_tokens(build("")) - TRANSCRIPT_RESERVE_TOKENS)
+    return min(budgets)
+
+
+def serialize_transcript(history: list, budget: int = None) -> str:
+    """把对话历史序列化为紧凑的 "角色：内容" 文本，用于嵌入提示
+
+    系统消息不再重复嵌入；超出 token 预算（默认按 transcript_token_budget 推算）时
+    保留首条患者基本信息与最近的对话，省略中间较早的部分。
+    """
+    if budget is None:
+        budget = transcript_token_budget()
+    lines = [
+        f"{ROLE_LABELS.get(m['role'], m['role'])}：{_WHITESPACE_RE.sub(' ', m['content']).strip()}"
+        for m in history if m["role"] != "system"
+    ]
+    costs = [estimate_tokens(line) + 1 for line in lines]
+    if sum(costs) <= budget:
+        return "\n".join(lines)
+
+    # 首条为患者基本信息，始终保留；其余从最新一条往前装入预算，并为省略说明留出位置
+    kept = []
+    remaining = budget - costs[0] - estimate_tokens(f"（省略较早的 {len(lines)} 条对话）") - 1
+    for line, cost in zip(reversed(lines[1:]), reversed(costs[1:])):
+        if cost > remaining:
+            break
+        kept.append(line)
+        remaining -= cost
+    omitted = len(lines) - 1 - len(kept)
+    logging.info(f"对话记录超出 token 预算，省略较早的 {omitted} 条")
+    return "\n".join([lines[0], f"（省略较早的 {omitted} 条对话）", *reversed(kept)])
+
+
+# 问诊摘要配置：长对话改用 "结构化摘要 + 最近几条原始对话" 作为提示上下文
+SUMMARY_THRESHOLD_MESSAGES = 12  # 对话历史超过该长度后开始维护摘要
+SUMMARY_RECENT_MESSAGES = 4  # 始终原样保留的最近消息条数
+SUMMARY_FOLD_MESSAGES = 6  # 较早的消息攒够该条数才并入摘要一次；两次合并之间上下文只在末尾追加，可命中前缀缓存
+SUMMARY_SLOTS = ["主要症状", "持续时间", "诱因", "伴随症状", "既往病史", "生活状况"]
+
+
+def new_summary() -> dict:
+    """返回空的问诊摘要；covered 为已并入摘要的历史消息下标（系统消息与患者基本信息之后）"""
+    return {"slots": {slot: "" for slot in SUMMARY_SLOTS}, "covered": 2}
+
+
+def reset_summary(summary: dict) -> None:
+    if summary is not None:
+        summary.clear()
+        summary.update(new_summary())
+
+
+def summary_fold_range(history: list, summary: dict):
+    """返回本轮需要并入摘要的历史区间 (start, end)，无需更新时返回 None"""
+    if len(history) <= SUMMARY_THRESHOLD_MESSAGES:
+        return None
+    start, end = summary["covered"], len(history) - SUMMARY_RECENT_MESSAGES
+    return (start, end) if end - start >= SUMMARY_FOLD_MESSAGES else None
+
+
+def build_context(history: list, summary: dict = None) -> str:
+    """构造嵌入提示的问诊上下文
+
+    摘要尚未生效时等同于 serialize_transcript；生效后为 患者基本信息 + 结构化摘要 +
+    尚未并入摘要的原始对话，提示长度不再随轮数线性增长。每轮都变的内容只放在末尾，
+    两次合并摘要之间本轮上下文以上一轮的上下文（去掉末尾的轮数）开头。
+    """
+    if summary is None or summary["covered"] <= 2 or len(history) <= SUMMARY_THRESHOLD_MESSAGES:
+        return serialize_transcript(history)
+    slots = "\n".join(f"- {slot}：{value or '未提及'}" for slot, value in summary["slots"].items())
+    recent = serialize_transcript(history[:2] + history[summary["covered"]:])
+    intake, _, rest = recent.partition("\n")
+    # 摘要看不出轮数，单独注明，避免完整性检查误判"对话不足6轮"
+    rounds = sum(1 for m in history[2:] if m["role"] == "user")
+    return f"{intake}\n【此前对话摘要】\n{slots}\n【最近对话】\n{rest}\n（以上共进行了 {rounds} 轮问答）"
+
+
+SUMMARY_PROMPT = f"""你负责维护一份问诊摘要。请根据新增的对话更新摘要，保留原有信息，补充或修正新信息。
+只输出 JSON 对象，键为：{"、".join(SUMMARY_SLOTS)}，值为简洁的中文描述，未提及的填空字符串。"""
+
+
+def build_summary_messages(summary: dict, messages: list) -> list:
+    """构造增量更新摘要的提示消息，只提供新增的对话"""
+    return [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": f"当前摘要：\n{json.dumps(summary['slots'], ensure_ascii=False)}\n\n新增对话：\n{serialize_transcript(messages)}"}
+    ]
+
+
+def parse_summary_response(response: str, summary: dict, end: int) -> dict:
+    """解析模型返回的摘要 JSON，返回覆盖到 end 的新摘要"""
+    match = re.search(r"\{.*\}", response, re.S)
+    if match is None:
+        raise ValueError(f"摘要格式错误: {response}")
+    updated = json.loads(match.group(0))
+    slots = {slot: str(updated.get(slot) or summary["slots"].get(slot, "")) for slot in SUMMARY_SLOTS}
+    return {"slots": slots, "covered": end}
+
+
+def update_summary(history: list, summary: dict) -> dict:
+    """把尚未并入摘要的较早对话（通常只有最新滑出窗口的一轮）合并进摘要"""
+    start, end = summary_fold_range(history, summary)
+    response = chat_completion(
+        build_summary_messages(summary, history[start:end]), temperature=0.1, priority=PRIORITY_SUMMARY
+    )
+    return parse_summary_response(response, summary, end)
+
+
+def start_summary_update(history: list, summary: dict):
+    """需要时在线程池中开始更新摘要，返回 Future 或 None"""
+    if summary is None or summary_fold_range(history, summary) is None:
+        return None
+    return submit_with_context(llm_executor, update_summary, list(history), dict(summary))
+
+
+def finish_summary_update(future, summary: dict) -> None:
+    """等待摘要更新完成并写回；失败时保留旧摘要，下轮会连同未并入的对话一起重试"""
+    if future is None:
+        return
+    try:
+        summary.update(future.result())
+    except Exception as e:
+        logging.error(f"更新问诊摘要时发生错误: {e}")
+
+
+# 并行推测配置
+SPECULATIVE_MODE = True  # 可能结束问诊时同时发起完整性检查与病历生成（病历转入后台时改为追问），省去一次串行往返
+RECORD_MIN_HISTORY = 10  # 对话历史达到该长度后才可能结束问诊（约6轮问答）
+LLM_WORKERS = 32  # 推测请求使用的线程数
+
+llm_executor = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix="llm")
+
+
+# 提示前缀缓存：服务商会缓存与之前请求相同的提示前缀，命中的部分不必重新处理、计费也更低。
+# 各类调用的任务说明是固定不变的模块常量，放在最前；对话记录接在后面且逐轮只在末尾追加，
+# 这样上一轮同类调用的整个提示就是本轮提示的前缀
+CHECK_PROMPT = """你是一位专业的导诊员。请严格检查问诊信息的完整性，必须确保完成至少6轮有效对话。
+必须包含以下所有信息，每个信息点需要详细追问：
+1. 主要症状：
+   - 具体症状描述
+   - 症状的具体部位
+   - 症状的性质（如疼痛类型、程度等）
+
+2. 症状持续时间：
+   - 首次出现时间
+   - 发作频率
+   - 是否规律发作
+
+3. 症状诱因：
+   - 可能的诱发因素
+   - 加重或缓解因素
+   - 是否与特定行为相关
+
+4. 伴随症状：
+   - 其他不适感
+   - 生活作息影响
+   - 情绪变化
+
+5. 既往病史：
+   - 相关疾病史
+   - 家族病史
+   - 过敏史
+
+6. 基本生活状况：
+   - 作息规律
+   - 饮食习惯
+   - 工作环境
+
+只输出一个 JSON 对象，不要输出其他内容：
+{"complete": 是否完整（true/false）, "missing": [缺少的信息项], "next_question": "下一个需要追问的问题"}
+- 所有信息完整且【不超过10轮对话】时 complete 为 true，next_question 为空字符串
+- 信息不完整或对话不足6轮时 complete 为 false
+- missing 只能取 "主要症状"、"持续时间"、"诱因"、"伴随症状"、"既往病史"、"生活状况"
+- next_question 针对最关键的缺项，一次只问一个要点，简短明确，不与之前的问题重复"""
+
+
+def build_task_messages(instruction: str, request: str, transcript: str) -> list:
+    """构造一次调用的消息：固定的任务说明在前，逐轮追加的对话记录在后"""
+    return [
+        {"role": "system", "content": instruction},
+        {"role": "user", "content": f"{request}：\n{transcript}"},
+    ]
+
+
+def build_check_messages(history: str) -> list:
+    """构造检查问诊完整性的提示消息"""
+    return build_task_messages(CHECK_PROMPT, "请分析以下问诊对话", history)
+
+
+def loads_json(text: str):
+    return orjson.loads(text) if orjson is not None else json.loads(text)
+
+
+def parse_check_response(response: str) -> tuple:
+    """解析并校验完整性检查的 JSON 结果，返回 (是否完整, 缺失项, 下一个问题)；格式不符时抛出 ValueError"""
+    data = loads_json(response)
+    if not isinstance(data, dict) or not isinstance(data.get("complete"), bool):
+        raise ValueError(f"完整性检查结果格式不符: {response[:200]!r}")
+    missing = data.get("missing")
+    missing = [slot for slot in missing if slot in SUMMARY_SLOTS] if isinstance(missing, list) else []
+    question = data.get("next_question")
+    question = question.strip() if isinstance(question, str) and not data["complete"] else ""
+    return data["complete"], missing, question
+
+
+def log_check_result(is_complete: bool, missing: list) -> None:
+    logging.info(f"模型判断问诊{'已完整' if is_complete else '未完整'}（缺失：{'、'.join(missing) or '无'}）")
+
+
+def check_satisfaction(history: str) -> tuple[bool, str]:
+    """判断问诊是否完整；未完整时一并返回模型建议的下一个问题（可能为空，此时需单独生成追问）"""
+    try:
+        is_complete, missing, next_question = parse_check_response(
+            chat_completion(build_check_messages(history), temperature=0.1, priority=PRIORITY_CHECK, json_mode=True)
+        )
+    except (LLMOverloaded, LLMUnavailable):
+        raise
+    except Exception as e:
+        logging.error(f"检查问诊完整性时发生错误: {e}")
+        return False, ""
+    log_check_result(is_complete, missing)
+    return is_complete, next_question
+
+
+# 本地完整性检查：用关键词规则找出明显还没收集到的信息，这类情况不必调用模型；
+# 规则只能说明患者提到过相关内容、不能确认信息充分，是否完整始终交给模型判断
+LOCAL_CHECK_MODE = True
+LOCAL_CHECK_MIN_ROUNDS = 6  # 不足该轮数时直接判定未完成
+LOCAL_CHECK_MAX_ROUNDS = 10  # 达到该轮数后即使仍有缺项也交给模型判断，避免规则漏判导致问诊无法结束
+LOCAL_CHECK_CERTAIN_MISSING = 2  # 缺项不少于该数目时直接判定未完成
+
+# 每项信息的关键词，只匹配患者自己的回答；不收录 "症状""多久""还有""以前""生活" 这类提问用语
+SLOT_PATTERNS = {
+    "主要症状": r"痛|疼|痒|晕|咳|烧|热|吐|泻|胀|麻|酸|乏力|无力|不适|难受|肿|出血|流血|呼吸困难|气短|失眠|心慌|心悸|胸闷|恶心|腹泻|便秘|皮疹",
+    "持续时间": r"\d+\s*(?:天|日|周|星期|个月|月|年|小时|分钟)|[一二两三四五六七八九十几半]+\s*(?:天|日|周|星期|个月|月|年|小时|分钟)"
+               r"|昨天|前天|今天|最近|近期|刚才|刚刚|早上|晚上|夜里|一直|反复|偶尔|经常|每天|持续",
+    "诱因": r"诱发|受凉|着凉|感冒|劳累|熬夜|饮酒|喝酒|吃了|进食|饭后|空腹|运动后|活动后|生气|紧张|压力|天气|外伤|摔|碰|撞|加重|缓解|好转|休息后",
+    "伴随症状": r"伴有|没有其他|无其他|发热|发烧|恶心|呕吐|头晕|乏力|出汗|流鼻涕|鼻塞|咳痰|腹泻|拉肚子",
+    "既往病史": r"曾经|得过|患过|慢性病|高血压|糖尿病|心脏病|哮喘|鼻炎|胃病|手术|住院|过敏|家族|遗传|父母|吃药|服药|用药",
+    "生活状况": r"作息|睡眠|睡觉|熬夜|饮食|吃饭|口味|抽烟|吸烟|喝酒|饮酒|上班|加班|职业|运动|锻炼|久坐",
+}
+SLOT_REGEXES = {slot: re.compile(pattern) for slot, pattern in SLOT_PATTERNS.items()}
+# 不提供信息的回答（空白、拒答、"不知道""不清楚""没有"等）不计入任何一项
+NON_ANSWER_RE = re.compile(r"[\s\W]*(?:(?:不知道|不清楚|没有|没|无|不记得|记不清|说不清|不确定|不想说|忘了|嗯|哦)[\s\W]*)*")
+
+llm_calls_avoided = 0  # 本地规则直接给出结论、省下的完整性检查调用次数
+_llm_calls_avoided_lock = threading.Lock()
+
+
+def scan_slots(history: list) -> tuple:
+    """返回 (患者回答的轮数, 缺失项列表)；只看患者自己的回答，不提供信息的回答不计入任何一项"""
+    # 跳过系统消息与患者基本信息；导诊员的提问里本来就有各项的关键词，不能算作已收集
+    replies = [m["content"] for m in history[2:] if m["role"] == "user"]
+    filled = set()
+    for reply in replies:
+        if NON_ANSWER_RE.fullmatch(reply):
+            continue
+        for slot, regex in SLOT_REGEXES.items():
+            if regex.search(reply):
+                filled.add(slot)
+    return len(replies), [slot for slot in SLOT_PATTERNS if slot not in filled]
+
+
+def local_check_satisfaction(history: list) -> tuple:
+    """用本地规则判断问诊是否完整
+
+    返回 (结论, 缺失项列表)：结论为 False 表示可以确定未完成，None 表示需要模型判断。
+    关键词只能说明患者提到过相关内容，因此规则从不直接判定完整。
+    """
+    rounds, missing = scan_slots(history)
+    if rounds < LOCAL_CHECK_MIN_ROUNDS or len(history) < RECORD_MIN_HISTORY:
+        return False, missing
+    if len(missing) >= LOCAL_CHECK_CERTAIN_MISSING and rounds < LOCAL_CHECK_MAX_ROUNDS:
+        return False, missing
+    return None, missing
+
+
+def local_verdict(history: list):
+    """本地规则能确定未完成时返回 False 并计入省下的调用次数，否则返回 None"""
+    global llm_calls_avoided
+    if not LOCAL_CHECK_MODE:
+        return None
+    verdict, missing = local_check_satisfaction(history)
+    if verdict is None:
+        logging.info(f"本地规则无法确定问诊是否完整（缺失：{'、'.join(missing)}），交由模型判断")
+        return None
+    with _llm_calls_avoided_lock:
+        llm_calls_avoided += 1
+        avoided = llm_calls_avoided
+    logging.info(f"本地判断问诊未完整（缺失：{'、'.join(missing) or '无'}），累计省去 {avoided} 次模型调用")
+    return verdict
+
+
+# 科室推荐词表：科室 -> {症状关键词: 权重}，权重越高指向性越强
+DEPARTMENT_SYMPTOMS = {
+    "神经内科": {"头痛": 3, "偏头痛": 3, "头晕": 2, "眩晕": 2, "手脚麻木": 3, "麻木": 2, "抽搐": 3,
+               "记忆力下降": 3, "肢体无力": 3, "口角歪斜": 3, "言语不清": 3, "失眠": 1},
+    "心血管内科": {"胸闷": 3, "胸痛": 3, "心慌": 3, "心悸": 3, "心跳快": 2, "心跳慢": 2, "血压高": 3,
+                "高血压": 2, "气短": 2, "下肢水肿": 2, "腿肿": 2},
+    "呼吸内科": {"咳嗽": 3, "咳痰": 3, "痰多": 2, "气喘": 3, "喘不上气": 3, "呼吸困难": 2, "咯血": 3,
+              "胸闷": 1, "发烧": 1, "发热": 1},
+    "消化内科": {"胃痛": 3, "胃疼": 3, "胃胀": 3, "腹痛": 2, "肚子痛": 2, "肚子疼": 2, "腹胀": 3, "腹泻": 3,
+              "拉肚子": 3, "恶心": 2, "呕吐": 2, "反酸": 3, "烧心": 3, "便秘": 2, "便血": 2, "黑便": 3,
+              "食欲不振": 2, "没胃口": 2},
+    "普外科": {"右下腹痛": 3, "阑尾": 3, "包块": 2, "疝气": 3, "伤口": 2, "外伤": 1},
+    "骨科": {"腰痛": 3, "腰疼": 3, "颈椎": 3, "脖子疼": 2, "关节痛": 3, "关节疼": 3, "膝盖痛": 3, "膝盖疼": 3,
+           "骨折": 3, "扭伤": 3, "崴脚": 3, "肩膀痛": 2, "背痛": 2, "腿疼": 1},
+    "泌尿外科": {"尿频": 3, "尿急": 3, "尿痛": 3, "血尿": 3, "排尿困难": 3, "尿不出": 3, "腰痛": 1},
+    "内分泌科": {"多饮": 3, "多尿": 2, "口渴": 2, "消瘦": 2, "体重下降": 2, "血糖高": 3, "糖尿病": 3,
+              "甲状腺": 3, "怕热": 2, "脖子粗": 3},
+    "皮肤科": {"皮疹": 3, "红疹": 3, "湿疹": 3, "荨麻疹": 3, "瘙痒": 3, "痒": 2, "脱发": 3, "痘痘": 3, "起疙瘩": 3},
+    "耳鼻喉科": {"耳鸣": 3, "耳痛": 3, "耳朵疼": 3, "听力下降": 3, "鼻塞": 3, "流鼻涕": 2, "流鼻血": 3,
+              "咽痛": 2, "嗓子疼": 2, "喉咙痛": 2, "声音嘶哑": 3},
+    "眼科": {"眼睛痛": 3, "眼睛疼": 3, "视力下降": 3, "视物模糊": 3, "看不清": 2, "眼睛红": 3, "眼干": 2, "流泪": 2},
+    "口腔科": {"牙痛": 3, "牙疼": 3, "牙龈出血": 3, "牙龈肿": 3, "口腔溃疡": 3},
+    "妇科": {"月经": 3, "痛经": 3, "白带": 3, "阴道出血": 3, "闭经": 3, "下腹痛": 1},
+    "产科": {"怀孕": 3, "停经": 2, "孕期": 3},
+    "精神心理科": {"焦虑": 3, "抑郁": 3, "情绪低落": 3, "心情不好": 2, "紧张": 1, "失眠": 1},
+    "感染科": {"发烧": 2, "发热": 2, "高烧": 3, "畏寒": 2, "寒战": 2},
+}
+DEFAULT_DEPARTMENT = "全科医学科"
+PEDIATRIC_AGE = 14  # 低于该年龄优先推荐儿科
+FEMALE_ONLY_DEPARTMENTS = {"妇科", "产科"}
+
+# 倒排索引：关键词 -> [(科室, 权重)]，所有关键词编译为一个正则，按长度优先匹配
+DEPARTMENT_INDEX = {}
+for _department, _symptoms in DEPARTMENT_SYMPTOMS.items():
+    for _keyword, _weight in _symptoms.items():
+        DEPARTMENT_INDEX.setdefault(_keyword, []).append((_department, _weight))
+DEPARTMENT_KEYWORD_RE = re.compile("|".join(map(re.escape, sorted(DEPARTMENT_INDEX, key=len, reverse=True))))
+_NEGATION_RE = re.compile(r"(?:没有|没|无|不|否认)[^，。,.；;！!？?]{0,2}$")
+_INTAKE_AGE_RE = re.compile(r"年龄：(\d+)岁")
+_INTAKE_GENDER_RE = re.compile(r"性别：(男|女)")
+
+
+def recommend_departments(text: str, intake: str = "", top_k: int = 3) -> list:
+    """根据症状描述返回按得分排序的推荐科室，纯本地计算，每次调用仅需数十微秒
+
+    text 为患者的症状描述，intake 为患者基本信息（用于儿科与性别相关科室的调整）。
+    每个关键词只计一次，前面带否定词（如 "没有发烧"）的不计分。
+    """
+    scores = {}
+    matched = {}
+    for match in DEPARTMENT_KEYWORD_RE.finditer(text):
+        keyword = match.group(0)
+        if _NEGATION_RE.search(text, max(0, match.start() - 4), match.start()):
+            continue
+        for department, weight in DEPARTMENT_INDEX[keyword]:
+            if keyword in matched.setdefault(department, []):
+                continue
+            matched[department].append(keyword)
+            scores[department] = scores.get(department, 0) + weight
+
+    gender = _INTAKE_GENDER_RE.search(intake)
+    if gender and gender.group(1) == "男":
+        for department in FEMALE_ONLY_DEPARTMENTS:
+            scores.pop(department, None)
+    age = _INTAKE_AGE_RE.search(intake)
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+    results = [{"department": d, "score": score, "matched": matched[d]} for d, score in ranked]
+    if age and int(age.group(1)) < PEDIATRIC_AGE:
+        top_score = results[0]["score"] if results else 0
+        results.insert(0, {"department": "儿科", "score": top_score, "matched": [f"{age.group(1)}岁"]})
+    if not results:
+        results.append({"department": DEFAULT_DEPARTMENT, "score": 0, "matched": []})
+    return results[:top_k]
+
+
+def recommend_departments_for_history(history: list, top_k: int = 3) -> list:
+    """按当前问诊中患者的全部回答推荐科室"""
+    patient_turns = [m["content"] for m in history[1:] if m["role"] == "user"]
+    intake = patient_turns[0] if patient_turns and "患者基本信息：" in patient_turns[0] else ""
+    symptoms = patient_turns[1:] if intake else patient_turns
+    return recommend_departments("。".join(symptoms), intake, top_k)
+
+
+# 危急症状词表：类别 -> 短语；在任何模型调用之前对每条输入做匹配
+RED_FLAG_LEXICON = {
+    "急性心脏疾病": ["胸痛", "胸口痛", "胸口疼", "胸口剧痛", "心前区疼痛", "压榨样", "胸口像压了石头", "胸痛放射到左臂",
+                 "心脏骤停", "心跳骤停"],
+    "脑卒中": ["口角歪斜", "嘴歪", "口眼歪斜", "半身不遂", "一侧肢体无力", "一边手脚没力气", "半边身体麻木", "说话不清楚",
+            "说话不清", "说不出话", "言语不清", "突然看不见", "突发剧烈头痛", "剧烈头痛", "一辈子最痛的头痛"],
+    "大出血": ["大出血", "大量出血", "血流不止", "止不住血", "出血不止", "呕血", "吐血", "咯血", "大量便血", "孕期出血",
+            "怀孕出血"],
+    # "没有呼吸" 会误中 "没有呼吸困难"，因此只收 "没了呼吸"
+    "呼吸衰竭或窒息": ["喘不上气", "呼吸困难", "无法呼吸", "不呼吸", "没了呼吸", "停止呼吸", "憋气", "窒息", "嘴唇发紫",
+                 "嘴唇青紫", "喉咙肿得"],
+    "意识障碍": ["昏迷", "晕倒", "昏倒", "晕厥", "晕过去", "昏过去", "意识不清", "叫不醒", "抽搐不止", "癫痫发作"],
+    "中毒或严重过敏": ["中毒", "喝了农药", "吃了农药", "过敏性休克", "煤气"],
+    "严重外伤": ["车祸", "高处坠落", "从高处摔下", "骨头露出来", "刀伤", "枪伤", "烧伤面积"],
+    "自伤风险": ["想自杀", "自杀", "不想活", "轻生", "割腕", "吃了很多安眠药"],
+}
+RED_FLAG_PHRASES = {phrase: category for category, phrases in RED_FLAG_LEXICON.items() for phrase in phrases}
+# 全部短语编译为一个按长度优先的正则自动机，单次扫描即可完成匹配
+RED_FLAG_RE = re.compile("|".join(map(re.escape, sorted(RED_FLAG_PHRASES, key=len, reverse=True))))
+# 紧挨在短语前的否定词或表示过去的词（如 "没有胸痛""以前有过晕厥"），中间只允许少数连接词；
+# 漏报的代价远高于误报，"过去两天一直胸痛""不舒服，胸痛" 这类说法仍然计入。
+# 前面紧跟时间单位的 "以前""过去" 是 "……之前" 的意思（如 "半小时以前晕倒了"），说的是刚发生的事，不能跳过
+_RED_FLAG_SKIP_RE = re.compile(
+    r"(?:没有|没|无|不|否认|曾经|从前|(?<![分钟时天日周期月年儿])以前|(?<![晕昏倒分钟时天日周期月年儿])过去)"
+    r"也?(?:有过|出现过|发生过|得过|有|出现|感到|觉得|明显)?$"
+)
+
+
+def detect_red_flags(text: str) -> list:
+    """返回文本中出现的危急症状 [(类别, 短语)]，前面紧挨否定词或 "以前""曾经" 等过去时间的不计"""
+    flags = []
+    for match in RED_FLAG_RE.finditer(text):
+        if _RED_FLAG_SKIP_RE.search(text, max(0, match.start() - 8), match.start()):
+            continue
+        flag = (RED_FLAG_PHRASES[match.group(0)], match.group(0))
+        if flag not in flags:
+            flags.append(flag)
+    return flags
+
+
+def emergency_response(flags: list) -> str:
+    """根据命中的危急症状生成就医提醒"""
+    categories = "、".join(dict.fromkeys(category for category, _ in flags))
+    phrases = "、".join(phrase for _, phrase in flags)
+    if any(category == "自伤风险" for category, _ in flags):
+        return (f"⚠️ **紧急提醒**：您提到了「{phrases}」。您的安全最重要，请立即联系身边信任的人陪伴您，"
+                f"并拨打 120 或当地心理援助热线寻求帮助。\n\n如果您愿意，可以继续告诉我您现在的感受。")
+    return (f"⚠️ **紧急提醒**：您描述的「{phrases}」可能提示{categories}等危急情况。"
+            f"请立即拨打 120 或尽快前往最近医院的急诊科就诊，不要等待线上问诊结果。\n\n"
+            f"如症状已经缓解，请在就诊后再继续问诊。")
+
+
+def handle_red_flags(query: str, history: list):
+    """命中危急症状时直接写入就医提醒并返回，不再调用模型；未命中返回 None"""
+    flags = detect_red_flags(query)
+    if not flags:
+        return None
+    logging.warning(f"检测到危急症状: {flags}")
+    metrics.inc("triage_turns_total", outcome="emergency")
+    result = emergency_response(flags)
+    history.append({"role": "user", "content": query})
+    history.append({"role": "assistant", "content": result})
+    journal_event("turn", history[-2:])
+    return result
+
+
+# 问诊日志配置：按会话追加写入的预写日志，进程重启后恢复进行中的问诊，已结束的问诊压缩进 SQLite 归档
+JOURNAL_DIR = os.environ.get("JOURNAL_DIR") or None  # 设置为目录（如 "journal"）即启用
+JOURNAL_FLUSH_INTERVAL = float(os.environ.get("JOURNAL_FLUSH_INTERVAL", 0.05))  # 批量 fsync 的间隔（秒），0 表示每条事件立即落盘
+JOURNAL_SEGMENT_BYTES = 8 * 1024 * 1024  # 日志段超过该大小即封存，随后压缩进归档
+ARCHIVE_DB_PATH = os.environ.get("ARCHIVE_DB_PATH", "")  # 归档数据库文件，默认放在日志目录下
+ARCHIVE_TOKEN = os.environ.get("ARCHIVE_TOKEN", "")  # /consultations 查询接口的访问令牌，为空时不开放该接口
+
+_current_session_id = contextvars.ContextVar("current_session_id", default=None)
+_DEPARTMENT_NAME_RE = re.compile(
+    "|".join(map(re.escape, sorted(set(DEPARTMENT_SYMPTOMS) | {DEFAULT_DEPARTMENT, "儿科"}, key=len, reverse=True)))
+)
+
+
+def record_department(transcript: list) -> str:
+    """取病历中建议的科室，病历里找不到已知科室时按患者的回答本地推荐"""
+    record = transcript[-1][1] if transcript else ""
+    anchor = record.find("科室")
+    match = _DEPARTMENT_NAME_RE.search(record, max(anchor, 0))
+    if match:
+        return match.group(0)
+    history = new_history() + [{"role": role, "content": content} for role, content in transcript]
+    return recommend_departments_for_history(history, top_k=1)[0]["department"]
+
+
+class ConsultationArchive:
+    """已结束问诊的 SQLite 归档，按日期与科室建索引"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS consultations ("
+            "session_id TEXT NOT NULL, started_at REAL NOT NULL, finished_at REAL NOT NULL, day TEXT NOT NULL, "
+            "department TEXT NOT NULL, transcript TEXT NOT NULL, PRIMARY KEY (session_id, finished_at))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_consultations_day ON consultations(day, department)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_consultations_department ON consultations(department, day)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_consultations_finished ON consultations(finished_at)")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        # 与 SQLiteConversationStore 相同：每个线程、每个进程各自持有连接
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def add(self, consultations: list) -> None:
+        """写入已结束的问诊；同一会话同一结束时间的问诊只保留一份，重复压缩不会产生重复记录"""
+        rows = [
+            (c["session_id"], c["started_at"], c["finished_at"], f"{datetime.fromtimestamp(c['finished_at']):%Y-%m-%d}",
+             record_department(c["transcript"]), json.dumps(c["transcript"], ensure_ascii=False))
+            for c in consultations
+        ]
+        with self._conn() as conn:
+            conn.executemany("INSERT OR IGNORE INTO consultations VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def last_finished(self, since: float) -> dict:
+        """返回 since 之后结束过问诊的会话 -> 最后一次结束时间，用于跳过已归档问诊在日志中的残留事件"""
+        rows = self._conn().execute(
+            "SELECT session_id, MAX(finished_at) FROM consultations WHERE finished_at >= ? GROUP BY session_id",
+            (since,),
+        ).fetchall()
+        return dict(rows)
+
+    def query(self, day: str = None, department: str = None, limit: int = 50) -> list:
+        """按日期（YYYY-MM-DD）和/或科室查询，最近结束的在前"""
+        conditions, params = [], []
+        if day:
+            conditions.append("day = ?")
+            params.append(day)
+        if department:
+            conditions.append("department = ?")
+            params.append(department)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._conn().execute(
+            f"SELECT session_id, started_at, finished_at, day, department, transcript FROM consultations {where} "
+            "ORDER BY finished_at DESC LIMIT ?",
+            (*params, limit),
+        ).fetchall()
+        return [
+            {"session_id": session_id, "started_at": started_at, "finished_at": finished_at, "date": day,
+             "department": department, "transcript": json.loads(transcript)}
+            for session_id, started_at, finished_at, day, department, transcript in rows
+        ]
+
+
+def replay_journal(events: list, closed: dict) -> tuple:
+    """按时间顺序重放事件，返回 (进行中的问诊, 已结束的问诊)
+
+    进行中的问诊为 会话 -> {started_at, updated_at, messages}；closed 中记录的结束时间及之前的事件已归档，直接跳过。
+    """
+    states, finished = {}, []
+    for event in events:
+        session_id, t = event["s"], event["t"]
+        if t <= closed.get(session_id, 0):
+            continue
+        if event["e"] == "start":
+            states[session_id] = {"started_at": event.get("b", t), "updated_at": t, "messages": list(event["m"])}
+        elif event["e"] == "turn":
+            state = states.setdefault(session_id, {"started_at": t, "updated_at": t, "messages": []})
+            state["messages"].extend(event["m"])
+            state["updated_at"] = t
+        elif event["e"] == "record":
+            state = states.pop(session_id, None)
+            finished.append({"session_id": session_id, "started_at": state["started_at"] if state else t,
+                             "finished_at": t, "transcript": event["m"]})
+    return states, finished
+
+
+class ConsultationJournal:
+    """问诊事件的预写日志：每个进程追加写自己的日志段，后台线程攒批后统一 fsync
+
+    每行一条事件：CRC32 + JSON {t 时间, s 会话, e 事件, m 消息}。事件有三种：start（填写基本信息，开始新的问诊）、
+    turn（一问一答）、record（生成病历，附完整对话，问诊结束）。请求线程只把编码好的一行放进缓冲区，不等磁盘；
+    进程崩溃最多丢失最近一个刷盘间隔内的事件，末尾写了一半的行按校验和丢弃。
+    段文件写满后封存；压缩时把已结束的问诊写入归档，进行中的问诊以快照形式转写到当前段，再删除封存段。
+    """
+
+    def __init__(self, directory: str, archive: ConsultationArchive, flush_interval: float = JOURNAL_FLUSH_INTERVAL,
+                 segment_bytes: int = JOURNAL_SEGMENT_BYTES):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.archive = archive
+        self.flush_interval = flush_interval
+        self.segment_bytes = segment_bytes
+        self._pending = []
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._closed = False
+        self.appended = 0
+        self.fsyncs = 0
+        self.compactions = 0
+        self._open_segment()
+        if flush_interval > 0:
+            threading.Thread(target=self._flush_loop, name="journal-flush", daemon=True).start()
+        atexit.register(self.close)
+
+    def _open_segment(self) -> None:
+        self.segment_path = os.path.join(self.directory, f"{os.getpid()}-{time.time_ns()}.wal")
+        self._fd = os.open(self.segment_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        if fcntl is not None:
+            # 持有期间其他进程无法加锁，压缩时据此区分仍在写入的段与已封存（或所属进程已退出）的段
+            fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._segment_size = 0
+
+    @staticmethod
+    def _encode(event: dict) -> bytes:
+        payload = json.dumps(event, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return b"%08x %s\n" % (zlib.crc32(payload), payload)
+
+    def append(self, session_id: str, event: str, messages: list, **extra) -> None:
+        """追加一条事件；按间隔批量刷盘时只放进缓冲区即返回"""
+        line = self._encode({"t": time.time(), "s": session_id, "e": event, "m": messages, **extra})
+        with self._cond:
+            self.appended += 1
+            if self.flush_interval > 0:
+                self._pending.append(line)
+                if len(self._pending) == 1:
+                    self._cond.notify()
+                return
+        self._write([line])
+
+    def _flush_loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+            time.sleep(self.flush_interval)  # 等一个间隔，让这段时间内的事件合并成一次 fsync
+            self.flush()
+
+    def flush(self) -> None:
+        with self._cond:
+            lines, self._pending = self._pending, []
+        if lines and self._write(lines):
+            self.compact()
+
+    def _write(self, lines: list) -> bool:
+        """写入并 fsync，返回是否因写满而换了新段"""
+        data = b"".join(lines)
+        with self._write_lock:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self._fd, view):]
+            os.fsync(self._fd)
+            self.fsyncs += 1
+            self._segment_size += len(data)
+            if self._segment_size < self.segment_bytes:
+                return False
+            os.close(self._fd)  # 关闭即释放段锁，该段视为封存
+            self._open_segment()
+            return True
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self.flush()
+
+    def _segments(self) -> list:
+        return sorted(
+            os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".wal")
+        )
+
+    @staticmethod
+    def _is_sealed(path: str) -> bool:
+        """段文件没有被任何进程持有锁即已封存；没有 fcntl 时只支持单进程，其他段都视为已封存"""
+        if fcntl is None:
+            return True
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def read_events(paths: list) -> list:
+        """读取日志段中的事件并按时间排序；校验失败的行（崩溃时写了一半）跳过"""
+        events = []
+        for path in paths:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            for line in data.splitlines():
+                crc, _, payload = line.partition(b" ")
+                try:
+                    if int(crc, 16) != zlib.crc32(payload):
+                        raise ValueError("校验和不符")
+                    event = json.loads(payload)
+                except ValueError:
+                    logging.warning(f"跳过问诊日志中损坏的一行: {path}")
+                    continue
+                event["path"] = path
+                events.append(event)
+        events.sort(key=lambda event: event["t"])
+        return events
+
+    def _replay(self, paths: list) -> tuple:
+        events = self.read_events(paths)
+        closed = self.archive.last_finished(events[0]["t"]) if events else {}
+        states, finished = replay_journal(events, closed)
+        return events, states, finished
+
+    @contextlib.contextmanager
+    def _compaction_guard(self):
+        """同一时刻只允许一个进程中的一个线程压缩，已有压缩在进行时返回 False"""
+        if not self._compact_lock.acquire(blocking=False):
+            yield False
+            return
+        fd = None
+        try:
+            if fcntl is not None:
+                fd = os.open(os.path.join(self.directory, "compact.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    yield False
+                    return
+            yield True
+        finally:
+            if fd is not None:
+                os.close(fd)
+            self._compact_lock.release()
+
+    def compact(self) -> int:
+        """把已封存的段压缩进归档，返回删除的段数
+
+        读取全部段（含其他进程正在写的段）重建每个问诊的状态：已结束的写入归档；
+        在封存段中出现过、仍在有效期内的进行中问诊写一条 start 快照到当前段，然后删除封存段。
+        """
+        with self._compaction_guard() as acquired:
+            if not acquired:
+                return 0
+            segments = [path for path in self._segments() if path != self.segment_path]
+            sealed = {path for path in segments if self._is_sealed(path)}
+            if not sealed:
+                return 0
+            events, states, finished = self._replay(segments + [self.segment_path])
+            self.archive.add(finished)
+            sealed_sessions = {event["s"] for event in events if event["path"] in sealed}
+            deadline = time.time() - SESSION_TTL_SECONDS
+            snapshots = [
+                self._encode({"t": state["updated_at"], "s": session_id, "e": "start", "m": state["messages"],
+                              "b": state["started_at"]})
+                for session_id, state in states.items()
+                if session_id in sealed_sessions and state["updated_at"] >= deadline
+            ]
+            if snapshots:
+                self._write(snapshots)
+            for path in sealed:
+                os.remove(path)
+            self.compactions += 1
+            logging.info(
+                f"问诊日志压缩：封存段 {len(sealed)} 个，归档问诊 {len(finished)} 个，转写进行中问诊 {len(snapshots)} 个"
+            )
+            return len(sealed)
+
+    def recover(self, store: ConversationStore) -> int:
+        """启动时把日志中仍在有效期内、进行中的问诊写回会话存储（已存在的会话不覆盖），返回恢复的会话数"""
+        _, states, _ = self._replay(self._segments())
+        deadline = time.time() - store.ttl
+        restored = 0
+        for session_id, state in states.items():
+            if state["updated_at"] < deadline or store.exists(session_id):
+                continue
+            history = new_history()
+            history.extend({"role": role, "content": content} for role, content in state["messages"])
+            store.save(session_id, {"history": history})
+            restored += 1
+        self.compact()
+        return restored
+
+    def stats(self) -> dict:
+        with self._cond:
+            pending = len(self._pending)
+        return {"appended": self.appended, "fsyncs": self.fsyncs, "pending": pending,
+                "segments": len(self._segments()), "compactions": self.compactions}
+
+
+def create_consultation_journal(directory: str = JOURNAL_DIR):
+    """启用问诊日志时创建日志与归档并恢复进行中的问诊；未启用时返回 None"""
+    if not directory:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    archive = ConsultationArchive(ARCHIVE_DB_PATH or os.path.join(directory, "archive.db"))
+    journal = ConsultationJournal(directory, archive)
+    restored = journal.recover(conversation_store)
+    logging.info(f"问诊日志已启用：{directory}，恢复进行中的问诊 {restored} 个")
+    return journal
+
+
+consultation_journal = create_consultation_journal()
+
+
+def journal_event(event: str, messages: list) -> None:
+    """把本轮的对话变化写入问诊日志；未启用日志或不在会话请求中（如基准脚本直接调用）时不记录"""
+    session_id = _current_session_id.get()
+    if consultation_journal is None or session_id is None:
+        return
+    consultation_journal.append(session_id, event, [[m["role"], m["content"]] for m in messages])
+
+
+# 模型不可用时的本地兜底：按缺项给出模板追问，信息基本齐全时按模板整理简版病历
+SLOT_QUESTIONS = {
+    "主要症状": "请具体描述一下您最主要的不适：在哪个部位、是什么样的感觉、程度如何？",
+    "持续时间": "这些症状是什么时候开始的？多久发作一次？",
+    "诱因": "症状出现前有没有什么诱因？有什么情况会让它加重或缓解吗？",
+    "伴随症状": "除此之外，还有没有其他不舒服，比如发热、恶心或乏力？",
+    "既往病史": "您以前得过什么疾病吗？家里人有类似的病史吗？有没有药物过敏？",
+    "生活状况": "您平时的作息、饮食和工作情况是怎样的？",
+}
+FALLBACK_QUESTION = "还有其他不适或需要补充的情况吗？"
+
+
+def local_follow_up(history: list, missing: list) -> str:
+    """按第一个尚未问过的缺项给出模板追问"""
+    asked = {m["content"] for m in history if m["role"] == "assistant"}
+    for slot in missing:
+        if SLOT_QUESTIONS[slot] not in asked:
+            return SLOT_QUESTIONS[slot]
+    return FALLBACK_QUESTION
+
+
+def local_medical_record(history: list) -> str:
+    """不经模型、直接按患者原话整理的简版病历"""
+    patient_turns = [m["content"] for m in history[1:] if m["role"] == "user"]
+    intake = patient_turns[0] if patient_turns and "患者基本信息：" in patient_turns[0] else ""
+    statements = patient_turns[1:] if intake else patient_turns
+    departments = "、".join(item["department"] for item in recommend_departments_for_history(history))
+    lines = [
+        "# 门诊病历记录（简版）",
+        "",
+        f"**就诊时间：** {datetime.now():%Y-%m-%d %H:%M}",
+        "",
+        "> 智能问诊服务暂时繁忙，以下内容按您的原话整理，仅供分诊参考。",
+    ]
+    if intake:
+        lines += ["", "## 基本信息", intake.replace("患者基本信息：", "").strip()]
+    lines += ["", "## 患者自述"] + [f"{i}. {text}" for i, text in enumerate(statements, 1)]
+    lines += ["", "## 就诊建议", f"1. **建议科室：** {departments}", "2. **就医建议：** 请携带本记录到分诊台或挂号处"]
+    return "\n".join(lines)
+
+
+def fallback_turn(history: list, summary: dict = None) -> str:
+    """模型不可用时用本地规则完成本轮：信息齐全（或已问满轮数）时生成简版病历，否则给出模板追问"""
+    count_llm_event("fallbacks")
+    if not history or history[-1]["role"] != "user":
+        return "抱歉，系统出现错误，请重新描述您的症状。"
+    # 没有模型可问，规则认为六项都已提到、或已问满轮数时就结束问诊
+    rounds, missing = scan_slots(history)
+    if ((not missing and rounds >= LOCAL_CHECK_MIN_ROUNDS and len(history) >= RECORD_MIN_HISTORY)
+            or rounds >= LOCAL_CHECK_MAX_ROUNDS):
+        return finish_turn(history, local_medical_record(history), None, summary)
+    return finish_turn(history, None, local_follow_up(history, missing), summary)
+
+
+def refine_response(query: str, history: list, summary: dict = None) -> str:
+    try:
+        logging.info("开始处理用户输入...")
+        
+        # 如果是首次输入（包含患者基本信息）
+        if "患者基本信息：" in query:
+            return start_intake(query, history, summary)
+
+        # 危急症状在任何模型调用之前拦截
+        emergency = handle_red_flags(query, history)
+        if emergency is not None:
+            return emergency
+
+        # 原有的问诊逻辑
+        history.append({"role": "user", "content": query})
+        turn_start = start_turn()
+        # 摘要更新与本轮问诊同时进行，本轮仍使用上一轮的摘要加最近的原始对话
+        summary_future = start_summary_update(history, summary)
+        transcript = build_context(history, summary)
+        # 已有调用在排队时不再推测，避免落选的请求占用名额
+        speculate = SPECULATIVE_MODE and not llm_dispatcher.busy()
+        if speculate:
+            medical_record, next_question = run_turn_speculative(history, transcript)
+        else:
+            medical_record, next_question = run_turn_sequential(history, transcript)
+        logging.info(
+            f"本轮耗时 {observe_turn(turn_start, 'sync'):.2f}s"
+            f"（{'并行推测' if speculate else '串行'}模式，历史长度 {len(history)}）"
+        )
+        finish_summary_update(summary_future, summary)
+
+        return finish_turn(history, medical_record, next_question, summary)
+    except LLMOverloaded:
+        discard_turn(history)
+        raise
+    except LLMUnavailable as e:
+        logging.warning(f"模型服务不可用，改用本地规则: {e}")
+        return fallback_turn(history, summary)
+    except Exception as e:
+        logging.error(f"处理对话时发生错误: {e}")
+        metrics.inc("triage_turns_total", outcome="error")
+        return "抱歉，系统出现错误，请重新描述您的症状。"
+
+
+def start_turn() -> float:
+    """开始一轮问诊的统计：清零本轮的提示用量，返回起始时间"""
+    _turn_tokens.set({})
+    return time.perf_counter()
+
+
+def observe_turn(turn_start: float, mode: str) -> float:
+    """记录一轮问诊的总耗时，以及提示 token 中命中、未命中上下文缓存的部分，返回秒数"""
+    elapsed = time.perf_counter() - turn_start
+    metrics.observe("triage_turn_seconds", elapsed, mode=mode)
+    add_server_timing("turn", elapsed)
+    tokens = _turn_tokens.get()
+    if tokens:
+        cached, missed = tokens["cached"], tokens["prompt"] - tokens["cached"]
+        metrics.inc("triage_turn_prompt_tokens_total", cached, mode=mode, cache="hit")
+        metrics.inc("triage_turn_prompt_tokens_total", missed, mode=mode, cache="miss")
+        logging.info(f"本轮提示 {tokens['prompt']} tokens，命中上下文缓存 {cached}，未命中 {missed}")
+    return elapsed
+
+
+def start_intake(query: str, history: list, summary: dict = None) -> str:
+    """记录患者基本信息并返回欢迎语，重新填写基本信息视为开始新的问诊"""
+    metrics.inc("triage_turns_total", outcome="intake")
+    history[:] = new_history()
+    reset_summary(summary)
+    history.append({"role": "user", "content": query})
+    welcome_message = "感谢您提供基本信息。请详细描述您目前的主要症状和不适感。"
+    history.append({"role": "assistant", "content": welcome_message})
+    journal_event("start", history[1:])
+    return welcome_message
+
+
+def early_turn_text(history: list):
+    """首轮主诉（患者基本信息之后的第一条回答）返回其文本，用于缓存常见主诉；其余轮次返回 None"""
+    if len(history) == 4 and history[-1]["role"] == "user" and "患者基本信息：" in history[1]["content"]:
+        return history[-1]["content"]
+    return None
+
+
+def finish_turn(history: list, medical_record, next_question, summary: dict = None) -> str:
+    """把本轮结果写回对话历史；生成了病历（或已提交后台生成）则结束本次问诊"""
+    metrics.inc("triage_turns_total", outcome="follow_up" if medical_record is None else "record")
+    if isinstance(medical_record, RecordJob):
+        # 对话连同病历由后台任务写入问诊日志
+        history[:] = new_history()
+        reset_summary(summary)
+        logging.info(f"问诊完成，病历在后台生成（任务 {medical_record.job_id}）")
+        return RECORD_PENDING_MESSAGE
+    if medical_record is not None:
+        result = record_message(medical_record)
+        history.append({"role": "assistant", "content": result})
+        journal_event("record", history[1:])  # 病历连同完整对话写入日志，随后清空会话
+        history[:] = new_history()
+        reset_summary(summary)
+        logging.info("问诊完成，已生成病历记录")
+        return result
+    history.append({"role": "assistant", "content": next_question})
+    journal_event("turn", history[-2:])
+    logging.info(f"追问问题: {next_question}")
+    return next_question
+
+
+def reuse_check_question(next_question: str) -> bool:
+    """完整性检查已给出下一个问题时直接沿用，省去单独的追问调用"""
+    if not next_question:
+        return False
+    count_llm_event("follow_ups_reused")
+    logging.info("沿用完整性检查给出的追问问题，省去一次模型调用")
+    return True
+
+
+def run_turn_sequential(history: list, transcript: str) -> tuple:
+    """依次检查完整性、再生成病历或追问，返回 (病历, 追问) 二者之一"""
+    is_complete = local_verdict(history)
+    next_question = ""
+    if is_complete is None:
+        is_complete, next_question = check_satisfaction(transcript)
+    if is_complete and len(history) >= RECORD_MIN_HISTORY:  # 确保至少6轮对话（每轮包含问和答）
+        return submit_record_job(history, transcript) or generate_medical_record(transcript), None
+    if reuse_check_question(next_question):
+        return None, next_question
+    return None, generate_follow_up(transcript, early_turn_text(history))
+
+
+def run_turn_speculative(history: list, transcript: str) -> tuple:
+    """并行发起完整性检查与病历生成，以检查结论为准
+
+    追问问题由完整性检查一并给出，无需推测；检查判定未完整时丢弃推测的病历（尚未开始的会被取消）。
+    本地规则已能确定结论、或还不可能结束问诊时无需推测，按串行方式只发起需要的请求；
+    病历交给后台任务生成时本轮不等病历，改为推测追问问题，见 run_turn_speculative_follow_up。
+    """
+    if (len(history) < RECORD_MIN_HISTORY
+            or (LOCAL_CHECK_MODE and local_check_satisfaction(history)[0] is not None)):
+        return run_turn_sequential(history, transcript)
+
+    check_future = submit_with_context(llm_executor, check_satisfaction, transcript)
+    if record_jobs_enabled():
+        return run_turn_speculative_follow_up(history, transcript, check_future)
+    record_future = submit_with_context(llm_executor, generate_medical_record, transcript)
+    try:
+        is_complete, next_question = check_future.result()
+    except BaseException:
+        record_future.cancel()
+        raise
+    if is_complete:
+        return record_future.result(), None
+    if not record_future.cancel():
+        logging.info("丢弃推测生成的病历记录")
+    if reuse_check_question(next_question):
+        return None, next_question
+    return None, generate_follow_up(transcript, early_turn_text(history))
+
+
+def run_turn_speculative_follow_up(history: list, transcript: str, check_future) -> tuple:
+    """病历交给后台任务时的推测：与完整性检查同时生成追问问题
+
+    检查判定完整时取消追问并提交病历任务；未完整时优先沿用检查给出的问题，
+    检查没给出问题时直接使用推测的追问，省去一次串行往返。
+    """
+    follow_up_future = submit_with_context(llm_executor, generate_follow_up, transcript, early_turn_text(history))
+    try:
+        is_complete, next_question = check_future.result()
+    except BaseException:
+        follow_up_future.cancel()
+        raise
+    if is_complete or reuse_check_question(next_question):
+        if not follow_up_future.cancel():
+            logging.info("丢弃推测生成的追问问题")
+        if is_complete:
+            return submit_record_job(history, transcript) or generate_medical_record(transcript), None
+        return None, next_question
+    return None, follow_up_future.result()
+
+
+FOLLOW_UP_PROMPT = """你是一位专业的导诊员。请根据患者的回答进行智能追问：
+1. 仔细分析患者最新回答的内容
+2. 对每个症状点进行深入追问，直到获取足够详细的信息
+3. 发现危急症状时立即建议就医
+4. 每次只问一个最关键的问题
+5. 确保问题不重复，且逐步深入
+6. 注意可能被忽略的细节
+
+提问要求：
+- 问题要具体且一次只问一个要点
+- 问题要简短明确
+- 循序渐进，由表及里
+- 注意症状之间的关联性
+- 关注患者的生活质量影响
+- 问题不要重复，或者难以理解"""
+
+
+def build_follow_up_messages(transcript: str) -> list:
+    """构造生成追问问题的提示消息"""
+    return build_task_messages(FOLLOW_UP_PROMPT, "这是问诊记录，请根据患者最新回答生成下一个问题", transcript)
+
+
+def generate_follow_up(transcript: str, early_text: str = None) -> str:
+    """根据问诊记录生成下一个追问问题"""
+    return chat_completion(build_follow_up_messages(transcript), temperature=0.3, early_text=early_text)
+
+
+def stream_follow_up(transcript: str, early_text: str = None):
+    """流式生成追问问题，逐段产出文本"""
+    yield from stream_completion(build_follow_up_messages(transcript), temperature=0.3, early_text=early_text)
+
+
+# 病历记录：模型只输出各字段取值的 JSON，由本地预编译的模板排版成 Markdown，
+# 模型不必逐字复述整套病历格式，输出 token 与生成时间随之大幅减少
+STRUCTURED_RECORD_MODE = True  # 关闭后恢复由模型直接输出整份 Markdown 病历
+RECORD_FIELDS = {
+    "chief_complaint": "主诉：主要症状和持续时间，一句话",
+    "onset": "发病时间：首次出现时间、发作频率",
+    "characteristics": "症状特点：具体表现、发展过程、严重程度",
+    "triggers": "诱因分析：可能的诱发因素、加重或缓解因素",
+    "accompanying": "伴随症状：其他不适表现、对日常生活的影响",
+    "past_history": "疾病史",
+    "family_history": "家族史",
+    "allergies": "药物或其他过敏史",
+    "diagnosis": "初步诊断：根据症状的初步判断分析",
+    "department": "建议就诊的科室",
+    "advice": "具体的就医建议",
+    "precautions": "日常注意事项",
+}
+RECORD_MISSING = "未提及"
+
+RECORD_FIELDS_PROMPT = "请根据问诊对话整理病历记录的各项内容，只输出一个 JSON 对象，包含以下字段：\n" + "\n".join(
+    f"- {name}：{description}" for name, description in RECORD_FIELDS.items()
+) + f"\n每个字段的值为简洁的中文字符串，可包含多条要点时用“；”分隔；对话中没有提到的写“{RECORD_MISSING}”。不要输出 Markdown 或其他说明。"
+
+MARKDOWN_RECORD_PROMPT = """请根据问诊对话生成一份规范的病历记录，使用 Markdown 格式：
+# 门诊病历记录
+
+**就诊时间：** [当前时间]
+
+## 主诉
+患者主要症状和不适
+
+## 现病史
+1. **发病时间：** 
+   - 首次出现时间
+   - 发作频率
+
+2. **症状特点：**
+   - 具体表现
+   - 发展过程
+   - 严重程度
+
+3. **诱因分析：**
+   - 可能的诱发因素
+   - 加重/缓解因素
+
+4. **伴随症状：**
+   - 其他不适表现
+   - 对日常生活的影响
+
+## 既往史
+- **疾病史：** 相关病史记录
+- **家族史：** 家族相关病史
+- **过敏史：** 药物或其他过敏情况
+
+## 初步诊断
+根据症状的初步判断分析
+
+## 就诊建议
+1. **建议科室：** 推荐就诊的专科
+2. **就医建议：** 具体就医指导
+3. **注意事项：** 日常注意要点
+
+请确保格式规范，便于阅读。"""
+
+# 模板只编译一次；就诊时间在本地填写，不再由模型生成
+RECORD_TEMPLATE = jinja2.Environment(autoescape=False, keep_trailing_newline=False).from_string(
+    """# 门诊病历记录
+
+**就诊时间：** {{ visit_time }}
+
+## 主诉
+{{ chief_complaint }}
+
+## 现病史
+1. **发病时间：** {{ onset }}
+2. **症状特点：** {{ characteristics }}
+3. **诱因分析：** {{ triggers }}
+4. **伴随症状：** {{ accompanying }}
+
+## 既往史
+- **疾病史：** {{ past_history }}
+- **家族史：** {{ family_history }}
+- **过敏史：** {{ allergies }}
+
+## 初步诊断
+{{ diagnosis }}
+
+## 就诊建议
+1. **建议科室：** {{ department }}
+2. **就医建议：** {{ advice }}
+3. **注意事项：** {{ precautions }}"""
+)
+
+
+def build_medical_record_messages(transcript: str) -> list:
+    """构造生成病历记录的提示消息"""
+    prompt = RECORD_FIELDS_PROMPT if STRUCTURED_RECORD_MODE else MARKDOWN_RECORD_PROMPT
+    return build_task_messages(prompt, "请根据以下对话生成病历记录", transcript)
+
+
+def parse_record_fields(response: str) -> dict:
+    """解析模型给出的病历字段，缺失或为空的字段记为“未提及”；不是 JSON 对象时抛出 ValueError"""
+    data = loads_json(response)
+    if not isinstance(data, dict):
+        raise ValueError("病历字段不是 JSON 对象")
+    fields = {}
+    for name in RECORD_FIELDS:
+        value = data.get(name)
+        if isinstance(value, list):
+            value = "；".join(str(item).strip() for item in value if str(item).strip())
+        elif value is not None:
+            value = str(value).strip()
+        fields[name] = value or RECORD_MISSING
+    return fields
+
+
+def render_medical_record(fields: dict) -> str:
+    """按模板排版病历，并在同一遍中清理字段里夹带的 HTML 标签"""
+    return clean_medical_record(RECORD_TEMPLATE.render(visit_time=f"{datetime.now():%Y-%m-%d %H:%M}", **fields))
+
+
+def finish_medical_record(response: str) -> str:
+    """把模型的回复整理成病历：结构化模式下按字段排版，回复不是字段 JSON 时按 Markdown 原文清洗"""
+    if STRUCTURED_RECORD_MODE:
+        try:
+            return render_medical_record(parse_record_fields(response))
+        except ValueError:
+            logging.warning("病历字段格式不正确，按原文整理")
+    return clean_medical_record(response)
+
+
+# 模型偶尔输出的 HTML 标签与对应的 Markdown，一次正则扫描全部替换
+HTML_TO_MARKDOWN = {
+    "<br>": "\n", "<br/>": "\n", "<br />": "\n", "<b>": "**", "</b>": "**", "<strong>": "**", "</strong>": "**",
+    "<em>": "*", "</em>": "*", "<i>": "*", "</i>": "*",
+}
+_HTML_TAG_RE = re.compile("|".join(map(re.escape, sorted(HTML_TO_MARKDOWN, key=len, reverse=True))), re.IGNORECASE)
+
+
+def clean_medical_record(medical_record: str) -> str:
+    """替换可能的 HTML 标签为 Markdown 语法"""
+    return _HTML_TAG_RE.sub(lambda match: HTML_TO_MARKDOWN[match.group(0).lower()], medical_record)
+
+
+def generate_medical_record(transcript: str) -> str:
+    """生成规范的病历记录"""
+    try:
+        return finish_medical_record(chat_completion(
+            build_medical_record_messages(transcript), temperature=0.3, priority=PRIORITY_RECORD,
+            json_mode=STRUCTURED_RECORD_MODE,
+        ))
+    except (LLMOverloaded, LLMUnavailable):
+        raise
+    except Exception as e:
+        logging.error(f"生成病历记录时发生错误: {e}")
+        return "无法生成病历记录"
+
+
+def stream_medical_record(transcript: str):
+    """流式生成病历记录，逐段产出未清洗的文本；结构化模式下字段齐了才能排版，整份病历一次产出"""
+    if STRUCTURED_RECORD_MODE:
+        yield generate_medical_record(transcript)
+        return
+    yield from stream_completion(build_medical_record_messages(transcript), temperature=0.3, priority=PRIORITY_RECORD)
+
+
+# 后台病历任务配置：问诊信息齐全后病历交给后台线程生成，本轮立即返回“问诊结束”，页面在病历就绪时收到推送
+RECORD_JOBS_MODE = os.environ.get("RECORD_JOBS_MODE", "1") == "1"
+RECORD_JOB_WORKERS = int(os.environ.get("RECORD_JOB_WORKERS", 4))  # 同时生成病历的线程数
+RECORD_JOB_MAX_PENDING = 64  # 排队与进行中的任务达到该数目时不再入队，改为在本轮请求中直接生成
+RECORD_JOB_POLL_SECONDS = 0.25  # 等待其他进程执行的任务时查询共享存储的间隔
+RECORD_EVENTS_HOLD_SECONDS = 2  # WSGI 下推送接口最多挂起的秒数，未完成即断开、由浏览器重连，不长期占用请求线程
+RECORD_EVENTS_ASYNC_HOLD_SECONDS = 60  # ASGI 下挂起不占线程，可以等得更久
+RECORD_EVENTS_RETRY_MS = 1000  # 推送连接断开后浏览器重连的间隔
+RECORD_PENDING_MESSAGE = "【问诊结束】\n\n问诊信息已收集完毕，病历记录正在生成，请稍候……"
+
+# 本轮提交的病历任务编号，/submit 据此在响应中返回
+_record_job_id = contextvars.ContextVar("record_job_id", default=None)
+
+
+def record_message(medical_record: str) -> str:
+    """问诊结束时展示给患者的完整回复"""
+    return f"【问诊结束】\n\n{medical_record}\n\n如需继续问诊，请重新开始。"
+
+
+class RecordJob:
+    """已提交到后台的病历生成任务，作为本轮的“病历”交给 finish_turn"""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+
+
+class RecordJobQueue:
+    """后台生成病历的任务队列：有界线程池执行，任务状态写入会话存储，任意工作进程都能查询
+
+    任务状态为 {session_id, status, result, created_at, finished_at}，status 为 pending / done / failed。
+    模型繁忙或不可用时按患者原话生成简版病历，任务仍算完成。
+    """
+
+    def __init__(self, workers: int = RECORD_JOB_WORKERS, max_pending: int = RECORD_JOB_MAX_PENDING):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="record")
+        self._cond = threading.Condition()
+        self.pending = 0
+        self.completed = 0
+
+    def submit(self, session_id: str, transcript: str, history: list):
+        """提交任务并返回 RecordJob；排队已满时返回 None，由调用方在请求中直接生成"""
+        with self._cond:
+            if self.pending >= self.max_pending:
+                logging.warning("后台病历任务已满，本轮直接生成病历")
+                return None
+            self.pending += 1
+        job_id = uuid.uuid4().hex
+        conversation_store.save_job(job_id, {
+            "session_id": session_id, "status": "pending", "result": "", "created_at": time.time(), "finished_at": None,
+        })
+        self._executor.submit(self._run, job_id, session_id, transcript, list(history), time.perf_counter())
+        return RecordJob(job_id)
+
+    def _run(self, job_id: str, session_id: str, transcript: str, history: list, submitted: float) -> None:
+        state = {"session_id": session_id, "status": "failed", "result": "抱歉，病历生成失败，请重新问诊。",
+                 "created_at": time.time() - (time.perf_counter() - submitted), "finished_at": None}
+        outcome = "failed"
+        try:
+            try:
+                medical_record = generate_medical_record(transcript)
+                outcome = "ok"
+            except (LLMOverloaded, LLMUnavailable) as e:
+                logging.warning(f"后台生成病历时模型不可用，改用本地规则: {e}")
+                count_llm_event("fallbacks")
+                medical_record = local_medical_record(history)
+                outcome = "fallback"
+            state.update(status="done", result=record_message(medical_record))
+            if consultation_journal is not None:
+                messages = [[m["role"], m["content"]] for m in history[1:]] + [["assistant", state["result"]]]
+                consultation_journal.append(session_id, "record", messages)
+        except Exception as e:
+            logging.error(f"后台病历任务 {job_id} 失败: {e}")
+        finally:
+            state["finished_at"] = time.time()
+            elapsed = time.perf_counter() - submitted
+            try:
+                conversation_store.save_job(job_id, state)
+            except Exception as e:
+                logging.error(f"保存病历任务 {job_id} 的状态失败: {e}")
+            metrics.observe("triage_record_job_seconds", elapsed, outcome=outcome)
+            logging.info(f"后台病历任务 {job_id} 完成（{outcome}），耗时 {elapsed:.2f}s")
+            with self._cond:
+                self.pending -= 1
+                self.completed += 1
+                self._cond.notify_all()
+
+    def get(self, job_id: str, session_id: str):
+        """读取任务状态；任务不存在或不属于该会话时返回 None"""
+        state = conversation_store.load_job(job_id)
+        if state is None or state["session_id"] != session_id:
+            return None
+        return state
+
+    def wait(self, job_id: str, session_id: str, timeout: float):
+        """等待任务结束或超时，返回最新状态；本进程的任务完成时立即唤醒，其他进程的任务按间隔查询"""
+        deadline = time.monotonic() + timeout
+        while True:
+            state = self.get(job_id, session_id)
+            remaining = deadline - time.monotonic()
+            if state is None or state["status"] != "pending" or remaining <= 0:
+                return state
+            with self._cond:
+                self._cond.wait(min(remaining, RECORD_JOB_POLL_SECONDS))
+
+    async def await_job(self, job_id: str, session_id: str, timeout: float):
+        """wait 的异步版本，等待期间不占用事件循环"""
+        deadline = time.monotonic() + timeout
+        while True:
+            state = self.get(job_id, session_id)
+            remaining = deadline - time.monotonic()
+            if state is None or state["status"] != "pending" or remaining <= 0:
+                return state
+            await asyncio.sleep(min(remaining, RECORD_JOB_POLL_SECONDS))
+
+
+record_jobs = RecordJobQueue()
+
+
+def record_jobs_enabled() -> bool:
+    """只在会话请求中使用后台任务；基准脚本等直接调用时仍在本轮生成病历"""
+    return RECORD_JOBS_MODE and _current_session_id.get() is not None
+
+
+def submit_record_job(history: list, transcript: str):
+    """把病历生成提交到后台，返回 RecordJob；未启用或排队已满时返回 None"""
+    if not record_jobs_enabled():
+        return None
+    job = record_jobs.submit(_current_session_id.get(), transcript, history)
+    if job is not None:
+        _record_job_id.set(job.job_id)
+    return job
+
+
+def record_job_event(state: dict) -> str:
+    return f"event: done\ndata: {json.dumps({'text': state['result']}, ensure_ascii=False)}\n\n"
+
+
+def stream_completion(messages: list, temperature: float, early_text: str = None, priority: int = PRIORITY_FOLLOW_UP):
+    """以 stream=True 调用模型，逐段产出增量文本；命中缓存时一次性产出，完整输出后写入缓存
+
+    调用名额一直占用到流读完或被关闭为止。收到首个分段之前的失败按退避重试，
+    之后的中断不能重试（已有内容输出），直接抛出 LLMUnavailable。
+    """
+    route = PRIORITY_NAMES[priority]
+    model, max_tokens = route_model(route, messages)
+    key = _cache_key(model, temperature, messages, early_text)
+    cached = lookup_cache(route, key)
+    if cached is not None:
+        yield cached
+        return
+
+    def request(timeout: float):
+        stream = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+            timeout=timeout,
+        )
+        chunks = iter(stream)
+        try:
+            return stream, chunks, next_stream_text(chunks, usage)
+        except BaseException:
+            stream.close()
+            raise
+
+    parts = []
+    usage = []
+    with llm_dispatcher.slot(priority):
+        started = time.monotonic()
+        stream, chunks, text = call_with_retries(request, route + "_stream")
+        try:
+            while text is not None:
+                parts.append(text)
+                yield text
+                text = next_stream_text(chunks, usage)
+        except RETRYABLE_ERRORS as e:
+            llm_breaker.failure()
+            raise LLMUnavailable(f"流式输出中断: {e!r}") from e
+        finally:
+            stream.close()
+    content = "".join(parts)
+    prompt_tokens, cached_tokens, completion_tokens = usage_tokens(usage[-1] if usage else None, messages, content)
+    observe_llm_call(route, model, time.monotonic() - started, prompt_tokens, completion_tokens, stream=True,
+                     cached_tokens=cached_tokens)
+    completion_cache.put(key, content)
+
+
+def stream_chunk_usage(chunk):
+    """流式分段附带的用量：OpenAI 格式在分段顶层，Moonshot 放在最后一段的 choices[0] 中；没有时返回 None"""
+    if chunk.usage:
+        return chunk.usage
+    return getattr(chunk.choices[0], "usage", None) if chunk.choices else None
+
+
+def next_stream_text(chunks, usage: list):
+    """读到下一段非空的增量文本，流结束时返回 None；分段附带的用量追加到 usage（流式响应不一定带用量）"""
+    for chunk in chunks:
+        chunk_usage = stream_chunk_usage(chunk)
+        if chunk_usage:
+            usage.append(chunk_usage)
+        if chunk.choices and chunk.choices[0].delta.content:
+            return chunk.choices[0].delta.content
+    return None
+
+
+def refine_response_stream(query: str, history: list, summary: dict = None):
+    """refine_response 的流式版本
+
+    逐段产出 ("delta", 文本)，最后产出 ("done", 完整回复)；完整回复以清洗后的文本为准。
+    病历交给后台任务生成时不推送病历内容，在 done 之前产出 ("record_job", 任务编号)。
+    """
+    try:
+        logging.info("开始处理用户输入（流式）...")
+
+        if "患者基本信息：" in query:
+            yield "done", start_intake(query, history, summary)
+            return
+        emergency = handle_red_flags(query, history)
+        if emergency is not None:
+            yield "done", emergency
+            return
+
+        history.append({"role": "user", "content": query})
+        turn_start = start_turn()
+        summary_future = start_summary_update(history, summary)
+        transcript = build_context(history, summary)
+        is_complete = local_verdict(history)
+        next_question = ""
+        if is_complete is None:
+            is_complete, next_question = check_satisfaction(transcript)
+        parts = []
+        job = submit_record_job(history, transcript) if is_complete and len(history) >= RECORD_MIN_HISTORY else None
+        if job is not None:
+            finish_summary_update(summary_future, summary)
+            result = finish_turn(history, job, None, summary)
+            yield "record_job", job.job_id
+        elif is_complete and len(history) >= RECORD_MIN_HISTORY:
+            yield "delta", "【问诊结束】\n\n"
+            for text in stream_medical_record(transcript):
+                parts.append(text)
+                yield "delta", text
+            finish_summary_update(summary_future, summary)
+            result = finish_turn(history, clean_medical_record("".join(parts)), None, summary)
+        else:
+            # 完整性检查给出的问题很短，整段推送；否则流式生成追问
+            if reuse_check_question(next_question):
+                chunks = [next_question]
+            else:
+                chunks = stream_follow_up(transcript, early_turn_text(history))
+            for text in chunks:
+                if not parts:
+                    first_delta = time.perf_counter() - turn_start
+                    metrics.observe("triage_turn_first_delta_seconds", first_delta, mode="stream")
+                    logging.info(f"首个分段耗时 {first_delta:.2f}s")
+                parts.append(text)
+                yield "delta", text
+            finish_summary_update(summary_future, summary)
+            result = finish_turn(history, None, "".join(parts), summary)
+
+        logging.info(f"本轮耗时 {observe_turn(turn_start, 'stream'):.2f}s（流式输出）")
+        yield "done", result
+    except LLMOverloaded as e:
+        # 响应已经开始，无法再返回 503，改为在回复中提示稍后重发
+        logging.warning(f"流式处理对话时模型繁忙: {e}")
+        discard_turn(history)
+        yield "done", BUSY_MESSAGE.format(retry_after=e.retry_after)
+    except LLMUnavailable as e:
+        # 已推送的部分内容由 done 中的兜底回复整体替换
+        logging.warning(f"模型服务不可用，改用本地规则: {e}")
+        yield "done", fallback_turn(history, summary)
+    except Exception as e:
+        logging.error(f"流式处理对话时发生错误: {e}")
+        metrics.inc("triage_turns_total", outcome="error")
+        yield "done", "抱歉，系统出现错误，请重新描述您的症状。"
+
+
+# ---------------- 异步版本（ASGI 服务模式使用） ----------------
+
+async def acheck_satisfaction(history: str) -> tuple[bool, str]:
+    """check_satisfaction 的异步版本"""
+    try:
+        is_complete, missing, next_question = parse_check_response(
+            await achat_completion(build_check_messages(history), temperature=0.1, priority=PRIORITY_CHECK, json_mode=True)
+        )
+    except (LLMOverloaded, LLMUnavailable):
+        raise
+    except Exception as e:
+        logging.error(f"检查问诊完整性时发生错误: {e}")
+        return False, ""
+    log_check_result(is_complete, missing)
+    return is_complete, next_question
+
+
+async def agenerate_follow_up(transcript: str, early_text: str = None) -> str:
+    """generate_follow_up 的异步版本"""
+    return await achat_completion(build_follow_up_messages(transcript), temperature=0.3, early_text=early_text)
+
+
+async def agenerate_medical_record(transcript: str) -> str:
+    """generate_medical_record 的异步版本"""
+    try:
+        return finish_medical_record(await achat_completion(
+            build_medical_record_messages(transcript), temperature=0.3, priority=PRIORITY_RECORD,
+            json_mode=STRUCTURED_RECORD_MODE,
+        ))
+    except (LLMOverloaded, LLMUnavailable):
+        raise
+    except Exception as e:
+        logging.error(f"生成病历记录时发生错误: {e}")
+        return "无法生成病历记录"
+
+
+async def astream_medical_record(transcript: str):
+    """stream_medical_record 的异步版本"""
+    if STRUCTURED_RECORD_MODE:
+        yield await agenerate_medical_record(transcript)
+        return
+    async for text in astream_completion(build_medical_record_messages(transcript), temperature=0.3,
+                                         priority=PRIORITY_RECORD):
+        yield text
+
+
+async def astream_completion(messages: list, temperature: float, early_text: str = None,
+                             priority: int = PRIORITY_FOLLOW_UP):
+    """stream_completion 的异步版本"""
+    route = PRIORITY_NAMES[priority]
+    model, max_tokens = route_model(route, messages)
+    key = _cache_key(model, temperature, messages, early_text)
+    cached = lookup_cache(route, key)
+    if cached is not None:
+        yield cached
+        return
+
+    async def request(timeout: float):
+        stream = await async_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+            timeout=timeout,
+        )
+        chunks = stream.__aiter__()
+        try:
+            return stream, chunks, await anext_stream_text(chunks, usage)
+        except BaseException:
+            await stream.close()
+            raise
+
+    parts = []
+    usage = []
+    async with llm_dispatcher.aslot(priority):
+        started = time.monotonic()
+        stream, chunks, text = await acall_with_retries(request, route + "_stream")
+        try:
+            while text is not None:
+                parts.append(text)
+                yield text
+                text = await anext_stream_text(chunks, usage)
+        except RETRYABLE_ERRORS as e:
+            llm_breaker.failure()
+            raise LLMUnavailable(f"流式输出中断: {e!r}") from e
+        finally:
+            await stream.close()
+    content = "".join(parts)
+    prompt_tokens, cached_tokens, completion_tokens = usage_tokens(usage[-1] if usage else None, messages, content)
+    observe_llm_call(route, model, time.monotonic() - started, prompt_tokens, completion_tokens, stream=True,
+                     cached_tokens=cached_tokens)
+    completion_cache.put(key, content)
+
+
+async def anext_stream_text(chunks, usage: list):
+    """next_stream_text 的异步版本"""
+    async for chunk in chunks:
+        chunk_usage = stream_chunk_usage(chunk)
+        if chunk_usage:
+            usage.append(chunk_usage)
+        if chunk.choices and chunk.choices[0].delta.content:
+            return chunk.choices[0].delta.content
+    return None
+
+
+async def arun_turn(history: list, transcript: str) -> tuple:
+    """run_turn_sequential / run_turn_speculative 的异步版本
+
+    推测模式下落选的一路直接取消，对应的 HTTP 请求也会随之中断。
+    """
+    record_possible = len(history) >= RECORD_MIN_HISTORY
+    is_complete = local_verdict(history)
+    next_question = ""
+    speculate = SPECULATIVE_MODE and record_possible and is_complete is None
+    if not speculate or llm_dispatcher.busy():
+        if is_complete is None:
+            is_complete, next_question = await acheck_satisfaction(transcript)
+        if is_complete and record_possible:
+            return submit_record_job(history, transcript) or await agenerate_medical_record(transcript), None
+    elif record_jobs_enabled():
+        # 病历交给后台任务，本轮改为推测追问问题，见 run_turn_speculative_follow_up
+        check_task = asyncio.create_task(acheck_satisfaction(transcript))
+        follow_up_task = asyncio.create_task(agenerate_follow_up(transcript, early_turn_text(history)))
+        try:
+            is_complete, next_question = await check_task
+        except BaseException:
+            follow_up_task.cancel()
+            raise
+        if is_complete or reuse_check_question(next_question):
+            follow_up_task.cancel()
+            if is_complete:
+                return submit_record_job(history, transcript) or await agenerate_medical_record(transcript), None
+            return None, next_question
+        return None, await follow_up_task
+    else:
+        check_task = asyncio.create_task(acheck_satisfaction(transcript))
+        record_task = asyncio.create_task(agenerate_medical_record(transcript))
+        try:
+            is_complete, next_question = await check_task
+        except BaseException:
+            record_task.cancel()
+            raise
+        if is_complete:
+            return await record_task, None
+        record_task.cancel()
+
+    if reuse_check_question(next_question):
+        return None, next_question
+    return None, await agenerate_follow_up(transcript, early_turn_text(history))
+
+
+async def arefine_response(query: str, history: list, summary: dict = None) -> str:
+    """refine_response 的异步版本"""
+    summary_task = None
+    try:
+        logging.info("开始处理用户输入...")
+        if "患者基本信息：" in query:
+            return start_intake(query, history, summary)
+        emergency = handle_red_flags(query, history)
+        if emergency is not None:
+            return emergency
+
+        history.append({"role": "user", "content": query})
+        turn_start = start_turn()
+        summary_task = astart_summary_update(history, summary)
+        transcript = build_context(history, summary)
+        medical_record, next_question = await arun_turn(history, transcript)
+        logging.info(
+            f"本轮耗时 {observe_turn(turn_start, 'async'):.2f}s"
+            f"（异步{'并行推测' if SPECULATIVE_MODE else '串行'}模式，历史长度 {len(history)}）"
+        )
+        await afinish_summary_update(summary_task, summary)
+        return finish_turn(history, medical_record, next_question, summary)
+    except LLMOverloaded:
+        discard_turn(history)
+        raise
+    except LLMUnavailable as e:
+        logging.warning(f"模型服务不可用，改用本地规则: {e}")
+        return fallback_turn(history, summary)
+    except Exception as e:
+        logging.error(f"处理对话时发生错误: {e}")
+        metrics.inc("triage_turns_total", outcome="error")
+        return "抱歉，系统出现错误，请重新描述您的症状。"
+    finally:
+        adiscard_summary_update(summary_task)
+
+
+async def arefine_response_stream(query: str, history: list, summary: dict = None):
+    """refine_response_stream 的异步版本"""
+    summary_task = None
+    try:
+        logging.info("开始处理用户输入（流式）...")
+        if "患者基本信息：" in query:
+            yield "done", start_intake(query, history, summary)
+            return
+        emergency = handle_red_flags(query, history)
+        if emergency is not None:
+            yield "done", emergency
+            return
+
+        history.append({"role": "user", "content": query})
+        turn_start = start_turn()
+        summary_task = astart_summary_update(history, summary)
+        transcript = build_context(history, summary)
+        is_complete = local_verdict(history)
+        next_question = ""
+        if is_complete is None:
+            is_complete, next_question = await acheck_satisfaction(transcript)
+        parts = []
+        job = submit_record_job(history, transcript) if is_complete and len(history) >= RECORD_MIN_HISTORY else None
+        if job is not None:
+            await afinish_summary_update(summary_task, summary)
+            result = finish_turn(history, job, None, summary)
+            yield "record_job", job.job_id
+        elif is_complete and len(history) >= RECORD_MIN_HISTORY:
+            yield "delta", "【问诊结束】\n\n"
+            async for text in astream_medical_record(transcript):
+                parts.append(text)
+                yield "delta", text
+            await afinish_summary_update(summary_task, summary)
+            result = finish_turn(history, clean_medical_record("".join(parts)), None, summary)
+        elif reuse_check_question(next_question):
+            parts.append(next_question)
+            yield "delta", next_question
+            await afinish_summary_update(summary_task, summary)
+            result = finish_turn(history, None, next_question, summary)
+        else:
+            follow_up_stream = astream_completion(
+                build_follow_up_messages(transcript), temperature=0.3, early_text=early_turn_text(history)
+            )
+            async for text in follow_up_stream:
+                if not parts:
+                    metrics.observe("triage_turn_first_delta_seconds", time.perf_counter() - turn_start, mode="async_stream")
+                parts.append(text)
+                yield "delta", text
+            await afinish_summary_update(summary_task, summary)
+            result = finish_turn(history, None, "".join(parts), summary)
+
+        logging.info(f"本轮耗时 {observe_turn(turn_start, 'async_stream'):.2f}s（异步流式输出）")
+        yield "done", result
+    except LLMOverloaded as e:
+        logging.warning(f"流式处理对话时模型繁忙: {e}")
+        discard_turn(history)
+        yield "done", BUSY_MESSAGE.format(retry_after=e.retry_after)
+    except LLMUnavailable as e:
+        # 已推送的部分内容由 done 中的兜底回复整体替换
+        logging.warning(f"模型服务不可用，改用本地规则: {e}")
+        yield "done", fallback_turn(history, summary)
+    except Exception as e:
+        logging.error(f"流式处理对话时发生错误: {e}")
+        metrics.inc("triage_turns_total", outcome="error")
+        yield "done", "抱歉，系统出现错误，请重新描述您的症状。"
+    finally:
+        adiscard_summary_update(summary_task)
+
+
+async def aupdate_summary(history: list, summary: dict) -> dict:
+    """update_summary 的异步版本"""
+    start, end = summary_fold_range(history, summary)
+    response = await achat_completion(
+        build_summary_messages(summary, history[start:end]), temperature=0.1, priority=PRIORITY_SUMMARY
+    )
+    return parse_summary_response(response, summary, end)
+
+
+def astart_summary_update(history: list, summary: dict):
+    """start_summary_update 的异步版本，返回 asyncio 任务或 None"""
+    if summary is None or summary_fold_range(history, summary) is None:
+        return None
+    return asyncio.create_task(aupdate_summary(list(history), dict(summary)))
+
+
+async def afinish_summary_update(task, summary: dict) -> None:
+    """finish_summary_update 的异步版本"""
+    if task is None:
+        return
+    try:
+        summary.update(await task)
+    except Exception as e:
+        logging.error(f"更新问诊摘要时发生错误: {e}")
+
+
+def adiscard_summary_update(task) -> None:
+    """本轮出错或中途结束时取消尚未完成的摘要更新；已结束的取走其结果，避免任务泄漏与 "never retrieved" 警告"""
+    if task is None:
+        return
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled():
+        task.exception()
+
+
+# 语音识别配置
+ASR_BACKEND = os.environ.get("ASR_BACKEND", "google")  # "google" 为在线识别，"vosk" 为本地离线识别
+VOSK_MODEL_PATH = os.environ.get("VOSK_MODEL_PATH", "models/vosk-model-small-cn-0.22")  # 离线中文模型目录
+ASR_SAMPLE_RATE = 16000
+ASR_WORKERS = 2  # 语音解码线程数，限制 CPU 占用，也不占用请求线程
+ASR_TIMEOUT_SECONDS = 30
+
+
+class ASRBackend:
+    """语音识别后端接口：输入 16 kHz 单声道 16 位 PCM，返回识别文本
+
+    识别不出内容时抛出 sr.UnknownValueError，引擎或服务出错时抛出 sr.RequestError。
+    实现需可被多个语音线程同时调用。
+    """
+
+    name = "base"
+
+    def transcribe(self, pcm: bytes, sample_rate: int = ASR_SAMPLE_RATE) -> str:
+        raise NotImplementedError
+
+    def create_stream(self, sample_rate: int = ASR_SAMPLE_RATE) -> "ASRStream":
+        """创建增量识别会话；不支持增量识别的后端在结束时整段识别"""
+        return ASRStream(self, sample_rate)
+
+
+class ASRStream:
+    """增量识别会话：边说边送入 PCM 分块，随时给出中间结果，结束时给出最终文本
+
+    默认实现只缓存音频，没有中间结果，结束时调用后端整段识别。
+    同一会话的调用需串行进行，不同会话之间互不影响。
+    """
+
+    def __init__(self, backend: ASRBackend, sample_rate: int = ASR_SAMPLE_RATE):
+        self.backend = backend
+        self.sample_rate = sample_rate
+        self._chunks = []
+
+    def accept(self, pcm: bytes) -> str:
+        """送入一块 PCM，返回目前为止的中间识别结果"""
+        self._chunks.append(pcm)
+        return ""
+
+    def finish(self) -> str:
+        """结束会话并返回最终文本，异常与 ASRBackend.transcribe 相同"""
+        return self.backend.transcribe(b"".join(self._chunks), self.sample_rate)
+
+
+class GoogleASRBackend(ASRBackend):
+    """Google 在线识别（原有实现），每次识别需要一次远程请求"""
 
-# 初始化 OpenAI 客户端
-client = OpenAI(
-    base_url="https://api.moonshot.cn/v1",  # 确保这是正确的 API 地址
-    api_key="填写moonshotkey"  # 确保这是有效的 API 密钥
-)
+    name = "google"
 
-# 系统消息内容
-SYSTEM_MESSAGE = """
-你是一位专业的导诊员，由 Moonshot AI 提供支持。请通过多轮对话的方式，逐步了解患者的症状和情况。
+    def transcribe(self, pcm: bytes, sample_rate: int = ASR_SAMPLE_RATE) -> str:
+        recognizer = sr.Recognizer()
+        audio = sr.AudioData(pcm, sample_rate=sample_rate, sample_width=2)
+        return recognizer.recognize_google(audio, language="zh-CN")
 
-Role: 专业导诊员
-Background: 用户可能对自身病情描述不够清晰，需要通过引导性的提问来获取更多信息。
-Skills: 
-1. 善于倾听和提问，通过追问获取关键信息
-2. 能够根据用户的回答动态调整提问方向
-3. 具备专业的医学知识，能准确理解症状描述
 
-Workflow:
-1. 首先让患者描述主要症状
-2. 根据症状进行有针对性的追问：
-   - 症状持续时间
-   - 是否有诱因
-   - 是否伴随其他不适
-   - 是否有既往病史
-3. 获取足够信息后，推荐最合适的就诊科室
+class VoskASRBackend(ASRBackend):
+    """基于 Vosk 的本地离线识别，模型在启动时加载一次并由所有语音线程共享"""
 
-注意事项：
-- 每次对话要有重点，避免一次性问太多问题
-- 提问要通俗易懂，避免专业术语
-- 如发现危急症状，及时建议就医
-"""
+    name = "vosk"
 
-# 初始化对话历史
-history = [{"role": "system", "content": SYSTEM_MESSAGE}]
+    def __init__(self, model_path: str = VOSK_MODEL_PATH):
+        import vosk  # 可选依赖，只有选用离线识别时才需要安装
 
+        vosk.SetLogLevel(-1)
+        self._vosk = vosk
+        self.model = vosk.Model(model_path)
 
+    def transcribe(self, pcm: bytes, sample_rate: int = ASR_SAMPLE_RATE) -> str:
+        # 识别器持有解码状态，每次识别单独创建；模型本身只读，可以共享
+        recognizer = self._vosk.KaldiRecognizer(self.model, sample_rate)
+        recognizer.AcceptWaveform(pcm)
+        # 中文模型的输出以空格分词，拼接回连续文本
+        text = json.loads(recognizer.FinalResult()).get("text", "").replace(" ", "")
+        if not text:
+            raise sr.UnknownValueError()
+        return text
 
+    def create_stream(self, sample_rate: int = ASR_SAMPLE_RATE) -> "ASRStream":
+        return VoskASRStream(self, sample_rate)
 
 
-def check_satisfaction(history: str) -> tuple[bool, str]:
-    """判断问诊是否完整并返回缺失信息"""
-    try:
-        messages = [
-            {"role": "system", "content": """你是一位专业的导诊员。请严格检查问诊信息的完整性，必须确保完成至少6轮有效对话。
-                必须包含以下所有信息，每个信息点需要详细追问：
-                1. 主要症状：
-                   - 具体症状描述
-                   - 症状的具体部位
-                   - 症状的性质（如疼痛类型、程度等）
-                
-                2. 症状持续时间：
-                   - 首次出现时间
-                   - 发作频率
-                   - 是否规律发作
-                
-                3. 症状诱因：
-                   - 可能的诱发因素
-                   - 加重或缓解因素
-                   - 是否与特定行为相关
-                
-                4. 伴随症状：
-                   - 其他不适感
-                   - 生活作息影响
-                   - 情绪变化
-                
-                5. 既往病史：
-                   - 相关疾病史
-                   - 家族病史
-                   - 过敏史
-                
-                6. 基本生活状况：
-                   - 作息规律
-                   - 饮食习惯
-                   - 工作环境
-                
-                请按以下格式回复：
-                - 如果所有信息完整且【不超过10轮对话】：True|已收集完整信息
-                - 如果信息不完整或对话不足6轮：False|下一个需要追问的具体问题"""},
-            {"role": "user", "content": f"请分析以下问诊对话：\n{history}"}
-        ]
-        completion = client.chat.completions.create(
-            model="moonshot-v1-8k",
-            messages=messages,
-            temperature=0.1,
-        )
-        response = completion.choices[0].message.content.strip()
-        is_complete, message = response.split('|', 1)
-        return is_complete.lower() == 'true', message.strip()
-    except Exception as e:
-        logging.error(f"检查问诊完整性时发生错误: {e}")
-        return False, "请详细描述您的主要症状"
+class VoskASRStream(ASRStream):
+    """Vosk 的增量识别：每块音频送入后即可取得中间结果"""
 
-def refine_response(query: str, history: list) -> str:
-    try:
-        logging.info("开始处理用户输入...")
-        
-        # 如果是首次输入（包含患者基本信息）
-        if "患者基本信息：" in query:
-            history.append({"role": "user", "content": query})
-            welcome_message = "感谢您提供基本信息。请详细描述您目前的主要症状和不适感。"
-            history.append({"role": "assistant", "content": welcome_message})
-            return welcome_message
-            
-        # 原有的问诊逻辑
-        history.append({"role": "user", "content": query})
-        is_complete, message = check_satisfaction(str(history))
-        
-        if is_complete and len(history) >= 10:  # 确保至少6轮对话（每轮包含问和答）
-            medical_record = generate_medical_record(history)
-            result = f"【问诊结束】\n\n{medical_record}\n\n如需继续问诊，请重新开始。"
-            history.append({"role": "assistant", "content": result})
-            history.clear()
-            history.append({"role": "system", "content": SYSTEM_MESSAGE})
-            logging.info("问诊完成，已生成病历记录")
-        else:
-            messages = [
-                {"role": "system", "content": """你是一位专业的导诊员。请根据患者的回答进行智能追问：
-                1. 仔细分析患者最新回答的内容
-                2. 对每个症状点进行深入追问，直到获取足够详细的信息
-                3. 发现危急症状时立即建议就医
-                4. 每次只问一个最关键的问题
-                5. 确保问题不重复，且逐步深入
-                6. 注意可能被忽略的细节
-                
-                提问要求：
-                - 问题要具体且一次只问一个要点
-                - 问题要简短明确
-                - 循序渐进，由表及里
-                - 注意症状之间的关联性
-                - 关注患者的生活质量影响
-                - 问题不要重复，或者难以理解
-                """},
-                {"role": "user", "content": f"这是问诊记录，请根据患者最新回答生成下一个问题：\n{str(history)}"}
-            ]
-            
-            completion = client.chat.completions.create(
-                model="moonshot-v1-8k",
-                messages=messages,
-                temperature=0.3,
-            )
-            
-            next_question = completion.choices[0].message.content
-            history.append({"role": "assistant", "content": next_question})
-            logging.info(f"追问问题: {next_question}")
-            result = next_question
-        
-        return result
-    except Exception as e:
-        logging.error(f"处理对话时发生错误: {e}")
-        return "抱歉，系统出现错误，请重新描述您的症状。"
+    def __init__(self, backend: VoskASRBackend, sample_rate: int = ASR_SAMPLE_RATE):
+        super().__init__(backend, sample_rate)
+        self._recognizer = backend._vosk.KaldiRecognizer(backend.model, sample_rate)
+        self._segments = []  # 识别器已经确定的分句
 
+    def accept(self, pcm: bytes) -> str:
+        if self._recognizer.AcceptWaveform(pcm):
+            self._segments.append(json.loads(self._recognizer.Result()).get("text", "").replace(" ", ""))
+            return "".join(self._segments)
+        partial = json.loads(self._recognizer.PartialResult()).get("partial", "").replace(" ", "")
+        return "".join(self._segments) + partial
 
-def generate_medical_record(history: list) -> str:
-    """生成规范的病历记录"""
-    try:
-        messages = [
-            {"role": "system", "content": """请根据问诊对话生成一份规范的病历记录，使用 Markdown 格式：
-# 门诊病历记录
+    def finish(self) -> str:
+        self._segments.append(json.loads(self._recognizer.FinalResult()).get("text", "").replace(" ", ""))
+        text = "".join(self._segments)
+        if not text:
+            raise sr.UnknownValueError()
+        return text
 
-**就诊时间：** [当前时间]
 
-## 主诉
-患者主要症状和不适
+def create_asr_backend(backend: str = ASR_BACKEND) -> ASRBackend:
+    """根据配置创建语音识别后端；离线模型不可用时退回在线识别"""
+    if backend == "vosk":
+        try:
+            asr = VoskASRBackend(VOSK_MODEL_PATH)
+            logging.info(f"已加载离线语音模型: {VOSK_MODEL_PATH}")
+            return asr
+        except Exception as e:
+            logging.error(f"加载离线语音模型失败，改用在线识别: {e}")
+            return GoogleASRBackend()
+    if backend == "google":
+        return GoogleASRBackend()
+    raise ValueError(f"未知的语音识别后端: {backend}")
 
-## 现病史
-1. **发病时间：** 
-   - 首次出现时间
-   - 发作频率
 
-2. **症状特点：**
-   - 具体表现
-   - 发展过程
-   - 严重程度
+asr_backend = create_asr_backend()
+asr_executor = ThreadPoolExecutor(max_workers=ASR_WORKERS, thread_name_prefix="asr")
 
-3. **诱因分析：**
-   - 可能的诱发因素
-   - 加重/缓解因素
+# 音频解码配置
+MAX_AUDIO_UPLOAD_BYTES = 10 * 1024 * 1024  # 超过该大小的上传在读取请求体之前即被拒绝
+MAX_AUDIO_SECONDS = 60  # 解码后超过该时长的录音不做识别
+SILENCE_FRAME_MS = 20  # 静音检测的帧长
+SILENCE_THRESHOLD_DB = -40  # 能量比最响的帧低这么多分贝即视为静音
+SILENCE_PADDING_MS = 200  # 裁剪首尾静音时保留的余量
 
-4. **伴随症状：**
-   - 其他不适表现
-   - 对日常生活的影响
 
-## 既往史
-- **疾病史：** 相关病史记录
-- **家族史：** 家族相关病史
-- **过敏史：** 药物或其他过敏情况
+class AudioDecodeError(ValueError):
+    """上传的音频无法解码或不符合要求"""
 
-## 初步诊断
-根据症状的初步判断分析
 
-## 就诊建议
-1. **建议科室：** 推荐就诊的专科
-2. **就医建议：** 具体就医指导
-3. **注意事项：** 日常注意要点
+def sniff_audio_container(data: bytes) -> str:
+    """根据文件头判断音频容器格式，无法识别时返回 "pcm"（按原始 16 kHz PCM 处理）"""
+    if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+        return "wav"
+    if data[:4] == b"\x1a\x45\xdf\xa3":
+        return "webm"
+    if data[:4] == b"OggS":
+        return "ogg"
+    if data[:4] == b"fLaC":
+        return "flac"
+    if data[4:8] == b"ftyp":
+        return "mp4"
+    if data[:3] == b"ID3" or data[:2] in (b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"):
+        return "mp3"
+    return "pcm"
 
-请确保格式规范，便于阅读。"""},
-            {"role": "user", "content": f"请根据以下对话生成病历记录：\n{str(history)}"}
-        ]
-        completion = client.chat.completions.create(
-            model="moonshot-v1-8k",
-            messages=messages,
-            temperature=0.3,
-        )
-        
-        # 替换可能的 HTML 标签为 Markdown 语法
-        medical_record = completion.choices[0].message.content
-        medical_record = medical_record.replace('<br>', '\n')
-        medical_record = medical_record.replace('<b>', '**').replace('</b>', '**')
-        medical_record = medical_record.replace('<strong>', '**').replace('</strong>', '**')
-        medical_record = medical_record.replace('<em>', '*').replace('</em>', '*')
-        
-        return medical_record
-    except Exception as e:
-        logging.error(f"生成病历记录时发生错误: {e}")
-        return "无法生成病历记录"
 
+def _decode_wav(data: bytes) -> tuple:
+    """用标准库 wave 解析 WAV，返回 (单声道 float32 采样, 采样率)"""
+    try:
+        with wave.open(io.BytesIO(data), "rb") as f:
+            channels, width, rate = f.getnchannels(), f.getsampwidth(), f.getframerate()
+            frames = f.readframes(f.getnframes())
+    except (wave.Error, EOFError) as e:
+        raise AudioDecodeError(f"WAV 格式错误: {e}")
+    if width == 1:
+        samples = (np.frombuffer(frames, np.uint8).astype(np.float32) - 128) / 128
+    elif width == 2:
+        samples = np.frombuffer(frames, "<i2").astype(np.float32) / 32768
+    elif width == 3:
+        raw = np.frombuffer(frames, np.uint8).reshape(-1, 3).astype(np.int32)
+        packed = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        samples = np.where(packed & 0x800000, packed - 0x1000000, packed).astype(np.float32) / 8388608
+    elif width == 4:
+        samples = np.frombuffer(frames, "<i4").astype(np.float32) / 2147483648
+    else:
+        raise AudioDecodeError(f"不支持的采样位宽: {width * 8} 位")
+    if channels > 1:
+        samples = samples[: len(samples) // channels * channels].reshape(-1, channels).mean(axis=1)
+    return samples, rate
 
-# 语音识别函数
-def recognize_speech_from_audio(audio_data) -> str:
-    """从音频数据识别语音并返回文本"""
-    recognizer = sr.Recognizer()
-    audio = sr.AudioData(audio_data, sample_rate=16000, sample_width=2)
+
+def _decode_compressed(data: bytes) -> tuple:
+    """用 PyAV 在内存中解码 webm/ogg/mp3 等压缩格式，边解码边重采样为 16 kHz 单声道"""
+    try:
+        import av  # 可选依赖，解码浏览器录制的 webm/opus 需要
+    except ImportError:
+        raise AudioDecodeError("解码压缩音频需要安装 av（PyAV）")
+    chunks = []
+    try:
+        with av.open(io.BytesIO(data)) as container:
+            stream = container.streams.audio[0]
+            resampler = av.AudioResampler(format="flt", layout="mono", rate=ASR_SAMPLE_RATE)
+            for frame in container.decode(stream):
+                for out in resampler.resample(frame):
+                    chunks.append(out.to_ndarray().reshape(-1))
+                if sum(map(len, chunks)) > MAX_AUDIO_SECONDS * ASR_SAMPLE_RATE:
+                    raise AudioDecodeError(f"录音超过 {MAX_AUDIO_SECONDS} 秒")
+            for out in resampler.resample(None):  # 取出重采样器中剩余的采样
+                chunks.append(out.to_ndarray().reshape(-1))
+    except (av.error.FFmpegError, IndexError) as e:
+        raise AudioDecodeError(f"音频解码失败: {e}")
+    samples = np.concatenate(chunks) if chunks else np.zeros(0, np.float32)
+    return samples.astype(np.float32, copy=False), ASR_SAMPLE_RATE
+
+
+def resample_audio(samples: np.ndarray, src_rate: int, dst_rate: int = ASR_SAMPLE_RATE) -> np.ndarray:
+    """线性插值重采样；降采样前先做滑动平均低通，抑制混叠"""
+    if src_rate == dst_rate or len(samples) == 0:
+        return samples
+    ratio = src_rate / dst_rate
+    if ratio > 1:
+        width = int(math.ceil(ratio))
+        samples = np.convolve(samples, np.full(width, 1 / width, np.float32), mode="same")
+    positions = np.arange(int(len(samples) / ratio)) * ratio
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+
+def trim_silence(samples: np.ndarray, rate: int = ASR_SAMPLE_RATE) -> np.ndarray:
+    """按帧能量裁掉首尾静音，减少识别引擎的工作量；整段都是静音时返回空数组"""
+    frame = rate * SILENCE_FRAME_MS // 1000
+    n_frames = len(samples) // frame
+    if n_frames == 0:  # 不足一帧的录音没有可识别的内容
+        return samples[:0]
+    energy = np.sqrt(np.mean(np.square(samples[: n_frames * frame].reshape(n_frames, frame)), axis=1))
+    peak = energy.max()
+    if peak < 1e-4:
+        return samples[:0]
+    voiced = np.flatnonzero(energy > peak * 10 ** (SILENCE_THRESHOLD_DB / 20))
+    padding = SILENCE_PADDING_MS // SILENCE_FRAME_MS
+    start = max(voiced[0] - padding, 0) * frame
+    end = min(voiced[-1] + 1 + padding, n_frames) * frame
+    return samples[start:end]
+
+
+def decode_audio(data: bytes) -> bytes:
+    """把上传的音频统一转换为识别引擎需要的 16 kHz 单声道 16 位 PCM，并裁掉首尾静音"""
+    if len(data) > MAX_AUDIO_UPLOAD_BYTES:
+        raise AudioDecodeError(f"音频超过 {MAX_AUDIO_UPLOAD_BYTES // (1024 * 1024)} MB")
+    container = sniff_audio_container(data)
+    if container == "wav":
+        samples, rate = _decode_wav(data)
+    elif container == "pcm":
+        samples, rate = np.frombuffer(data[: len(data) // 2 * 2], "<i2").astype(np.float32) / 32768, ASR_SAMPLE_RATE
+    else:
+        samples, rate = _decode_compressed(data)
+    if len(samples) > MAX_AUDIO_SECONDS * rate:
+        raise AudioDecodeError(f"录音超过 {MAX_AUDIO_SECONDS} 秒")
+    samples = trim_silence(resample_audio(samples, rate))
+    return (np.clip(samples, -1, 1) * 32767).astype("<i2").tobytes()
+
+
+def transcribe_audio(audio_data: bytes) -> str:
+    """在语音线程中解码并识别，返回识别文本或错误提示"""
+    start = time.perf_counter()
     try:
         logging.info("识别语音中...")
-        query = recognizer.recognize_google(audio, language="zh-CN")
-        logging.info(f"识别结果: {query}")
+        pcm = decode_audio(audio_data)
+        if not pcm:
+            raise sr.UnknownValueError()
+        query = asr_backend.transcribe(pcm, ASR_SAMPLE_RATE)
+        audio_seconds = len(pcm) / 2 / ASR_SAMPLE_RATE
+        elapsed = time.perf_counter() - start
+        metrics.observe("triage_asr_seconds", elapsed, backend=asr_backend.name, outcome="ok")
+        add_server_timing("asr", elapsed)
+        logging.info(
+            f"识别结果: {query}（{asr_backend.name}，音频 {audio_seconds:.1f}s，"
+            f"耗时 {elapsed:.2f}s，实时率 {elapsed / max(audio_seconds, 1e-6):.2f}）"
+        )
         return query
+    except AudioDecodeError as e:
+        logging.error(f"音频处理失败: {e}")
+        metrics.observe("triage_asr_seconds", time.perf_counter() - start, backend=asr_backend.name, outcome="decode_error")
+        return "无法识别语音"
     except sr.UnknownValueError:
         logging.error("无法识别语音")
+        metrics.observe("triage_asr_seconds", time.perf_counter() - start, backend=asr_backend.name, outcome="no_speech")
         return "无法识别语音"
     except sr.RequestError as e:
         logging.error(f"请求错误; {e}")
+        metrics.observe("triage_asr_seconds", time.perf_counter() - start, backend=asr_backend.name, outcome="error")
         return "请求错误"
 
 
-app = Flask(__name__)
-
-# 嵌入的 HTML 模板
-HTML_TEMPLATE = """
-<!DOCTYPE html>
-<html lang="zh-CN">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>智能导诊系统</title>
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css">
-    <script src="https://cdn.jsdelivr.net/npm/marked/marked.min.js"></script>
-    <style>
-
-        .patient-info-form {
-        padding: 30px;
-        background-color: #242f3d;
-        border-radius: 12px;
-        margin: 40px auto;
-        max-width: 500px;
-    }
-    .patient-info-form h2 {
-        color: #fff;
-        margin-bottom: 25px;
-        text-align: center;
-        font-size: 20px;
-    }
-    .form-group {
-        margin-bottom: 20px;
-    }
-    .form-group label {
-        display: block;
-        color: #fff;
-        margin-bottom: 8px;
-    }
-    .form-group input[type="text"],
-    .form-group input[type="number"],
-    .form-group select {
-        width: 100%;
-        padding: 10px;
-        border: 1px solid #3b4654;
-        border-radius: 6px;
-        background-color: #17212b;
-        color: #fff;
-    }
-    .radio-group {
-        display: flex;
-        gap: 20px;
-    }
-    .radio-group input[type="radio"] {
-        margin-right: 8px;
-    }
-    .submit-info-btn {
-        width: 100%;
-        padding: 12px;
-        background-color: #2b5278;
-        margin-top: 20px;
-    }
-    .submit-info-btn:hover {
-        background-color: #3a6d9c;
-    }
-        body {
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', 'Microsoft YaHei', sans-serif;
-            background-color: #17212b;
-            margin: 0;
-            padding: 0;
-            height: 100vh;
-            display: flex;
-            justify-content: center;
-            align-items: center;
-        }
-        .app-container {
-            display: flex;
-            width: 95%;
-            max-width: 1200px;
-            height: 90vh;
-            background-color: #17212b;
-            border-radius: 10px;
-            overflow: hidden;
-            box-shadow: 0 4px 20px rgba(0, 0, 0, 0.2);
-        }
-        .sidebar {
-            width: 280px;
-            background-color: #242f3d;
-            padding: 20px;
-            color: #fff;
-            border-right: 1px solid #3b4654;
-        }
-        .sidebar h2 {
-            font-size: 20px;
-            margin-bottom: 20px;
-            color: #fff;
-        }
-        .feature-list {
-            list-style: none;
-            padding: 0;
-            margin: 0;
-        }
-        .feature-item {
-            padding: 12px 15px;
-            margin-bottom: 8px;
-            background-color: #2b5278;
-            border-radius: 8px;
-            font-size: 14px;
-            cursor: pointer;
-            transition: background-color 0.2s;
-        }
-        .feature-item:hover {
-            background-color: #3a6d9c;
-        }
-        .feature-item i {
-            margin-right: 10px;
-            width: 20px;
-        }
-        .chat-section {
-            flex: 1;
-            display: flex;
-            flex-direction: column;
-            background-color: #0e1621;
-        }
-        .header {
-            background-color: #242f3d;
-            color: white;
-            padding: 15px 20px;
-            display: flex;
-            align-items: center;
-            gap: 15px;
-            border-bottom: 1px solid #3b4654;
-        }
-        .header-title {
-            font-size: 18px;
-            font-weight: normal;
-            margin: 0;
-            color: #fff;
-        }
-        .chat-container {
-            flex: 1;
-            overflow-y: auto;
-            padding: 20px;
-            background-color: #0e1621;
-        }
-        .message {
-            display: flex;
-            align-items: flex-start;
-            margin-bottom: 16px;
-            animation: fadeIn 0.2s ease;
-        }
-        .message-avatar {
-            width: 40px;
-            height: 40px;
-            border-radius: 50%;
-            margin: 0 12px;
-            flex-shrink: 0;
-            background-color: #242f3d;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            color: #fff;
-        }
-        .message-content {
-            max-width: 70%;
-            padding: 12px 16px;
-            border-radius: 8px;
-            position: relative;
-            font-size: 15px;
-            line-height: 1.4;
-        }
-        .bot-message {
-            background-color: #242f3d;
-            color: #fff;
-            margin-right: auto;
-        }
-        .user-message {
-            background-color: #2b5278;
-            color: #fff;
-            margin-left: auto;
-        }
-        .message-time {
-            font-size: 12px;
-            color: #8e8e8e;
-            margin-top: 4px;
-            text-align: right;
-        }
-        .input-container {
-            padding: 15px;
-            background-color: #242f3d;
-            border-top: 1px solid #3b4654;
-        }
-        .input-wrapper {
-            display: flex;
-            gap: 10px;
-            background-color: #17212b;
-            border-radius: 8px;
-            padding: 10px;
-        }
-        input[type="text"] {
-            flex: 1;
-            padding: 8px;
-            border: none;
-            background: none;
-            font-size: 15px;
-            outline: none;
-            color: #fff;
-        }
-        input[type="text"]::placeholder {
-            color: #8e8e8e;
-        }
-        .action-buttons {
-            display: flex;
-            gap: 8px;
-        }
-        button {
-            padding: 8px 16px;
-            border: none;
-            border-radius: 6px;
-            color: white;
-            cursor: pointer;
-            font-size: 14px;
-            display: flex;
-            align-items: center;
-            gap: 6px;
-            transition: background-color 0.2s;
-        }
-        .send-button {
-            background-color: #2b5278;
-        }
-        .send-button:hover {
-            background-color: #3a6d9c;
-        }
-        .record-button {
-            background-color: #2b5278;
-        }
-        .record-button:hover {
-            background-color: #3a6d9c;
-        }
-        .record-button.recording {
-            background-color: #c13d3d;
-        }
-        @keyframes fadeIn {
-            from { opacity: 0; transform: translateY(5px); }
-            to { opacity: 1; transform: translateY(0); }
-        }
-        /* 自定义滚动条 */
-        ::-webkit-scrollbar {
-            width: 6px;
-        }
-        ::-webkit-scrollbar-track {
-            background: #17212b;
-        }
-        ::-webkit-scrollbar-thumb {
-            background: #3b4654;
-            border-radius: 3px;
-        }
-        ::-webkit-scrollbar-thumb:hover {
-            background: #4a5a70;
-        }
+# 语音识别函数
+def recognize_speech_from_audio(audio_data) -> str:
+    """从音频数据识别语音并返回文本，解码在有界的语音线程池中进行"""
+    future = submit_with_context(asr_executor, transcribe_audio, audio_data)
+    try:
+        return future.result(timeout=ASR_TIMEOUT_SECONDS)
+    except FutureTimeoutError:
+        future.cancel()
+        logging.error("语音识别超时")
+        return "语音识别超时"
 
-        
-    // ... existing styles ...
-    
-    /* AI 思考动画样式 */
-    .thinking-animation {
-        display: flex;
-        align-items: center;
-        gap: 4px;
-        padding: 4px 8px;
-    }
-    
-    .thinking-dot {
-        width: 6px;
-        height: 6px;
-        background: #fff;
-        border-radius: 50%;
-        opacity: 0.4;
-        animation: thinkingAnimation 1.4s infinite;
-    }
-    
-    .thinking-dot:nth-child(2) {
-        animation-delay: 0.2s;
-    }
-    
-    .thinking-dot:nth-child(3) {
-        animation-delay: 0.4s;
-    }
-    
-    @keyframes thinkingAnimation {
-        0%, 100% { opacity: 0.4; transform: scale(1); }
-        50% { opacity: 1; transform: scale(1.1); }
-    }
-    </style>
-</head>
-<body>
-    <div class="app-container">
-        <div class="sidebar">
-            <h2>功能介绍</h2>
-            <ul class="feature-list">
-                <li class="feature-item">
-                    <i class="fas fa-comment-medical"></i>
-                    智能问诊对话
-                </li>
-                <li class="feature-item">
-                    <i class="fas fa-microphone"></i>
-                    语音输入支持
-                </li>
-                <li class="feature-item">
-                    <i class="fas fa-clipboard-list"></i>
-                    专业病历记录
-                </li>
-                <li class="feature-item">
-                    <i class="fas fa-hospital"></i>
-                    科室精准推荐
-                </li>
-                <li class="feature-item">
-                    <i class="fas fa-user-md"></i>
-                    专业医学知识
-                </li>
-                <li class="feature-item">
-                    <i class="fas fa-shield-alt"></i>
-                    隐私安全保护
-                </li>
-                <li class="feature-item" onclick="showHelp()">
-                    <i class="fas fa-question-circle"></i>
-                    使用帮助
-                </li>
-            </ul>
-        </div>
-        <div class="chat-section">
-            <div class="header">
-                <h1 class="header-title">智能导诊助手</h1>
-            </div>
-            <!-- 添加患者信息表单 -->
-            <div id="patient-info-form" class="patient-info-form">
-                <h2>患者基本信息</h2>
-                <div class="form-group">
-                    <label>性别：</label>
-                    <div class="radio-group">
-                        <input type="radio" id="male" name="gender" value="男" required>
-                        <label for="male">男</label>
-                        <input type="radio" id="female" name="gender" value="女">
-                        <label for="female">女</label>
-                    </div>
-                </div>
-                <div class="form-group">
-                    <label for="age">年龄：</label>
-                    <input type="number" id="age" min="0" max="120" required>
-                </div>
-                <div class="form-group">
-                    <label for="occupation">职业：</label>
-                    <input type="text" id="occupation" required>
-                </div>
-                <div class="form-group">
-                    <label>婚育状况：</label>
-                    <select id="marital-status" required>
-                        <option value="">请选择</option>
-                        <option value="未婚">未婚</option>
-                        <option value="已婚已育">已婚已育</option>
-                        <option value="已婚未育">已婚未育</option>
-                        <option value="其他">其他</option>
-                    </select>
-                </div>
-                <button onclick="submitPatientInfo()" class="submit-info-btn">开始问诊</button>
-            </div>
-            <!-- 修改聊天容器，默认隐藏 -->
-            <div id="chat-container" class="chat-container" style="display: none;">
-                <div class="message">
-                    <div class="message-avatar bot-avatar">
-                        <i class="fas fa-user-md"></i>
-                    </div>
-                    <div class="message-content bot-message">
-                        您好！我是您的智能导诊助手，请详细描述您的症状，我会为您推荐合适的就诊科室。
-                        <div class="message-time">系统消息</div>
-                    </div>
-                </div>
-            </div>
-            <div class="input-container">
-                <div class="input-wrapper">
-                    <input type="text" id="text_input" placeholder="请描述您的症状...">
-                    <div class="action-buttons">
-                        <button id="record_button" class="record-button">
-                            <i class="fas fa-microphone"></i>
-                            语音输入
-                        </button>
-                        <button onclick="submitForm()" class="send-button">
-                            <i class="fas fa-paper-plane"></i>
-                            发送
-                        </button>
-                    </div>
-                </div>
-            </div>
-        </div>
-    </div>
-
-    <script>
-        let mediaRecorder;
-        let audioChunks = [];
-        let isRecording = false;
-
-        function showHelp() {
-            const helpContent = `
-# 智能导诊系统使用帮助
-
-## 基本操作
-1. **文字输入**
-   - 在底部输入框输入症状描述
-   - 按发送按钮或回车键提交
-
-2. **语音输入**
-   - 点击"语音输入"按钮开始录音
-   - 再次点击停止录音
-   - 系统自动识别并发送语音内容
-
-## 问诊流程
-1. 系统会引导您描述主要症状
-2. 根据您的回答进行追问
-3. 收集足够信息后生成诊断建议
-4. 推荐合适的就诊科室
-
-## 注意事项
-- 请尽可能详细描述症状
-- 如遇紧急情况请立即就医
-- 系统建议仅供参考
-`;
-            addMessage(helpContent);
-        }
-
-        // 配置 marked 选项
-        marked.setOptions({
-            breaks: true,
-            gfm: true,
-            headerIds: false,
-            mangle: false
-        });
-
-        function addMessage(content, isUser = false) {
-            const chatContainer = document.getElementById('chat-container');
-            const messageDiv = document.createElement('div');
-            messageDiv.className = 'message';
-    
-            const now = new Date();
-            const time = now.toLocaleTimeString('zh-CN', { hour: '2-digit', minute: '2-digit' });
-    
-            const avatar = `
-                <div class="message-avatar ${isUser ? 'user-avatar' : 'bot-avatar'}">
-                    <i class="fas ${isUser ? 'fa-user' : 'fa-user-md'}"></i>
-                </div>
-            `;
-    
-            // 处理 Markdown 内容
-            const formattedContent = isUser ? content : marked.parse(content);
-            
-            const messageContent = `
-                <div class="message-content ${isUser ? 'user-message' : 'bot-message'}">
-                    ${formattedContent}
-                    <div class="message-time">${time}</div>
-                </div>
-            `;
-    
-            messageDiv.innerHTML = isUser ? messageContent + avatar : avatar + messageContent;
-            chatContainer.appendChild(messageDiv);
-            chatContainer.scrollTop = chatContainer.scrollHeight;
-        }
-
-        document.getElementById('record_button').addEventListener('click', () => {
-            if (!isRecording) {
-                startRecording();
-            } else {
-                stopRecording();
-            }
-        });
-
-        async function startRecording() {
-            try {
-                const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
-                mediaRecorder = new MediaRecorder(stream);
-
-                mediaRecorder.ondataavailable = event => {
-                    audioChunks.push(event.data);
-                };
-
-                mediaRecorder.onstop = () => {
-                    const audioBlob = new Blob(audioChunks, { type: 'audio/wav' });
-                    const formData = new FormData();
-                    formData.append('audio_input', audioBlob, 'recording.wav');
-                    submitForm(formData);
-                };
-
-                mediaRecorder.start();
-                isRecording = true;
-                const recordButton = document.getElementById('record_button');
-                recordButton.classList.add('recording');
-                recordButton.innerHTML = '<i class="fas fa-stop"></i> 停止录音';
-            } catch (error) {
-                console.error('录音失败:', error);
-                alert('无法访问麦克风，请检查权限设置');
-            }
-        }
-
-        function stopRecording() {
-            mediaRecorder.stop();
-            isRecording = false;
-            const recordButton = document.getElementById('record_button');
-            recordButton.classList.remove('recording');
-            recordButton.innerHTML = '<i class="fas fa-microphone"></i> 语音输入';
-            audioChunks = [];
-        }
-
-          function showThinkingAnimation() {
-            const chatContainer = document.getElementById('chat-container');
-            const thinkingDiv = document.createElement('div');
-            thinkingDiv.className = 'message thinking-message';
-            thinkingDiv.innerHTML = `
-                <div class="message-avatar bot-avatar">
-                    <i class="fas fa-user-md"></i>
-                </div>
-                <div class="message-content bot-message">
-                    <div class="thinking-animation">
-                        <div class="thinking-dot"></div>
-                        <div class="thinking-dot"></div>
-                        <div class="thinking-dot"></div>
-                    </div>
-                </div>
-            `;
-            chatContainer.appendChild(thinkingDiv);
-            chatContainer.scrollTop = chatContainer.scrollHeight;
-            return thinkingDiv;
-        }
-
-        function removeThinkingAnimation(element) {
-            if (element && element.parentNode) {
-                element.parentNode.removeChild(element);
-            }
-        }
-
-        // 修改 submitForm 函数
-        async function submitForm(formData = null) {
-            const textInput = document.getElementById('text_input');
-            const text = textInput.value.trim();
-    
-            if (!formData) {
-                if (!text) {
-                    alert('请输入内容');
-                    return;
-                }
-                formData = new FormData();
-                formData.append('text_input', text);
-                addMessage(text, true);
-            }
-    
-            const thinkingAnimation = showThinkingAnimation();
-    
-            try {
-                const response = await fetch('/submit', {
-                    method: 'POST',
-                    body: formData
-                });
-                const data = await response.json();
-                removeThinkingAnimation(thinkingAnimation);
-                addMessage(data.result);
-                textInput.value = '';
-            } catch (error) {
-                console.error('Error:', error);
-                removeThinkingAnimation(thinkingAnimation);
-                addMessage('抱歉，服务出现错误，请稍后重试。');
-            }
-        }
 
-        // 支持按回车发送消息
-        document.getElementById('text_input').addEventListener('keypress', function(e) {
-            if (e.key === 'Enter') {
-                submitForm();
-            }
-        });
-        function submitPatientInfo() {
-        const gender = document.querySelector('input[name="gender"]:checked')?.value;
-        const age = document.getElementById('age').value;
-        const occupation = document.getElementById('occupation').value;
-        const maritalStatus = document.getElementById('marital-status').value;
-
-        if (!gender || !age || !occupation || !maritalStatus) {
-            alert('请填写所有必填信息');
-            return;
-        }
-
-        const patientInfo = `患者基本信息：
-- 性别：${gender}
-- 年龄：${age}岁
-- 职业：${occupation}
-- 婚育状况：${maritalStatus}`;
-
-        // 隐藏表单，显示聊天界面
-        document.getElementById('patient-info-form').style.display = 'none';
-        document.getElementById('chat-container').style.display = 'block';
-        document.getElementById('input-container').style.display = 'block';
-
-        // 发送患者信息
-        const formData = new FormData();
-        formData.append('text_input', patientInfo);
-        submitForm(formData);
+async def arecognize_speech_from_audio(audio_data) -> str:
+    """recognize_speech_from_audio 的异步版本，等待期间不占用事件循环"""
+    try:
+        return await asyncio.wait_for(
+            asyncio.wrap_future(submit_with_context(asr_executor, transcribe_audio, audio_data)), ASR_TIMEOUT_SECONDS
+        )
+    except asyncio.TimeoutError:
+        logging.error("语音识别超时")
+        return "语音识别超时"
+
+
+# 流式语音配置：浏览器通过 WebSocket 边说边发送 16 kHz 单声道 16 位 PCM
+VOICE_STREAM_SPEECH_DBFS = -45  # 帧能量高于该值（相对满幅）视为有人说话
+VOICE_STREAM_END_SILENCE_MS = 800  # 开口之后连续静音这么久即认为说完
+VOICE_STREAM_IDLE_SECONDS = 10  # 这么久收不到音频即结束会话
+
+
+class VoiceStream:
+    """一次流式语音输入：把音频送入增量识别，并按能量判断说话人何时停下"""
+
+    def __init__(self, backend: ASRBackend = None):
+        self.stream = (backend or asr_backend).create_stream(ASR_SAMPLE_RATE)
+        self.frame_bytes = ASR_SAMPLE_RATE * SILENCE_FRAME_MS // 1000 * 2
+        self.threshold = 32768 * 10 ** (VOICE_STREAM_SPEECH_DBFS / 20)
+        self.speech_started = False
+        self.silent_ms = 0
+        self.received_bytes = 0
+        self.ended_at = None  # 判定说完的时刻，用于统计收尾延迟
+        self._pending = b""  # 不足一帧的尾部，留到下一块一起计算能量
+
+    def _detect_end(self, pcm: bytes) -> bool:
+        data = self._pending + pcm
+        usable = len(data) // self.frame_bytes * self.frame_bytes
+        self._pending = data[usable:]
+        if not usable:
+            return False
+        frames = np.frombuffer(data[:usable], "<i2").astype(np.float32).reshape(-1, self.frame_bytes // 2)
+        for voiced in np.sqrt(np.mean(np.square(frames), axis=1)) > self.threshold:
+            if voiced:
+                self.speech_started = True
+                self.silent_ms = 0
+            elif self.speech_started:
+                self.silent_ms += SILENCE_FRAME_MS
+        return self.speech_started and self.silent_ms >= VOICE_STREAM_END_SILENCE_MS
+
+    def feed(self, pcm: bytes) -> tuple:
+        """送入一块音频，返回 (中间识别结果, 是否已经说完)"""
+        pcm = pcm[: len(pcm) // 2 * 2]
+        self.received_bytes += len(pcm)
+        partial = self.stream.accept(pcm)
+        ended = self._detect_end(pcm) or self.received_bytes >= MAX_AUDIO_SECONDS * ASR_SAMPLE_RATE * 2
+        if ended:
+            self.ended_at = time.perf_counter()
+        return partial, ended
+
+    def finish(self) -> str:
+        """取得最终识别文本，失败时返回与整段识别相同的错误提示"""
+        ended_at = self.ended_at or time.perf_counter()
+        try:
+            if not self.speech_started:
+                raise sr.UnknownValueError()
+            query = self.stream.finish()
+            logging.info(
+                f"流式识别结果: {query}（{asr_backend.name}，音频 {self.received_bytes / 2 / ASR_SAMPLE_RATE:.1f}s，"
+                f"说完到出结果 {(time.perf_counter() - ended_at) * 1000:.0f}ms）"
+            )
+            return query
+        except sr.UnknownValueError:
+            logging.error("无法识别语音")
+            return "无法识别语音"
+        except sr.RequestError as e:
+            logging.error(f"请求错误; {e}")
+            return "请求错误"
+
+
+def voice_event(event: str, text: str) -> str:
+    """流式语音接口推送给页面的消息"""
+    return json.dumps({"type": event, "text": text}, ensure_ascii=False)
+
+
+# 页面与静态资源配置：启动时一次性读取、渲染和压缩，请求时直接返回内存中的字节
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+TEMPLATE_DIR = os.path.join(BASE_DIR, "templates")
+STATIC_MAX_AGE = 365 * 24 * 60 * 60  # 带版本号的资源按不可变内容缓存一年
+COMPRESS_MIN_BYTES = 1024  # 小于该大小的资源不压缩
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+mimetypes.add_type("font/woff2", ".woff2")
+mimetypes.add_type("application/javascript", ".js")
+
+_CSS_URL_RE = re.compile(r"""url\((['"]?)(?!data:|https?:|/)([^)'"?#]+)\1\)""")
+
+
+class StaticAsset:
+    """预先处理好的资源：原始内容、各压缩版本以及内容指纹"""
+
+    def __init__(self, body: bytes, content_type: str):
+        self.content_type = content_type
+        self.digest = hashlib.sha256(body).hexdigest()[:16]
+        self.variants = {"identity": body}
+        if len(body) >= COMPRESS_MIN_BYTES and content_type.startswith(COMPRESSIBLE_TYPES):
+            self.variants["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.variants["br"] = brotli.compress(body, quality=11)
+
+    def select(self, accept_encoding: str) -> tuple:
+        """按 Accept-Encoding 选出压缩率最高的可用版本，返回 (编码, 内容)"""
+        accepted = {token.split(";")[0].strip() for token in accept_encoding.lower().split(",")}
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and encoding in accepted:
+                return encoding, self.variants[encoding]
+        return "identity", self.variants["identity"]
+
+
+def _content_type(path: str) -> str:
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if content_type.startswith("text/") or content_type in ("application/javascript", "application/json"):
+        content_type += "; charset=utf-8"
+    return content_type
+
+
+def load_static_assets(root: str = STATIC_DIR) -> dict:
+    """读取静态目录下的全部文件，返回 相对路径 -> StaticAsset
+
+    CSS 中以相对路径引用的资源（如字体）补上版本号，随样式表一起长期缓存。
+    """
+    paths = []
+    for directory, _, files in os.walk(root):
+        for name in files:
+            paths.append(os.path.relpath(os.path.join(directory, name), root).replace(os.sep, "/"))
+    assets = {}
+
+    def versioned(match, css_path):
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(css_path), match.group(2)))
+        if target not in assets:
+            return match.group(0)
+        quote = match.group(1)
+        return f"url({quote}{match.group(2)}?v={assets[target].digest}{quote})"
+
+    # 先处理其他文件，CSS 引用的资源此时已有指纹
+    for path in sorted(paths, key=lambda p: p.endswith(".css")):
+        with open(os.path.join(root, path), "rb") as f:
+            body = f.read()
+        if path.endswith(".css"):
+            body = _CSS_URL_RE.sub(lambda m: versioned(m, path), body.decode("utf-8")).encode("utf-8")
+        assets[path] = StaticAsset(body, _content_type(path))
+    return assets
+
+
+def render_index(assets: dict) -> StaticAsset:
+    """渲染一次首页模板；资源地址带内容指纹，资源更新后页面自动引用新地址"""
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_DIR), autoescape=True)
+    html = env.get_template("index.html").render(asset_url=lambda path: f"/static/{path}?v={assets[path].digest}")
+    return StaticAsset(html.encode("utf-8"), "text/html; charset=utf-8")
+
+
+def asset_response(asset: StaticAsset, if_none_match: str, accept_encoding: str, immutable: bool) -> tuple:
+    """构造资源响应，返回 (状态码, 响应头, 内容)，Flask 与 quart 两个服务共用
+
+    每个压缩版本有各自的 ETag；带正确版本号的请求按不可变内容缓存，
+    其余（包括首页）每次向服务器确认，未变化时返回 304。
+    """
+    encoding, body = asset.select(accept_encoding)
+    etag = f'"{asset.digest}"' if encoding == "identity" else f'"{asset.digest}-{encoding}"'
+    headers = {
+        "ETag": etag,
+        "Vary": "Accept-Encoding",
+        "Cache-Control": f"public, max-age={STATIC_MAX_AGE}, immutable" if immutable else "no-cache",
     }
-    </script>
-</body>
-</html>
-"""
+    # 代理在转发时可能把 ETag 改为弱校验形式，比较时忽略 W/ 前缀
+    if etag in {token.strip().removeprefix("W/") for token in if_none_match.split(",")}:
+        return 304, headers, b""
+    headers["Content-Type"] = asset.content_type
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return 200, headers, body
+
+
+static_assets = load_static_assets()
+index_page = render_index(static_assets)
+logging.info(f"已加载 {len(static_assets)} 个静态资源，首页 {len(index_page.variants['identity'])} 字节")
+
+app = Flask(__name__, static_folder=None)
+app.config["MAX_CONTENT_LENGTH"] = MAX_AUDIO_UPLOAD_BYTES  # 过大的上传直接返回 413，不读取请求体
+
+
+@app.before_request
+def start_request_timing():
+    g.request_start = time.perf_counter()
+    _request_timings.set({})
+
+
+@app.after_request
+def record_request_timing(response):
+    """记录请求耗时；开启 SERVER_TIMING 时在非流式响应上附带各环节耗时"""
+    elapsed = time.perf_counter() - g.get("request_start", time.perf_counter())
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.observe(
+        "triage_http_request_seconds", elapsed, method=request.method, endpoint=endpoint, status=response.status_code
+    )
+    if SERVER_TIMING and response.mimetype != "text/event-stream":
+        response.headers["Server-Timing"] = server_timing_header(_request_timings.get() or {}, elapsed)
+    return response
+
+
+@app.errorhandler(413)
+def upload_too_large(error):
+    return jsonify({"error": "上传的音频过大"}), 413
+
+
+@app.errorhandler(LLMOverloaded)
+def llm_overloaded(error):
+    response = jsonify({"error": BUSY_MESSAGE.format(retry_after=error.retry_after), "retry_after": error.retry_after})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
+def send_asset(asset: StaticAsset, immutable: bool = False) -> Response:
+    status, headers, body = asset_response(
+        asset, request.headers.get("If-None-Match", ""), request.headers.get("Accept-Encoding", ""), immutable
+    )
+    return Response(body, status=status, headers=headers)
 
 
 @app.route('/')
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    return send_asset(index_page)
 
 
-@app.route('/submit', methods=['POST'])
-def submit():
-    global history
+@app.route('/static/<path:filename>')
+def static_file(filename):
+    asset = static_assets.get(filename)
+    if asset is None:
+        return jsonify({"error": "资源不存在"}), 404
+    return send_asset(asset, immutable=request.args.get("v") == asset.digest)
+
+
+def get_session_id() -> str:
+    """从 Cookie 读取会话 ID，缺失或格式不对时生成新的"""
+    session_id = request.cookies.get(SESSION_COOKIE_NAME, "")
+    if re.fullmatch(r"[0-9a-f]{32}", session_id):
+        return session_id
+    return uuid.uuid4().hex
+
+
+def read_query():
+    """从表单中读取文字或语音输入，两者都没有时返回 None"""
     if 'text_input' in request.form:
-        query = request.form['text_input']
-    elif 'audio_input' in request.files:
+        return request.form['text_input']
+    if 'audio_input' in request.files:
         audio_file = request.files['audio_input']
         audio_data = audio_file.read()
-        query = recognize_speech_from_audio(audio_data)
+        return recognize_speech_from_audio(audio_data)
+    return None
+
+
+@app.route('/submit', methods=['POST'])
+def submit():
+    query = read_query()
+    if query is None:
+        return jsonify({"error": "无效的输入方式"}), 400
+
+    session_id = get_session_id()
+    _record_job_id.set(None)
+    with conversation_store.lock(session_id):
+        _current_session_id.set(session_id)  # 本轮的对话变化按该会话写入问诊日志
+        session = conversation_store.load(session_id)
+        refined_result = refine_response(query, session["history"], session.setdefault("summary", new_summary()))
+        conversation_store.save(session_id, session)
+
+    body = {"result": refined_result}
+    if _record_job_id.get() is not None:
+        body["record_job"] = _record_job_id.get()
+    response = make_response(jsonify(body))
+    response.set_cookie(SESSION_COOKIE_NAME, session_id, httponly=True, samesite="Lax")
+    return response
+
+
+@app.route('/departments', methods=['GET', 'POST'])
+def departments():
+    """即时给出推荐科室（本地计算，不调用模型）
+
+    传入 text 时按该文本推荐，否则按当前会话中患者已经提供的信息推荐。
+    """
+    start = time.perf_counter()
+    text = request.values.get('text')
+    if text is not None:
+        ranked = recommend_departments(text)
     else:
+        session = conversation_store.load(get_session_id())
+        ranked = recommend_departments_for_history(session["history"])
+    elapsed_us = (time.perf_counter() - start) * 1e6
+    return jsonify({"departments": ranked, "elapsed_us": round(elapsed_us, 1)})
+
+
+@app.route('/records/<job_id>')
+def record_job_status(job_id):
+    """后台病历任务的状态：pending / done / failed，完成后 result 为完整回复"""
+    state = record_jobs.get(job_id, get_session_id())
+    if state is None:
+        return jsonify({"error": "任务不存在"}), 404
+    return jsonify({"status": state["status"], "result": state["result"]})
+
+
+@app.route('/records/<job_id>/events')
+def record_job_events(job_id):
+    """病历就绪时以 Server-Sent Events 推送 done 事件
+
+    每次最多挂起 RECORD_EVENTS_HOLD_SECONDS，未完成即结束响应，浏览器按 retry 间隔自动重连。
+    """
+    session_id = get_session_id()
+    if record_jobs.get(job_id, session_id) is None:
+        return jsonify({"error": "任务不存在"}), 404
+
+    def events():
+        yield f"retry: {RECORD_EVENTS_RETRY_MS}\n\n"
+        state = record_jobs.wait(job_id, session_id, RECORD_EVENTS_HOLD_SECONDS)
+        if state is not None and state["status"] != "pending":
+            yield record_job_event(state)
+
+    response = Response(events(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@app.route('/consultations')
+def consultations():
+    """按日期（date=YYYY-MM-DD）与科室（department）查询已归档的问诊，需携带 Authorization: Bearer <ARCHIVE_TOKEN>"""
+    if consultation_journal is None or not ARCHIVE_TOKEN:
+        return jsonify({"error": "未启用问诊归档查询"}), 404
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {ARCHIVE_TOKEN}"):
+        return jsonify({"error": "未授权"}), 401
+    limit = min(request.args.get("limit", 50, type=int), 500)
+    rows = consultation_journal.archive.query(request.args.get("date"), request.args.get("department"), limit)
+    return jsonify({"consultations": rows})
+
+
+@app.route('/cache/stats')
+def cache_stats():
+    """模型回复缓存的命中情况"""
+    return jsonify(completion_cache.stats())
+
+
+@app.route('/llm/stats')
+def llm_stats():
+    """模型调用调度器的排队深度、放行与拒绝计数，以及重试、对冲、熔断情况"""
+    return jsonify(llm_call_stats())
+
+
+def collect_component_metrics() -> list:
+    """把回复缓存、调度器、熔断器等组件已有的统计转成指标"""
+    cache = completion_cache.stats()
+    dispatcher = llm_dispatcher.stats()
+    with _llm_call_counters_lock:
+        events = dict(llm_call_counters)
+    samples = [
+        ("triage_cache_entries", "gauge", "回复缓存的条目数", {}, cache["entries"]),
+        ("triage_cache_evictions_total", "counter", "回复缓存淘汰的条目数", {}, cache["evictions"]),
+        ("triage_llm_in_flight", "gauge", "在途的模型调用数", {}, dispatcher["in_flight"]),
+        ("triage_llm_queued", "gauge", "排队中的模型调用数", {}, dispatcher["queued"]),
+        ("triage_llm_breaker_open", "gauge", "熔断器是否打开（半开也计为 1）", {}, int(llm_breaker.state != "closed")),
+        ("triage_local_check_decisions_total", "counter", "本地规则直接给出完整性结论的次数", {}, llm_calls_avoided),
+    ]
+    for result in ("admitted", "rejected", "timeouts"):
+        samples.append(("triage_llm_dispatcher_total", "counter", "调度器放行、拒绝与排队超时的次数",
+                        {"result": result}, dispatcher[result]))
+    for event, value in events.items():
+        samples.append(("triage_llm_events_total", "counter", "模型调用的尝试、重试、对冲、熔断与兜底次数",
+                        {"event": event}, value))
+    samples.append(("triage_record_jobs_pending", "gauge", "排队与进行中的后台病历任务数", {}, record_jobs.pending))
+    if consultation_journal is not None:
+        journal = consultation_journal.stats()
+        samples += [
+            ("triage_journal_events_total", "counter", "写入问诊日志的事件数", {}, journal["appended"]),
+            ("triage_journal_fsyncs_total", "counter", "问诊日志的 fsync 次数（每次落盘一批事件）", {}, journal["fsyncs"]),
+            ("triage_journal_pending", "gauge", "尚未落盘的问诊日志事件数", {}, journal["pending"]),
+            ("triage_journal_segments", "gauge", "问诊日志的段文件数", {}, journal["segments"]),
+        ]
+    return samples
+
+
+metrics.add_collector(collect_component_metrics)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 文本格式的指标（本工作进程）"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+
+def save_streamed_turn(session_id: str, session: dict) -> None:
+    """保存流式问诊的会话；客户端中途断开、本轮没有回复时先撤回末尾的患者消息
+
+    否则下一轮会出现连续两条患者消息，问诊轮数也会多算一轮。
+    """
+    history = session["history"]
+    if len(history) > 1 and history[-1]["role"] == "user":
+        logging.info("本轮回复未送达，撤回未作答的患者消息")
+        history.pop()
+    conversation_store.save(session_id, session)
+
+
+@app.route('/submit_stream', methods=['POST'])
+def submit_stream():
+    """以 Server-Sent Events 逐段推送回复"""
+    query = read_query()
+    if query is None:
         return jsonify({"error": "无效的输入方式"}), 400
+    llm_dispatcher.check_admission()  # 排队已满时在开始推送之前返回 503
+
+    session_id = get_session_id()
+
+    def events():
+        with conversation_store.lock(session_id):
+            _current_session_id.set(session_id)
+            session = conversation_store.load(session_id)
+            stream = refine_response_stream(query, session["history"], session.setdefault("summary", new_summary()))
+            try:
+                for event, text in stream:
+                    data = json.dumps({"text": text}, ensure_ascii=False)
+                    yield f"event: {event}\ndata: {data}\n\n"
+            finally:
+                stream.close()  # 客户端中途断开时先结束本轮，再保存
+                save_streamed_turn(session_id, session)
+
+    response = Response(events(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # 关闭反向代理缓冲
+    response.set_cookie(SESSION_COOKIE_NAME, session_id, httponly=True, samesite="Lax")
+    return response
+
+
+if Sock is not None:
+    sock = Sock(app)
+
+    @sock.route('/voice_stream')
+    def voice_stream(ws):
+        """流式语音输入：接收 PCM 分块，推送中间识别结果，说完后直接流式返回回复
+
+        页面发送二进制 PCM 帧，发送文本消息 "end" 表示手动结束；
+        服务端依次推送 partial、final 以及与 /submit_stream 相同的 delta / done 消息。
+        """
+        session_id = get_session_id()
+        voice = VoiceStream()
+        last_partial = ""
+        try:
+            while True:
+                message = ws.receive(timeout=VOICE_STREAM_IDLE_SECONDS)
+                if message is None or isinstance(message, str):
+                    break
+                partial, ended = asr_executor.submit(voice.feed, message).result(timeout=ASR_TIMEOUT_SECONDS)
+                if partial and partial != last_partial:
+                    last_partial = partial
+                    ws.send(voice_event("partial", partial))
+                if ended:
+                    break
+            query = asr_executor.submit(voice.finish).result(timeout=ASR_TIMEOUT_SECONDS)
+            ws.send(voice_event("final", query))
+            with conversation_store.lock(session_id):
+                _current_session_id.set(session_id)
+                session = conversation_store.load(session_id)
+                stream = refine_response_stream(query, session["history"], session.setdefault("summary", new_summary()))
+                try:
+                    for event, text in stream:
+                        ws.send(voice_event(event, text))
+                finally:
+                    stream.close()
+                    save_streamed_turn(session_id, session)
+        except FutureTimeoutError:
+            logging.error("语音识别超时")
+            ws.send(voice_event("done", "语音识别超时"))
+        except ConnectionClosed:
+            logging.info("流式语音连接已关闭")
+
 
-    refined_result = refine_response(query, history)
-    return jsonify({"result": refined_result})
+# 异步（ASGI）服务入口：与 Flask 版本提供相同的页面、问诊、病历任务与统计接口
+if quart is not None:
+    asgi_app = quart.Quart(__name__, static_folder=None)
+    asgi_app.config["MAX_CONTENT_LENGTH"] = MAX_AUDIO_UPLOAD_BYTES
+
+    @asgi_app.errorhandler(LLMOverloaded)
+    async def async_llm_overloaded(error):
+        body = {"error": BUSY_MESSAGE.format(retry_after=error.retry_after), "retry_after": error.retry_after}
+        return quart.jsonify(body), 503, {"Retry-After": str(error.retry_after)}
+
+    async def aread_query():
+        """read_query 的异步版本，语音识别在语音线程池中执行"""
+        form = await quart.request.form
+        if 'text_input' in form:
+            return form['text_input']
+        files = await quart.request.files
+        if 'audio_input' in files:
+            audio_data = files['audio_input'].read()
+            return await arecognize_speech_from_audio(audio_data)
+        return None
+
+    def aget_session_id(source=None) -> str:
+        session_id = (source or quart.request).cookies.get(SESSION_COOKIE_NAME, "")
+        if re.fullmatch(r"[0-9a-f]{32}", session_id):
+            return session_id
+        return uuid.uuid4().hex
+
+    def asend_asset(asset: StaticAsset, immutable: bool = False):
+        headers = quart.request.headers
+        status, response_headers, body = asset_response(
+            asset, headers.get("If-None-Match", ""), headers.get("Accept-Encoding", ""), immutable
+        )
+        return quart.Response(body, status=status, headers=response_headers)
+
+    @asgi_app.before_request
+    async def async_start_request_timing():
+        quart.g.request_start = time.perf_counter()
+        _request_timings.set({})
+
+    @asgi_app.after_request
+    async def async_record_request_timing(response):
+        elapsed = time.perf_counter() - quart.g.get("request_start", time.perf_counter())
+        rule = quart.request.url_rule
+        metrics.observe(
+            "triage_http_request_seconds", elapsed, method=quart.request.method,
+            endpoint=rule.rule if rule is not None else "unmatched", status=response.status_code,
+        )
+        if SERVER_TIMING and response.mimetype != "text/event-stream":
+            response.headers["Server-Timing"] = server_timing_header(_request_timings.get() or {}, elapsed)
+        return response
+
+    @asgi_app.route('/metrics')
+    async def async_metrics():
+        return quart.Response(metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+    @asgi_app.route('/')
+    async def async_index():
+        return asend_asset(index_page)
+
+    @asgi_app.route('/static/<path:filename>')
+    async def async_static_file(filename):
+        asset = static_assets.get(filename)
+        if asset is None:
+            return quart.jsonify({"error": "资源不存在"}), 404
+        return asend_asset(asset, immutable=quart.request.args.get("v") == asset.digest)
+
+    @asgi_app.route('/submit', methods=['POST'])
+    async def async_submit():
+        query = await aread_query()
+        if query is None:
+            return quart.jsonify({"error": "无效的输入方式"}), 400
+
+        session_id = aget_session_id()
+        _record_job_id.set(None)
+        async with conversation_store.async_lock(session_id):
+            _current_session_id.set(session_id)
+            session = conversation_store.load(session_id)
+            refined_result = await arefine_response(query, session["history"], session.setdefault("summary", new_summary()))
+            conversation_store.save(session_id, session)
+
+        body = {"result": refined_result}
+        if _record_job_id.get() is not None:
+            body["record_job"] = _record_job_id.get()
+        response = quart.jsonify(body)
+        response.set_cookie(SESSION_COOKIE_NAME, session_id, httponly=True, samesite="Lax")
+        return response
+
+    @asgi_app.route('/submit_stream', methods=['POST'])
+    async def async_submit_stream():
+        query = await aread_query()
+        if query is None:
+            return quart.jsonify({"error": "无效的输入方式"}), 400
+        llm_dispatcher.check_admission()
+
+        session_id = aget_session_id()
+
+        async def events():
+            async with conversation_store.async_lock(session_id):
+                _current_session_id.set(session_id)
+                session = conversation_store.load(session_id)
+                stream = arefine_response_stream(query, session["history"], session.setdefault("summary", new_summary()))
+                try:
+                    async for event, text in stream:
+                        data = json.dumps({"text": text}, ensure_ascii=False)
+                        yield f"event: {event}\ndata: {data}\n\n"
+                finally:
+                    await stream.aclose()
+                    save_streamed_turn(session_id, session)
+
+        response = await quart.make_response(events())
+        response.timeout = None  # 流式响应不受默认超时限制
+        response.mimetype = "text/event-stream"
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"
+        response.set_cookie(SESSION_COOKIE_NAME, session_id, httponly=True, samesite="Lax")
+        return response
+
+    @asgi_app.route('/departments', methods=['GET', 'POST'])
+    async def async_departments():
+        start = time.perf_counter()
+        text = (await quart.request.values).get('text')
+        if text is not None:
+            ranked = recommend_departments(text)
+        else:
+            session = conversation_store.load(aget_session_id())
+            ranked = recommend_departments_for_history(session["history"])
+        elapsed_us = (time.perf_counter() - start) * 1e6
+        return quart.jsonify({"departments": ranked, "elapsed_us": round(elapsed_us, 1)})
+
+    @asgi_app.route('/records/<job_id>')
+    async def async_record_job_status(job_id):
+        state = record_jobs.get(job_id, aget_session_id())
+        if state is None:
+            return quart.jsonify({"error": "任务不存在"}), 404
+        return quart.jsonify({"status": state["status"], "result": state["result"]})
+
+    @asgi_app.route('/records/<job_id>/events')
+    async def async_record_job_events(job_id):
+        """record_job_events 的异步版本，挂起等待不占线程，最多等 RECORD_EVENTS_ASYNC_HOLD_SECONDS"""
+        session_id = aget_session_id()
+        if record_jobs.get(job_id, session_id) is None:
+            return quart.jsonify({"error": "任务不存在"}), 404
+
+        async def events():
+            yield f"retry: {RECORD_EVENTS_RETRY_MS}\n\n"
+            state = await record_jobs.await_job(job_id, session_id, RECORD_EVENTS_ASYNC_HOLD_SECONDS)
+            if state is not None and state["status"] != "pending":
+                yield record_job_event(state)
+
+        response = await quart.make_response(events())
+        response.timeout = None
+        response.mimetype = "text/event-stream"
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
+
+    @asgi_app.route('/consultations')
+    async def async_consultations():
+        if consultation_journal is None or not ARCHIVE_TOKEN:
+            return quart.jsonify({"error": "未启用问诊归档查询"}), 404
+        if not hmac.compare_digest(quart.request.headers.get("Authorization", ""), f"Bearer {ARCHIVE_TOKEN}"):
+            return quart.jsonify({"error": "未授权"}), 401
+        args = quart.request.args
+        limit = min(args.get("limit", 50, type=int), 500)
+        # SQLite 查询会阻塞，放到线程里进行
+        rows = await asyncio.get_running_loop().run_in_executor(
+            None, consultation_journal.archive.query, args.get("date"), args.get("department"), limit
+        )
+        return quart.jsonify({"consultations": rows})
+
+    @asgi_app.route('/cache/stats')
+    async def async_cache_stats():
+        return quart.jsonify(completion_cache.stats())
+
+    @asgi_app.route('/llm/stats')
+    async def async_llm_stats():
+        return quart.jsonify(llm_call_stats())
+
+    @asgi_app.websocket('/voice_stream')
+    async def async_voice_stream():
+        """voice_stream 的异步版本，识别在语音线程池中执行"""
+        ws = quart.websocket
+        session_id = aget_session_id(ws)
+        voice = VoiceStream()
+        last_partial = ""
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(ws.receive(), VOICE_STREAM_IDLE_SECONDS)
+                except asyncio.TimeoutError:
+                    break
+                if isinstance(message, str):
+                    break
+                partial, ended = await asyncio.wait_for(
+                    asyncio.wrap_future(asr_executor.submit(voice.feed, message)), ASR_TIMEOUT_SECONDS
+                )
+                if partial and partial != last_partial:
+                    last_partial = partial
+                    await ws.send(voice_event("partial", partial))
+                if ended:
+                    break
+            query = await asyncio.wait_for(asyncio.wrap_future(asr_executor.submit(voice.finish)), ASR_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logging.error("语音识别超时")
+            await ws.send(voice_event("done", "语音识别超时"))
+            return
+        await ws.send(voice_event("final", query))
+        async with conversation_store.async_lock(session_id):
+            _current_session_id.set(session_id)
+            session = conversation_store.load(session_id)
+            stream = arefine_response_stream(query, session["history"], session.setdefault("summary", new_summary()))
+            try:
+                async for event, text in stream:
+                    await ws.send(voice_event(event, text))
+            finally:
+                await stream.aclose()
+                save_streamed_turn(session_id, session)
+
+
+def check_config() -> None:
+    """启动时检查部署配置，问题写入日志"""
+    if not MOONSHOT_API_KEY:
+        logging.error("未设置环境变量 MOONSHOT_API_KEY，模型调用将全部失败")
+    if SESSION_BACKEND == "memory":
+        logging.warning("会话保存在进程内存中，多个工作进程之间不共享；多进程部署请使用 sqlite 或 redis 后端")
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # 开发用入口：单进程；生产部署见 README 中的 gunicorn 命令（wsgi.py / asgi.py 直接使用 app / asgi_app）
+    check_config()
+    if SERVING_MODE == "asgi":
+        if quart is None:
+            raise RuntimeError("ASGI 服务需要安装 quart")
+        import uvicorn
+        uvicorn.run(asgi_app, host="127.0.0.1", port=5000)
+    else:
+        app.run(debug=DEBUG)
 
 
@@ -0,0 +1,10 @@
+"""生产环境 ASGI 入口
+
+用法：gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+或：uvicorn asgi:app --workers 4
+"""
+from wsgi import triage_app  # 导入 wsgi 时已加载主程序并检查部署配置
+
+if triage_app.quart is None:
+    raise RuntimeError("ASGI 服务需要安装 quart")
+app = triage_app.asgi_app
@@ -0,0 +1,18 @@
+"""基准测试脚本共用：按文件路径加载应用模块（主程序文件名含空格，无法直接 import）"""
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(ROOT, "Intelligent triage based on AI .py")
+
+
+def load_app(module_name: str = "triage_app"):
+    """加载并返回应用模块，重复调用时返回同一个模块"""
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
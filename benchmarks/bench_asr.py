@@ -0,0 +1,71 @@
+"""语音识别后端的实时率（RTF）基准：RTF = 识别耗时 / 音频时长，小于 1 表示快于实时
+
+用法：python benchmarks/bench_asr.py --backend vosk [--model 模型目录] [clip.wav ...]
+
+未给出音频文件时使用合成的 5 秒噪声片段，只用于衡量解码速度，不评估识别准确率。
+WAV 需为 16 kHz 单声道 16 位 PCM。
+"""
+import argparse
+import logging
+import math
+import random
+import struct
+import time
+import wave
+
+from _app import load_app
+
+
+def read_wav(path: str) -> bytes:
+    with wave.open(path, "rb") as f:
+        if f.getnchannels() != 1 or f.getsampwidth() != 2 or f.getframerate() != 16000:
+            raise SystemExit(f"{path}: 需要 16 kHz 单声道 16 位 PCM")
+        return f.readframes(f.getnframes())
+
+
+def synthetic_clip(seconds: float = 5.0, sample_rate: int = 16000) -> bytes:
+    """合成带起伏的噪声，避免被当作静音直接跳过"""
+    rng = random.Random(0)
+    samples = (
+        int(8000 * math.sin(i / sample_rate * 2 * math.pi * 3) * rng.uniform(-1, 1))
+        for i in range(int(seconds * sample_rate))
+    )
+    return b"".join(struct.pack("<h", s) for s in samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("clips", nargs="*", help="16 kHz 单声道 WAV 文件")
+    parser.add_argument("--backend", default="vosk", choices=["vosk", "google"])
+    parser.add_argument("--model", help="Vosk 模型目录，默认使用应用配置的 VOSK_MODEL_PATH")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="每个片段重复识别的次数")
+    args = parser.parse_args()
+
+    app = load_app()
+    logging.disable(logging.ERROR)
+    if args.backend == "vosk":
+        load_start = time.perf_counter()
+        backend = app.VoskASRBackend(args.model or app.VOSK_MODEL_PATH)
+        print(f"模型加载耗时 {time.perf_counter() - load_start:.2f}s（启动时一次性开销）")
+    else:
+        backend = app.GoogleASRBackend()
+
+    clips = {path: read_wav(path) for path in args.clips} or {"合成噪声 5s": synthetic_clip()}
+    print(f"{'片段':<24}{'时长(s)':>8}{'耗时(s)':>10}{'RTF':>8}  结果")
+    for name, pcm in clips.items():
+        duration = len(pcm) / 2 / app.ASR_SAMPLE_RATE
+        costs = []
+        text = ""
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            try:
+                text = backend.transcribe(pcm, app.ASR_SAMPLE_RATE)
+            except app.sr.UnknownValueError:
+                text = "（未识别出内容）"
+            costs.append(time.perf_counter() - start)
+        cost = sorted(costs)[len(costs) // 2]  # 取中位数
+        print(f"{name:<24}{duration:>8.2f}{cost:>10.3f}{cost / duration:>8.3f}  {text}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""首页与静态资源的每秒请求数
+
+通过 Flask 测试客户端走完整的 WSGI 处理流程（不含网络），对比：
+- 预渲染的首页（原始 / gzip / brotli / 304 协商缓存）
+- 每次请求重新编译模板（改造前 render_template_string 的做法，页面内联 CSS 与 JS）
+- 带版本号的静态资源
+
+用法：python benchmarks/bench_index.py [-d 每项持续秒数]
+"""
+import argparse
+import logging
+import os
+import time
+
+from _app import load_app
+
+
+def inline_page(app) -> str:
+    """把首页模板中引用的样式和脚本内联回去，还原改造前整页模板的规模"""
+    with open(os.path.join(app.TEMPLATE_DIR, "index.html"), encoding="utf-8") as f:
+        source = f.read()
+    styles, scripts = [], []
+    for path, asset in app.static_assets.items():
+        text = asset.variants["identity"].decode("utf-8", errors="ignore")
+        if path == "css/app.css":
+            styles.append(text)
+        elif path.startswith("js/"):
+            scripts.append(text)
+    lines = [line for line in source.splitlines() if "asset_url(" not in line]
+    head_end = lines.index("</head>")
+    lines[head_end:head_end] = ["<style>", *styles, "</style>"]
+    body_end = lines.index("</body>")
+    lines[body_end:body_end] = ["<script>", *scripts, "</script>"]
+    return "\n".join(lines)
+
+
+def measure(client, url: str, headers: dict, duration: float) -> tuple:
+    """返回 (每秒请求数, 响应字节数)"""
+    size = len(client.get(url, headers=headers).data)
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for _ in range(100):
+            client.get(url, headers=headers)
+        count += 100
+    return count / (time.perf_counter() - start), size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-d", "--duration", type=float, default=2.0)
+    args = parser.parse_args()
+
+    app = load_app()
+    logging.disable(logging.WARNING)
+    page = inline_page(app)
+
+    from flask import render_template_string
+
+    @app.app.route("/_bench_render_each_time")
+    def render_each_time():
+        return render_template_string(page)
+
+    client = app.app.test_client()
+    etag = client.get("/", headers={"Accept-Encoding": "br"}).headers["ETag"]
+    app_js = f"/static/js/app.js?v={app.static_assets['js/app.js'].digest}"
+    cases = [
+        ("每次编译模板", "/_bench_render_each_time", {}),
+        ("预渲染 原始", "/", {}),
+        ("预渲染 gzip", "/", {"Accept-Encoding": "gzip"}),
+        ("预渲染 br", "/", {"Accept-Encoding": "gzip, br"}),
+        ("预渲染 304", "/", {"Accept-Encoding": "gzip, br", "If-None-Match": etag}),
+        ("app.js br", app_js, {"Accept-Encoding": "gzip, br"}),
+    ]
+    print(f"{'场景':<12}{'请求/秒':>10}{'响应字节':>10}")
+    for name, url, headers in cases:
+        rps, size = measure(client, url, headers, args.duration)
+        print(f"{name:<12}{rps:>10.0f}{size:>10}")
+
+
+if __name__ == "__main__":
+    main()
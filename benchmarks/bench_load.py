@@ -0,0 +1,307 @@
+"""整套问诊流程的离线压测：本地模拟 Moonshot 与语音识别，回放脚本化的多轮问诊
+
+在进程内用多线程 WSGI 服务器启动应用，模型接口指向 fake_moonshot（可配置首字延迟分布与输出速度），
+多个并发患者按脚本各自完成若干次问诊（文字或语音），统计每轮耗时 p50/p95/p99、
+吞吐、每次问诊的模型调用次数与每轮提示中命中前缀缓存的 token 数；病历转入后台生成时像页面一样订阅推送，另计病历的等待时间。
+
+语音模式为每句回答合成一段 WAV 上传，应用照常解码、重采样、裁剪静音，
+识别这一步换成按音频查表返回脚本文本的本地后端（--asr-rtf 模拟识别耗时），不访问 Google。
+
+用法：python benchmarks/bench_load.py [--mode text|stream|voice] [--concurrency 16] [--rounds 2]
+      [--latency 0.3 --latency-dist lognormal --token-rate 60] [--prefill-rate 0] [--asr-rtf 0.2]
+"""
+import argparse
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import socket
+import struct
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+import wave
+from http.cookiejar import CookieJar
+
+from werkzeug.serving import make_server
+
+from _app import load_app
+from fake_moonshot import LATENCY_DISTS, FakeMoonshotHandler, serve
+
+# 每次问诊的基本信息各不相同，避免回复缓存让后续问诊不经过模型
+INTAKE = "患者基本信息：\n- 性别：{sex}\n- 年龄：{age}岁\n- 职业：{job}{serial}\n- 婚育状况：已婚"
+SCRIPTS = [
+    {
+        "sex": "女", "job": "教师",
+        "answers": [
+            "我头痛三天了",
+            "主要是两侧太阳穴胀痛，下午更明显",
+            "最近加班比较多，睡得晚",
+            "有点恶心，没有呕吐",
+            "以前没有类似情况，也没有慢性病",
+            "平时不抽烟，偶尔喝酒",
+            "休息之后会好一点",
+        ],
+    },
+    {
+        "sex": "男", "job": "工程师",
+        "answers": [
+            "咳嗽一个星期了",
+            "白天咳得多，有少量白痰",
+            "前几天着凉了，有点低烧",
+            "嗓子疼，流鼻涕",
+            "有过敏性鼻炎，没有其他病",
+            "抽烟十年了，每天半包",
+            "吃了止咳糖浆效果一般",
+        ],
+    },
+    {
+        "sex": "女", "job": "会计",
+        "answers": [
+            "肚子疼两天了",
+            "肚脐周围隐隐作痛，饭后明显",
+            "前天吃了路边摊",
+            "拉肚子一天三四次，稀水样",
+            "以前胃不太好，没有做过手术",
+            "不抽烟不喝酒",
+            "喝了点热水稍微好些",
+        ],
+    },
+]
+
+
+RECORD_RETRY_SECONDS = 1.0  # 与页面 EventSource 的重连间隔一致
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else float("nan")
+
+
+def synthesize_wav(seconds: float, pitch: float, sample_rate: int = 16000) -> bytes:
+    """合成一段带包络的音调作为“说话”，前后留静音，每句的时长与音高不同"""
+    silence = int(0.3 * sample_rate)
+    voiced = int(seconds * sample_rate)
+    samples = [0] * silence
+    for i in range(voiced):
+        envelope = math.sin(math.pi * i / voiced)
+        samples.append(int(12000 * envelope * math.sin(2 * math.pi * pitch * i / sample_rate)))
+    samples += [0] * silence
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(struct.pack(f"<{len(samples)}h", *samples))
+    return buffer.getvalue()
+
+
+def make_scripted_asr(app, rtf: float):
+    """按解码后的 PCM 查表返回脚本文本的识别后端，耗时为音频时长乘以 rtf"""
+
+    class ScriptedASRBackend(app.ASRBackend):
+        name = "scripted"
+
+        def __init__(self):
+            self.transcripts = {}
+
+        def register(self, wav: bytes, text: str) -> None:
+            self.transcripts[hashlib.sha1(app.decode_audio(wav)).hexdigest()] = text
+
+        def transcribe(self, pcm: bytes, sample_rate: int = app.ASR_SAMPLE_RATE) -> str:
+            time.sleep(len(pcm) / 2 / sample_rate * rtf)
+            text = self.transcripts.get(hashlib.sha1(pcm).hexdigest())
+            if text is None:
+                raise app.sr.UnknownValueError()
+            return text
+
+    return ScriptedASRBackend()
+
+
+def build_utterances(app, backend) -> dict:
+    """为每句脚本回答合成一段音频并登记到识别后端，返回 文本 -> WAV"""
+    utterances = {}
+    for script in SCRIPTS:
+        for answer in script["answers"]:
+            if answer in utterances:
+                continue
+            n = len(utterances)
+            wav = synthesize_wav(seconds=0.12 * len(answer), pitch=180 + 7 * n)  # 约每秒 8 个字
+            backend.register(wav, answer)
+            utterances[answer] = wav
+    return utterances
+
+
+def multipart(field: str, filename: str, payload: bytes) -> tuple:
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"{filename}\"\r\n"
+        f"Content-Type: audio/wav\r\n\r\n"
+    ).encode() + payload + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+class Patient:
+    """一位模拟患者：按脚本完成问诊，记录每轮耗时"""
+
+    def __init__(self, base_url: str, mode: str, utterances: dict, results: dict):
+        self.base_url = base_url
+        self.mode = mode
+        self.utterances = utterances
+        self.results = results
+
+    def wait_record(self, opener, job_id: str) -> float:
+        """像页面一样订阅后台病历任务的推送，直到收到 done，返回等待的秒数"""
+        start = time.perf_counter()
+        while True:
+            with opener.open(f"{self.base_url}/records/{job_id}/events", timeout=120) as response:
+                if any(line.startswith(b"event: done") for line in response):
+                    return time.perf_counter() - start
+            time.sleep(RECORD_RETRY_SECONDS)
+
+    def send(self, opener, text: str, voice: bool) -> tuple:
+        """发送一轮输入，返回 (总耗时, 首字耗时)；流式模式的首字耗时为收到第一段回复的时间
+
+        本轮结束问诊、病历转入后台生成时，等待病历就绪并把等待时间记入 records。
+        """
+        if voice:
+            data, content_type = multipart("audio_input", "answer.wav", self.utterances[text])
+        else:
+            data, content_type = urllib.parse.urlencode({"text_input": text}).encode(), None
+        path = "/submit_stream" if self.mode == "stream" else "/submit"
+        request = urllib.request.Request(self.base_url + path, data)
+        if content_type:
+            request.add_header("Content-Type", content_type)
+        start = time.perf_counter()
+        first = None
+        job_id = None
+        with opener.open(request, timeout=120) as response:
+            if self.mode != "stream":
+                job_id = json.loads(response.read()).get("record_job")
+            else:
+                event = None
+                for line in response:
+                    if line.startswith(b"event: "):
+                        event = line[7:].strip()
+                    if first is None and event == b"delta":
+                        first = time.perf_counter() - start
+                    if event == b"record_job" and line.startswith(b"data: "):
+                        job_id = json.loads(line[6:])["text"]
+        elapsed = time.perf_counter() - start
+        if job_id is not None:
+            self.results["records"].append(self.wait_record(opener, job_id))
+        return elapsed, first if first is not None else elapsed
+
+    def consult(self, patient_id: int, rounds: int) -> None:
+        for i in range(rounds):
+            script = SCRIPTS[(patient_id + i) % len(SCRIPTS)]
+            opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+            intake = INTAKE.format(sex=script["sex"], age=20 + patient_id % 50, job=script["job"],
+                                   serial=f"{patient_id}-{i}")
+            ok = True
+            # 基本信息总是由表单以文字提交，语音模式只用语音回答问题
+            for n, text in enumerate([intake] + script["answers"]):
+                try:
+                    elapsed, first = self.send(opener, text, voice=self.mode == "voice" and n > 0)
+                except (OSError, ValueError) as e:
+                    status = e.code if isinstance(e, urllib.error.HTTPError) else type(e).__name__
+                    self.results["errors"].append(status)
+                    ok = False
+                    continue
+                self.results["turns"].append(elapsed)
+                self.results["first"].append(first)
+            self.results["consultations"].append(ok)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=("text", "stream", "voice"), default="text",
+                        help="text 走 /submit，stream 走 /submit_stream，voice 上传合成语音")
+    parser.add_argument("-c", "--concurrency", type=int, default=16, help="并发的模拟患者数")
+    parser.add_argument("--rounds", type=int, default=2, help="每位患者完成的问诊次数")
+    parser.add_argument("--latency", type=float, default=0.3, help="模型首字延迟的均值（秒）")
+    parser.add_argument("--latency-dist", choices=LATENCY_DISTS, default="lognormal")
+    parser.add_argument("--latency-spread", type=float, default=0.5,
+                        help="uniform 为上下浮动比例，lognormal 为 sigma")
+    parser.add_argument("--token-rate", type=float, default=60.0, help="模型每秒输出的 token 数，0 表示立即输出")
+    parser.add_argument("--prefill-rate", type=float, default=0.0,
+                        help="模型每秒处理的未命中缓存的提示 token 数，0 表示不计提示处理时间")
+    parser.add_argument("--asr-rtf", type=float, default=0.2, help="语音模式下模拟识别的实时率")
+    parser.add_argument("--llm-rate", type=float, default=0.0,
+                        help="应用端调度器每秒放行的模型请求数，默认不限速以测出应用本身的上限")
+    args = parser.parse_args()
+
+    moonshot_port = free_port()
+    serve(moonshot_port, args.latency, latency_dist=args.latency_dist, latency_spread=args.latency_spread,
+          token_rate=args.token_rate, prefill_rate=args.prefill_rate)
+    os.environ["MOONSHOT_BASE_URL"] = f"http://127.0.0.1:{moonshot_port}/v1"
+    os.environ.setdefault("MOONSHOT_API_KEY", "bench")
+    app = load_app()
+    logging.disable(logging.CRITICAL)
+    app.llm_dispatcher = app.LLMDispatcher(rate=args.llm_rate)
+
+    utterances = {}
+    if args.mode == "voice":
+        app.asr_backend = make_scripted_asr(app, args.asr_rtf)
+        utterances = build_utterances(app, app.asr_backend)
+
+    port = free_port()
+    server = make_server("127.0.0.1", port, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{port}"
+
+    results = {"turns": [], "first": [], "errors": [], "consultations": [], "records": []}
+    patients = [
+        threading.Thread(target=Patient(base_url, args.mode, utterances, results).consult, args=(n, args.rounds))
+        for n in range(args.concurrency)
+    ]
+    calls_before = FakeMoonshotHandler.calls
+    prompt_before, cached_before = FakeMoonshotHandler.prompt_tokens, FakeMoonshotHandler.cached_tokens
+    start = time.perf_counter()
+    for t in patients:
+        t.start()
+    for t in patients:
+        t.join()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    turns, consultations = results["turns"], results["consultations"]
+    llm_calls = FakeMoonshotHandler.calls - calls_before
+    # 提示用量按模拟接口一侧统计（每字一个 token），包含后台病历
+    prompt_tokens = FakeMoonshotHandler.prompt_tokens - prompt_before
+    cached_tokens = FakeMoonshotHandler.cached_tokens - cached_before
+    print(f"模式 {args.mode}，并发患者 {args.concurrency}，每人问诊 {args.rounds} 次，"
+          f"模型首字 {args.latency}s（{args.latency_dist}），输出 {args.token_rate or '不限'} token/s")
+    print(f"完成问诊 {sum(consultations)}/{len(consultations)}，完成轮次 {len(turns)}，失败 {len(results['errors'])}"
+          + (f"（{sorted(set(map(str, results['errors'])))}）" if results["errors"] else ""))
+    print(f"每轮耗时 p50 {percentile(turns, 0.5) * 1000:.0f}ms  p95 {percentile(turns, 0.95) * 1000:.0f}ms"
+          f"  p99 {percentile(turns, 0.99) * 1000:.0f}ms")
+    if args.mode == "stream":
+        first = results["first"]
+        print(f"首段回复 p50 {percentile(first, 0.5) * 1000:.0f}ms  p95 {percentile(first, 0.95) * 1000:.0f}ms"
+              f"  p99 {percentile(first, 0.99) * 1000:.0f}ms")
+    records = results["records"]
+    if records:
+        print(f"后台病历 {len(records)} 份，结束问诊后等待 p50 {percentile(records, 0.5) * 1000:.0f}ms"
+              f"  p95 {percentile(records, 0.95) * 1000:.0f}ms")
+    print(f"吞吐 {len(turns) / elapsed:.1f} 轮/s，{len(consultations) / elapsed * 60:.1f} 次问诊/分钟")
+    print(f"模型调用 {llm_calls} 次，每次问诊 {llm_calls / max(len(consultations), 1):.1f} 次")
+    print(f"每轮提示 {prompt_tokens / max(len(turns), 1):.0f} token，命中前缀缓存 {cached_tokens / max(len(turns), 1):.0f}"
+          f"，未命中 {(prompt_tokens - cached_tokens) / max(len(turns), 1):.0f}（命中率 {cached_tokens / max(prompt_tokens, 1):.1%}）")
+    for route, stats in sorted(app.route_stats.stats().items()):
+        print(f"  {route:<10}{stats['calls']:>6} 次  p50 {stats['p50_ms']:.0f}ms  p95 {stats['p95_ms']:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
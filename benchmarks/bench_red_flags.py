@@ -0,0 +1,81 @@
+"""危急症状检测的单条消息耗时基准
+
+计时前先核对 CASES 中否定、过去时间等表述的检测结果，结果不符时直接报错。
+
+用法：python benchmarks/bench_red_flags.py [-n 迭代次数]
+"""
+import argparse
+import logging
+import time
+
+from _app import load_app
+
+SAMPLES = {
+    "普通短句": "头痛三天了",
+    "普通长句": "最近一周总是头痛，下午比较明显，休息后会好一些，没有发烧，平时经常熬夜加班，饮食也不太规律。" * 3,
+    "否定表述": "没有胸痛，也没有呼吸困难，就是有点咳嗽",
+    "命中危急": "突然胸口剧痛，出了很多汗，左边胳膊也发麻",
+    "命中多项": "刚才晕倒了一次，醒来后嘴歪，说话不清楚",
+    "既往表述": "以前有过胸痛，曾经晕倒过，现在主要是咳嗽",
+}
+# 文本 -> 应当命中的短语；否定与过去时间的表述不计，但不能因此漏掉当前的危急症状
+CASES = {
+    "没有胸痛": [],
+    "无呼吸困难，也不觉得胸痛": [],
+    "否认昏迷": [],
+    "以前有过胸痛": [],
+    "曾经晕倒": [],
+    "过去出现过呕血，这次是普通感冒": [],
+    "没有胸痛，但是呼吸困难": ["呼吸困难"],
+    "以前没事，今天突然胸痛": ["胸痛"],
+    "过去两天一直胸痛": ["胸痛"],
+    "刚才突然晕过去叫不醒": ["晕过去", "叫不醒"],
+    "胸口不舒服，胸痛": ["胸痛"],
+    "突然胸口剧痛，出了很多汗": ["胸口剧痛"],
+    "半小时以前晕倒了，现在还是头晕": ["晕倒"],
+    "两小时以前胸痛，现在还在痛": ["胸痛"],
+    "十分钟以前呕血了，现在头晕": ["呕血"],
+    "很多年以前有过晕厥，今天来看咳嗽": ["晕厥"],
+    "我爸一小时以前突然说不出话": ["说不出话"],
+    "他说话不清，嘴也有点歪": ["说话不清"],
+    "刚才晕过去了": ["晕过去"],
+    "孩子不呼吸了": ["不呼吸"],
+    "老人好像没了呼吸": ["没了呼吸"],
+    "没有呼吸困难，也没有晕过去": [],
+}
+
+
+def check(detect) -> None:
+    """核对 CASES 的检测结果"""
+    for text, expected in CASES.items():
+        phrases = [phrase for _, phrase in detect(text)]
+        assert phrases == expected, f"{text!r}: 期望 {expected}，实际 {phrases}"
+
+
+def bench(detect, text: str, iterations: int) -> float:
+    """返回单次调用的平均耗时（微秒）"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        detect(text)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--iterations", type=int, default=100000)
+    args = parser.parse_args()
+
+    app = load_app()
+    logging.disable(logging.WARNING)
+    check(app.detect_red_flags)
+    print(f"否定与过去时间表述：{len(CASES)} 个用例全部通过")
+    print(f"危急症状词表：{len(app.RED_FLAG_PHRASES)} 个短语，{len(app.RED_FLAG_LEXICON)} 个类别")
+    print(f"{'样例':<8}{'长度':>6}{'耗时(µs)':>12}  命中")
+    for name, text in SAMPLES.items():
+        cost = bench(app.detect_red_flags, text, args.iterations)
+        flags = "、".join(phrase for _, phrase in app.detect_red_flags(text)) or "-"
+        print(f"{name:<8}{len(text):>6}{cost:>12.2f}  {flags}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""模型调用的超时、重试、对冲与熔断在故障注入下的表现
+
+对本地模拟接口依次注入错误、卡死、长尾延迟与整体宕机，
+并发调用 chat_completion，报告成功率与 p50/p95/p99 耗时。
+
+用法：python benchmarks/bench_resilience.py [-n 每个场景的调用次数] [--port 8911]
+"""
+import argparse
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from openai import OpenAI
+
+from _app import load_app
+from fake_moonshot import FakeMoonshotHandler, serve
+
+CONCURRENCY = 8
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def run_calls(app, n: int, kind_priority: int) -> tuple:
+    """并发发起 n 次互不相同的调用，返回 (成功数, 耗时列表)"""
+    def one(_):
+        # 每次调用内容不同，避免命中回复缓存
+        messages = [{"role": "system", "content": "追问"}, {"role": "user", "content": uuid.uuid4().hex}]
+        start = time.perf_counter()
+        try:
+            app.chat_completion(messages, temperature=0.3, priority=kind_priority)
+            ok = True
+        except app.LLMUnavailable:
+            ok = False
+        return ok, time.perf_counter() - start
+
+    with ThreadPoolExecutor(CONCURRENCY) as pool:
+        results = list(pool.map(one, range(n)))
+    return sum(ok for ok, _ in results), [cost for _, cost in results]
+
+
+def report(name: str, app, n: int, priority: int) -> None:
+    before = dict(app.llm_call_counters)
+    ok, costs = run_calls(app, n, priority)
+    after = app.llm_call_counters
+    delta = {key: after[key] - before[key] for key in ("retries", "hedged", "hedge_wins", "short_circuited")}
+    print(
+        f"{name:<22}{ok / n:>8.1%}{percentile(costs, 0.5) * 1000:>9.0f}{percentile(costs, 0.95) * 1000:>9.0f}"
+        f"{percentile(costs, 0.99) * 1000:>9.0f}  重试 {delta['retries']}  对冲 {delta['hedged']}"
+        f"（胜 {delta['hedge_wins']}）  熔断拒绝 {delta['short_circuited']}"
+    )
+
+
+def configure(app, retries: int = 2, hedge: bool = False, timeout: float = 2.0) -> None:
+    app.LLM_MAX_RETRIES = retries
+    app.LLM_HEDGE_MODE = hedge
+    app.LLM_TIMEOUT_SECONDS = timeout
+    app.LLM_BACKOFF_BASE = 0.05
+    app.llm_breaker = app.CircuitBreaker(failures=1000)  # 前几个场景不希望熔断干扰成功率
+    app.llm_latency = app.LatencyTracker()
+
+
+def fault(error_rate=0.0, hang_rate=0.0, tail_rate=0.0, tail_latency=2.0, outage=False) -> None:
+    FakeMoonshotHandler.error_rate = error_rate
+    FakeMoonshotHandler.hang_rate = hang_rate
+    FakeMoonshotHandler.tail_rate = tail_rate
+    FakeMoonshotHandler.tail_latency = tail_latency
+    FakeMoonshotHandler.outage = outage
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--calls", type=int, default=200)
+    parser.add_argument("--port", type=int, default=8911)
+    parser.add_argument("--latency", type=float, default=0.05, help="模拟接口的正常耗时（秒）")
+    args = parser.parse_args()
+
+    serve(args.port, args.latency)
+    app = load_app()
+    logging.disable(logging.CRITICAL)
+    app.client = OpenAI(base_url=f"http://127.0.0.1:{args.port}/v1", api_key="bench", max_retries=0)
+    app.llm_dispatcher = app.LLMDispatcher(rate=0)  # 不限速，只看故障处理本身的影响
+    follow_up = app.PRIORITY_FOLLOW_UP
+
+    print(f"{'场景':<20}{'成功率':>8}{'p50(ms)':>9}{'p95(ms)':>9}{'p99(ms)':>9}")
+    configure(app, retries=0)
+    fault(error_rate=0.2)
+    report("20% 错误，不重试", app, args.calls, follow_up)
+    configure(app, retries=2)
+    report("20% 错误，重试 2 次", app, args.calls, follow_up)
+
+    configure(app, retries=2, timeout=1.0)
+    fault(hang_rate=0.05)
+    report("5% 卡死，超时 1s", app, args.calls, follow_up)
+
+    fault(tail_rate=0.05, tail_latency=2.0)
+    configure(app, hedge=False, timeout=5.0)
+    report("5% 长尾 2s，不对冲", app, args.calls, follow_up)
+    configure(app, hedge=True, timeout=5.0)
+    run_calls(app, 50, follow_up)  # 先积累耗时样本
+    report("5% 长尾 2s，p95 对冲", app, args.calls, follow_up)
+
+    # 整体宕机：连续失败后熔断，之后的调用立即失败并由本地规则兜底
+    configure(app, retries=2)
+    app.llm_breaker = app.CircuitBreaker(failures=5, cooldown=1.0)
+    fault(outage=True)
+    report("宕机，熔断", app, args.calls, follow_up)
+    history = app.new_history() + [
+        {"role": "user", "content": "患者基本信息：\n- 性别：男\n- 年龄：35岁"},
+        {"role": "assistant", "content": "感谢您提供基本信息。请详细描述您目前的主要症状和不适感。"},
+    ]
+    start = time.perf_counter()
+    reply = app.refine_response("我头痛三天了", history)
+    print(f"宕机时的本地兜底回复（{(time.perf_counter() - start) * 1000:.1f}ms）：{reply}")
+    fault()
+    time.sleep(1.0)
+    run_calls(app, 1, follow_up)  # 冷却结束后的第一个调用作为探测请求，探测期间其余调用仍直接兜底
+    report("恢复后（冷却 1s）", app, args.calls, follow_up)
+    print(f"熔断器：{app.llm_breaker.stats()}")
+
+
+if __name__ == "__main__":
+    main()
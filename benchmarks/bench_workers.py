@@ -0,0 +1,143 @@
+"""多进程部署的吞吐随工作进程数的变化
+
+对每个工作进程数分别用 gunicorn 启动 wsgi:app（sqlite 共享会话），
+后端接模拟的 Moonshot 接口，多个并发客户端各自完成若干次完整问诊，
+统计每秒完成的请求数与请求耗时分位数。
+
+用法：python benchmarks/bench_workers.py [--workers 1 2 4] [--threads 4] [--clients 32]
+"""
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from http.cookiejar import CookieJar
+
+from fake_moonshot import serve
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 每次问诊的基本信息各不相同，避免回复缓存让后续问诊不经过模型
+INTAKE = "患者基本信息：\n- 性别：女\n- 年龄：{age}岁\n- 职业：教师{serial}\n- 婚育状况：已婚"
+ANSWERS = [
+    "我头痛三天了",
+    "主要是两侧太阳穴胀痛，下午更明显",
+    "最近加班比较多，睡得晚",
+    "有点恶心，没有呕吐",
+    "以前没有类似情况，也没有慢性病",
+    "平时不抽烟，偶尔喝酒",
+    "休息之后会好一点",
+]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url: str, process: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn 已退出，返回码 {process.returncode}")
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"服务未能启动: {url}")
+
+
+def consult(base_url: str, client_id: int, rounds: int, latencies: list, errors: list) -> None:
+    """模拟一位患者完成若干次问诊，每次问诊使用新的会话"""
+    for i in range(rounds):
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+        intake = INTAKE.format(age=20 + client_id % 50, serial=f"{client_id}-{i}")
+        for text in [intake] + ANSWERS:
+            data = urllib.parse.urlencode({"text_input": text}).encode()
+            start = time.perf_counter()
+            try:
+                opener.open(f"{base_url}/submit", data, timeout=120).read()
+            except OSError as e:
+                errors.append(e)
+                continue
+            latencies.append(time.perf_counter() - start)
+
+
+def run(workers: int, args, moonshot_url: str) -> dict:
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix="triage-bench-")
+    env = dict(
+        os.environ,
+        MOONSHOT_BASE_URL=moonshot_url,
+        MOONSHOT_API_KEY="bench",
+        SESSION_BACKEND="sqlite",
+        SESSION_DB_PATH=os.path.join(workdir, "sessions.db"),
+        BIND=f"127.0.0.1:{port}",
+        WEB_CONCURRENCY=str(workers),
+        THREADS=str(args.threads),
+        LOG_LEVEL="WARNING",
+        ACCESS_LOG="",
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--log-level", "warning", "wsgi:app"],
+        cwd=ROOT, env=env,
+    )
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        wait_ready(base_url + "/", server)
+        latencies, errors = [], []
+        clients = [
+            threading.Thread(target=consult, args=(base_url, n, args.rounds, latencies, errors))
+            for n in range(args.clients)
+        ]
+        start = time.perf_counter()
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+    latencies.sort()
+
+    def pct(p):
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000 if latencies else float("nan")
+
+    return {
+        "workers": workers, "requests": len(latencies), "errors": len(errors),
+        "rps": len(latencies) / elapsed, "p50": pct(0.5), "p95": pct(0.95), "p99": pct(0.99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, default=4, help="每个工作进程的线程数")
+    parser.add_argument("--clients", type=int, default=32, help="并发的模拟患者数")
+    parser.add_argument("--rounds", type=int, default=2, help="每位患者完成的问诊次数")
+    parser.add_argument("--latency", type=float, default=0.2, help="模拟模型每次调用的耗时（秒）")
+    args = parser.parse_args()
+
+    moonshot_port = free_port()
+    serve(moonshot_port, args.latency)
+    moonshot_url = f"http://127.0.0.1:{moonshot_port}/v1"
+    print(f"线程/进程 {args.threads}，并发患者 {args.clients}，每人问诊 {args.rounds} 次，模型延迟 {args.latency}s")
+    print(f"{'进程数':>6}{'请求数':>8}{'失败':>6}{'吞吐(req/s)':>14}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+    for workers in args.workers:
+        r = run(workers, args, moonshot_url)
+        print(f"{r['workers']:>6}{r['requests']:>8}{r['errors']:>6}{r['rps']:>14.1f}"
+              f"{r['p50']:>10.0f}{r['p95']:>10.0f}{r['p99']:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""模拟 Moonshot 的 OpenAI 兼容接口，用于压测，不消耗真实额度
+
+按系统提示区分调用类型（完整性检查、追问、病历、摘要）返回固定格式的回复，
+每次调用先等待首字延迟（--latency，可按 --latency-dist 取固定值、均匀分布或对数正态分布），
+再按 --token-rate 的速度逐段输出（每字按一个 token 计），支持流式输出。
+可按比例注入故障：返回 500/429、长时间不响应、偶发的长尾延迟，用于验证超时、重试与熔断；
+测试中也可用 FakeMoonshotHandler.script 指定接下来几次调用依次出现的故障。
+模拟服务商的自动前缀缓存：与之前的请求相同的提示前缀按 64 字对齐计入 usage 的 cached_tokens，
+未命中的部分按 --prefill-rate 的速度额外计时，用于衡量提示布局对缓存命中的影响。
+
+用法：python benchmarks/fake_moonshot.py [--port 8900] [--latency 0.5]
+      [--latency-dist lognormal --latency-spread 0.5] [--token-rate 40]
+      [--error-rate 0.2] [--hang-rate 0.05] [--tail-rate 0.05 --tail-latency 3]
+      [--prefill-rate 5000] [--no-prefix-cache]
+应用端设置 MOONSHOT_BASE_URL=http://127.0.0.1:8900/v1 即可
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FOLLOW_UP = "请问这种情况持续多久了？有没有什么诱因？"
+CHECK_QUESTION = "这种情况是从什么时候开始的？"
+RECORD_FIELDS = {
+    "chief_complaint": "头痛3天",
+    "onset": "3天前起病，每天发作2到3次",
+    "characteristics": "双侧颞部胀痛，持续数小时，疼痛程度中等，逐渐加重",
+    "triggers": "近期熬夜、工作压力大；休息后稍有缓解",
+    "accompanying": "偶有恶心，无呕吐、发热；影响工作和睡眠",
+    "past_history": "无高血压、糖尿病等慢性病史",
+    "family_history": "母亲有偏头痛史",
+    "allergies": "否认药物过敏史",
+    "diagnosis": "紧张型头痛可能性大，需排除偏头痛",
+    "department": "神经内科",
+    "advice": "尽快到神经内科就诊，必要时完善头颅CT检查",
+    "precautions": "规律作息，避免熬夜；如出现剧烈头痛、呕吐或肢体无力请立即就医",
+}
+# 直接输出整份 Markdown 时的回复（STRUCTURED_RECORD_MODE 关闭时使用），内容与 RECORD_FIELDS 相同
+MEDICAL_RECORD = (
+    "# 门诊病历记录\n\n**就诊时间：** 2024-01-01 09:00\n\n## 主诉\n{chief_complaint}\n\n## 现病史\n"
+    "1. **发病时间：** {onset}\n2. **症状特点：** {characteristics}\n3. **诱因分析：** {triggers}\n"
+    "4. **伴随症状：** {accompanying}\n\n## 既往史\n- **疾病史：** {past_history}\n- **家族史：** {family_history}\n"
+    "- **过敏史：** {allergies}\n\n## 初步诊断\n{diagnosis}\n\n## 就诊建议\n1. **建议科室：** {department}\n"
+    "2. **就医建议：** {advice}\n3. **注意事项：** {precautions}"
+).format(**RECORD_FIELDS)
+SUMMARY = {"主要症状": "头痛", "持续时间": "三天"}
+COMPLETE_AFTER_ROUNDS = 6  # 患者回答达到该轮数后完整性检查返回 True
+HANG_SECONDS = 120  # 注入的“卡死”请求的挂起时长
+LATENCY_DISTS = ("fixed", "uniform", "lognormal")
+CACHE_BLOCK = 64  # 前缀缓存的粒度（字）
+CACHE_CAPACITY = 100_000  # 最多记住的前缀块数，超出后按最近最少使用淘汰
+FAULTS = ("ok", "error", "429", "hang", "tail")  # script 中可用的故障，ok 表示正常应答
+
+
+def reply_for(messages: list) -> str:
+    """根据提示内容生成对应调用类型的回复"""
+    system = messages[0]["content"] if messages else ""
+    if "问诊摘要" in system:
+        return json.dumps(SUMMARY, ensure_ascii=False)
+    if "完整性" in system:
+        rounds = messages[-1]["content"].count("患者：")
+        if rounds > COMPLETE_AFTER_ROUNDS:
+            return json.dumps({"complete": True, "missing": [], "next_question": ""}, ensure_ascii=False)
+        return json.dumps({"complete": False, "missing": ["持续时间"], "next_question": CHECK_QUESTION}, ensure_ascii=False)
+    if "病历记录" in system:
+        # 结构化病历的提示要求只输出字段 JSON
+        return json.dumps(RECORD_FIELDS, ensure_ascii=False) if "JSON" in system else MEDICAL_RECORD
+    return FOLLOW_UP
+
+
+class PrefixCache:
+    """按 CACHE_BLOCK 字对齐记住出现过的提示前缀；新请求与之前的请求相同的最长前缀即为命中的部分"""
+
+    def __init__(self, block: int = CACHE_BLOCK, capacity: int = CACHE_CAPACITY):
+        self.block = block
+        self.capacity = capacity
+        self._blocks = OrderedDict()  # 前缀摘要 -> None
+        self._lock = threading.Lock()
+
+    def match(self, text: str) -> int:
+        """返回命中的前缀长度（字），并记住本次提示的各个前缀"""
+        digest = hashlib.sha1()
+        keys = []
+        for end in range(self.block, len(text) + 1, self.block):
+            digest.update(text[end - self.block:end].encode())
+            keys.append(digest.copy().digest())
+        hit = 0
+        with self._lock:
+            for key in keys:
+                if key not in self._blocks:
+                    break
+                hit += 1
+            for key in keys:
+                self._blocks[key] = None
+                self._blocks.move_to_end(key)
+            while len(self._blocks) > self.capacity:
+                self._blocks.popitem(last=False)
+        return hit * self.block
+
+    def clear(self) -> None:
+        with self._lock:
+            self._blocks.clear()
+
+
+class FakeMoonshotHandler(BaseHTTPRequestHandler):
+    latency = 0.5  # 首字延迟的均值（秒）
+    latency_dist = "fixed"
+    latency_spread = 0.5  # uniform 为相对均值的上下浮动比例，lognormal 为 sigma
+    token_rate = 0.0  # 每秒输出的 token 数，0 表示整段回复立即输出
+    error_rate = 0.0  # 返回 500 或 429 的比例
+    hang_rate = 0.0  # 挂起 HANG_SECONDS 不响应的比例，模拟服务商卡死
+    tail_rate = 0.0  # 耗时变为 tail_latency 的比例，模拟长尾
+    tail_latency = 3.0
+    outage = False  # 为 True 时所有调用返回 503
+    retry_after = None  # 返回 429 时附带的 Retry-After 秒数，None 表示不附带
+    script = []  # 接下来的调用依次取用的故障（见 FAULTS），取完后再按比例注入
+    prefill_rate = 0.0  # 每秒处理的未命中缓存的提示 token 数，0 表示不计提示处理时间
+    prefix_cache = PrefixCache()  # 为 None 时不模拟前缀缓存
+    calls = 0
+    failures = 0
+    prompt_tokens = 0  # 成功应答的调用累计的提示 token 数
+    cached_tokens = 0  # 其中命中前缀缓存的部分
+    _guard = threading.Lock()
+    _random = random.Random(0)
+
+    def log_message(self, *args):
+        pass
+
+    @classmethod
+    def sample_latency(cls) -> float:
+        """按配置的分布抽取一次首字延迟"""
+        if cls.latency <= 0 or cls.latency_dist == "fixed":
+            return max(cls.latency, 0.0)
+        with cls._guard:
+            if cls.latency_dist == "uniform":
+                return cls.latency * cls._random.uniform(1 - cls.latency_spread, 1 + cls.latency_spread)
+            # 对数正态：均值保持为 latency，spread 越大长尾越重
+            sigma = cls.latency_spread
+            return cls.latency * cls._random.lognormvariate(-sigma * sigma / 2, sigma)
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if not self.path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        cls = FakeMoonshotHandler
+        with self._guard:
+            cls.calls += 1
+            fault = cls.script.pop(0) if cls.script else None
+            roll = self._random.random()
+        if fault is None:
+            # 未指定故障时按比例抽取
+            if cls.outage or roll < cls.error_rate:
+                fault = "429" if roll < cls.error_rate / 4 else "error"
+            elif roll - cls.error_rate < cls.hang_rate:
+                fault = "hang"
+            elif roll - cls.error_rate < cls.hang_rate + cls.tail_rate:
+                fault = "tail"
+        if fault in ("error", "429"):
+            with self._guard:
+                cls.failures += 1
+            status = 429 if fault == "429" else (503 if cls.outage else 500)
+            headers = {"Retry-After": str(cls.retry_after)} if status == 429 and cls.retry_after is not None else None
+            self._send_json(status, {"error": {"message": "injected failure", "type": "server_error"}}, headers)
+            return
+        if fault == "hang":
+            time.sleep(HANG_SECONDS)  # 客户端早已超时断开，不再响应
+            self.close_connection = True
+            return
+        if fault == "tail":
+            time.sleep(cls.tail_latency)
+        text = reply_for(request["messages"])
+        finish_reason = "stop"
+        if request.get("max_tokens") and len(text) > request["max_tokens"]:  # 按每字一个 token 粗略截断
+            text, finish_reason = text[:request["max_tokens"]], "length"
+        # 提示按消息顺序拼接后匹配前缀；角色与分隔符不计入 token
+        prompt = "".join(f"\x00{m['role']}\x00{m['content']}" for m in request["messages"])
+        prompt_tokens = sum(len(m["content"]) for m in request["messages"])
+        cached_tokens = min(cls.prefix_cache.match(prompt), prompt_tokens) if cls.prefix_cache is not None else 0
+        prefill = (prompt_tokens - cached_tokens) / cls.prefill_rate if cls.prefill_rate > 0 else 0.0
+        with self._guard:
+            cls.prompt_tokens += prompt_tokens
+            cls.cached_tokens += cached_tokens
+        time.sleep(self.sample_latency() + prefill)
+        # 与 Moonshot 相同，命中缓存的 token 数放在 usage 顶层的 cached_tokens
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(text), "total_tokens": prompt_tokens + len(text),
+                 "cached_tokens": cached_tokens}
+        if not request.get("stream"):
+            if cls.token_rate > 0:
+                time.sleep(len(text) / cls.token_rate)
+            self._send_json(200, {
+                "id": "fake", "object": "chat.completion", "created": int(time.time()), "model": request["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": finish_reason}],
+                "usage": usage,
+            })
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for i in range(0, len(text), 4):
+            if cls.token_rate > 0:
+                time.sleep(len(text[i:i + 4]) / cls.token_rate)
+            chunk = {
+                "id": "fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": request["model"],
+                "choices": [{"index": 0, "delta": {"content": text[i:i + 4]}, "finish_reason": None}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            self.wfile.flush()
+        # 与 Moonshot 相同，用量放在最后一个分段的 choices[0] 中
+        chunk = {
+            "id": "fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": request["model"],
+            "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason, "usage": usage}],
+        }
+        self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+def serve(port: int, latency: float, error_rate: float = 0.0, hang_rate: float = 0.0,
+          tail_rate: float = 0.0, tail_latency: float = 3.0, latency_dist: str = "fixed",
+          latency_spread: float = 0.5, token_rate: float = 0.0, prefill_rate: float = 0.0,
+          prefix_cache: bool = True) -> ThreadingHTTPServer:
+    """在后台线程启动模拟服务并返回服务器对象"""
+    if latency_dist not in LATENCY_DISTS:
+        raise ValueError(f"未知的延迟分布: {latency_dist}")
+    FakeMoonshotHandler.latency = latency
+    FakeMoonshotHandler.latency_dist = latency_dist
+    FakeMoonshotHandler.latency_spread = latency_spread
+    FakeMoonshotHandler.token_rate = token_rate
+    FakeMoonshotHandler.error_rate = error_rate
+    FakeMoonshotHandler.hang_rate = hang_rate
+    FakeMoonshotHandler.tail_rate = tail_rate
+    FakeMoonshotHandler.tail_latency = tail_latency
+    FakeMoonshotHandler.prefill_rate = prefill_rate
+    FakeMoonshotHandler.prefix_cache = PrefixCache() if prefix_cache else None
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeMoonshotHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.5, help="首字延迟的均值（秒）")
+    parser.add_argument("--latency-dist", choices=LATENCY_DISTS, default="fixed", help="首字延迟的分布")
+    parser.add_argument("--latency-spread", type=float, default=0.5,
+                        help="uniform 为上下浮动比例，lognormal 为 sigma")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="每秒输出的 token 数，0 表示立即输出")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 500/429 的比例")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="长时间不响应的比例")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="出现长尾延迟的比例")
+    parser.add_argument("--tail-latency", type=float, default=3.0, help="长尾延迟（秒）")
+    parser.add_argument("--prefill-rate", type=float, default=0.0,
+                        help="每秒处理的未命中缓存的提示 token 数，0 表示不计提示处理时间")
+    parser.add_argument("--no-prefix-cache", action="store_true", help="不模拟前缀缓存，cached_tokens 恒为 0")
+    args = parser.parse_args()
+    serve(args.port, args.latency, args.error_rate, args.hang_rate, args.tail_rate, args.tail_latency,
+          args.latency_dist, args.latency_spread, args.token_rate, args.prefill_rate, not args.no_prefix_cache)
+    print(f"模拟 Moonshot 接口：http://127.0.0.1:{args.port}/v1"
+          f"（首字延迟 {args.latency}s {args.latency_dist}，输出 {args.token_rate or '不限'} token/s）")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+"""gunicorn 配置，参数均可用环境变量覆盖
+
+用法：gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+# 工作进程数：默认每个 CPU 核两个
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2))
+# 请求大部分时间在等待模型返回，每个进程用多线程承接并发问诊
+worker_class = os.environ.get("WORKER_CLASS", "gthread")
+threads = int(os.environ.get("THREADS", 16))
+# 流式回复和语音识别可能持续较久
+timeout = int(os.environ.get("TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5
+# 每个进程自行加载应用：线程池、HTTP 连接池和数据库连接都不能跨 fork 共享
+preload_app = False
+accesslog = os.environ.get("ACCESS_LOG", "-") or None  # 设为空字符串关闭访问日志
+
+
+def on_starting(server):
+    # 多进程时会话必须放在共享存储中，否则同一问诊的请求落到不同进程会丢失上下文
+    if workers > 1 and os.environ.get("SESSION_BACKEND", "memory") == "memory":
+        raise RuntimeError("多进程部署请设置 SESSION_BACKEND=sqlite 或 SESSION_BACKEND=redis")
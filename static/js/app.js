@@ -0,0 +1,417 @@
+let mediaRecorder;
+let audioChunks = [];
+let isRecording = false;
+let voiceCapture = null;  // 流式语音输入时的 { socket, context, processor, stream }
+
+function showHelp() {
+    const helpContent = `
+# 智能导诊系统使用帮助
+
+## 基本操作
+1. **文字输入**
+   - 在底部输入框输入症状描述
+   - 按发送按钮或回车键提交
+
+2. **语音输入**
+   - 点击"语音输入"按钮开始说话，识别结果实时显示
+   - 说完停顿片刻即自动发送，也可再次点击提前结束
+
+## 问诊流程
+1. 系统会引导您描述主要症状
+2. 根据您的回答进行追问
+3. 收集足够信息后生成诊断建议
+4. 推荐合适的就诊科室
+
+## 注意事项
+- 请尽可能详细描述症状
+- 如遇紧急情况请立即就医
+- 系统建议仅供参考
+`;
+    addMessage(helpContent);
+}
+
+function addMessage(content, isUser = false) {
+    const chatContainer = document.getElementById('chat-container');
+    const messageDiv = document.createElement('div');
+    messageDiv.className = 'message';
+
+    const now = new Date();
+    const time = now.toLocaleTimeString('zh-CN', { hour: '2-digit', minute: '2-digit' });
+
+    const avatar = `
+        <div class="message-avatar ${isUser ? 'user-avatar' : 'bot-avatar'}">
+            <i class="fas ${isUser ? 'fa-user' : 'fa-user-md'}"></i>
+        </div>
+    `;
+
+    // 处理 Markdown 内容
+    const formattedContent = isUser ? content : renderMarkdown(content);
+
+    const messageContent = `
+        <div class="message-content ${isUser ? 'user-message' : 'bot-message'}">
+            ${formattedContent}
+            <div class="message-time">${time}</div>
+        </div>
+    `;
+
+    messageDiv.innerHTML = isUser ? messageContent + avatar : avatar + messageContent;
+    chatContainer.appendChild(messageDiv);
+    chatContainer.scrollTop = chatContainer.scrollHeight;
+    return messageDiv;
+}
+
+// 流式输出时用累计的内容重新渲染机器人消息
+function renderBotMessage(messageDiv, content) {
+    const chatContainer = document.getElementById('chat-container');
+    const contentDiv = messageDiv.querySelector('.message-content');
+    const timeDiv = contentDiv.querySelector('.message-time');
+    contentDiv.innerHTML = renderMarkdown(content);
+    contentDiv.appendChild(timeDiv);
+    chatContainer.scrollTop = chatContainer.scrollHeight;
+}
+
+// 病历在后台生成：订阅推送，病历就绪后替换“正在生成”的提示
+function watchRecordJob(jobId, botMessage) {
+    const source = new EventSource(`/records/${jobId}/events`);
+    source.addEventListener('done', event => {
+        source.close();
+        renderBotMessage(botMessage, JSON.parse(event.data).text);
+    });
+    source.onerror = () => {
+        // 病历未就绪时服务端会断开，浏览器自动重连；任务不存在等错误时连接关闭，不再重连
+        if (source.readyState === EventSource.CLOSED) {
+            renderBotMessage(botMessage, '抱歉，病历生成失败，请重新问诊。');
+        }
+    };
+}
+
+// 解析一条 SSE 事件，返回 { type, text }
+function parseServerEvent(rawEvent) {
+    let type = 'message';
+    const dataLines = [];
+    for (const line of rawEvent.split('\n')) {
+        if (line.startsWith('event:')) {
+            type = line.slice(6).trim();
+        } else if (line.startsWith('data:')) {
+            dataLines.push(line.slice(5).trim());
+        }
+    }
+    if (!dataLines.length) {
+        return null;
+    }
+    return { type, text: JSON.parse(dataLines.join('\n')).text };
+}
+
+document.getElementById('record_button').addEventListener('click', () => {
+    if (!isRecording) {
+        startRecording();
+    } else {
+        stopRecording();
+    }
+});
+
+async function startRecording() {
+    let stream;
+    try {
+        stream = await navigator.mediaDevices.getUserMedia({ audio: true });
+    } catch (error) {
+        console.error('录音失败:', error);
+        alert('无法访问麦克风，请检查权限设置');
+        return;
+    }
+    // 优先边说边识别，WebSocket 不可用时退回录完再上传
+    try {
+        await startStreamingRecording(stream);
+    } catch (error) {
+        console.warn('流式语音不可用，改为整段上传:', error);
+        try {
+            startUploadRecording(stream);
+        } catch (error) {
+            console.error('录音失败:', error);
+            stream.getTracks().forEach(track => track.stop());
+            alert('当前浏览器不支持录音');
+            return;
+        }
+    }
+    isRecording = true;
+    const recordButton = document.getElementById('record_button');
+    recordButton.classList.add('recording');
+    recordButton.innerHTML = '<i class="fas fa-stop"></i> 停止录音';
+}
+
+// 把浏览器采样率的浮点音频降采样为 16 kHz 的 16 位 PCM
+function downsampleToInt16(input, inputRate) {
+    const ratio = inputRate / 16000;
+    const output = new Int16Array(Math.floor(input.length / ratio));
+    for (let i = 0; i < output.length; i++) {
+        // 对落在同一输出采样内的输入取平均，起到简单的低通作用
+        const start = Math.floor(i * ratio);
+        const end = Math.min(Math.max(Math.floor((i + 1) * ratio), start + 1), input.length);
+        let sum = 0;
+        for (let j = start; j < end; j++) {
+            sum += input[j];
+        }
+        const sample = Math.max(-1, Math.min(1, sum / (end - start)));
+        output[i] = sample < 0 ? sample * 0x8000 : sample * 0x7fff;
+    }
+    return output;
+}
+
+function openVoiceSocket() {
+    const protocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
+    const socket = new WebSocket(`${protocol}//${location.host}/voice_stream`);
+    socket.binaryType = 'arraybuffer';
+    return new Promise((resolve, reject) => {
+        socket.onopen = () => resolve(socket);
+        socket.onerror = reject;
+    });
+}
+
+function stopVoiceCapture() {
+    if (!voiceCapture) {
+        return;
+    }
+    voiceCapture.processor.disconnect();
+    voiceCapture.context.close();
+    voiceCapture.stream.getTracks().forEach(track => track.stop());
+    voiceCapture = null;
+    resetRecordButton();
+}
+
+async function startStreamingRecording(stream) {
+    const socket = await openVoiceSocket();
+    const context = new AudioContext();
+    const source = context.createMediaStreamSource(stream);
+    const processor = context.createScriptProcessor(4096, 1, 1);
+    processor.onaudioprocess = event => {
+        if (socket.readyState === WebSocket.OPEN) {
+            socket.send(downsampleToInt16(event.inputBuffer.getChannelData(0), context.sampleRate).buffer);
+        }
+    };
+    source.connect(processor);
+    processor.connect(context.destination);
+    voiceCapture = { socket, context, processor, stream };
+
+    // 中间结果实时显示在患者消息里，说完后按 /submit_stream 的方式渲染回复
+    let userMessage = null;
+    let thinkingAnimation = null;
+    let botMessage = null;
+    let answer = '';
+    let recordJob = null;
+    socket.onmessage = event => {
+        const message = JSON.parse(event.data);
+        if (message.type === 'record_job') {
+            recordJob = message.text;
+            return;
+        }
+        if (message.type === 'partial' || message.type === 'final') {
+            if (!userMessage) {
+                userMessage = addMessage('', true);
+            }
+            const contentDiv = userMessage.querySelector('.message-content');
+            contentDiv.firstChild.textContent = message.text;
+            if (message.type === 'final') {
+                stopVoiceCapture();
+                thinkingAnimation = showThinkingAnimation();
+            }
+            return;
+        }
+        answer = message.type === 'done' ? message.text : answer + message.text;
+        if (!botMessage) {
+            removeThinkingAnimation(thinkingAnimation);
+            botMessage = addMessage(answer);
+        } else {
+            renderBotMessage(botMessage, answer);
+        }
+        if (message.type === 'done' && recordJob) {
+            watchRecordJob(recordJob, botMessage);
+        }
+    };
+    socket.onclose = () => {
+        stopVoiceCapture();
+        if (thinkingAnimation && !botMessage) {
+            removeThinkingAnimation(thinkingAnimation);
+            addMessage('抱歉，服务出现错误，请稍后重试。');
+        }
+    };
+}
+
+function startUploadRecording(stream) {
+    mediaRecorder = new MediaRecorder(stream);
+
+    mediaRecorder.ondataavailable = event => {
+        audioChunks.push(event.data);
+    };
+
+    mediaRecorder.onstop = () => {
+        // 按录制器实际使用的格式（通常是 webm/opus）标注，由服务端解码
+        const mimeType = mediaRecorder.mimeType || 'audio/webm';
+        const extension = mimeType.split(';')[0].split('/')[1] || 'webm';
+        const audioBlob = new Blob(audioChunks, { type: mimeType });
+        audioChunks = [];
+        stream.getTracks().forEach(track => track.stop());
+        const formData = new FormData();
+        formData.append('audio_input', audioBlob, `recording.${extension}`);
+        submitForm(formData);
+    };
+
+    mediaRecorder.start();
+}
+
+function stopRecording() {
+    if (voiceCapture) {
+        // 手动结束：通知服务端立即出最终结果，麦克风在收到结果后释放
+        voiceCapture.socket.send('end');
+    } else {
+        mediaRecorder.stop();
+    }
+    resetRecordButton();
+}
+
+function resetRecordButton() {
+    isRecording = false;
+    const recordButton = document.getElementById('record_button');
+    recordButton.classList.remove('recording');
+    recordButton.innerHTML = '<i class="fas fa-microphone"></i> 语音输入';
+}
+
+function showThinkingAnimation() {
+    const chatContainer = document.getElementById('chat-container');
+    const thinkingDiv = document.createElement('div');
+    thinkingDiv.className = 'message thinking-message';
+    thinkingDiv.innerHTML = `
+        <div class="message-avatar bot-avatar">
+            <i class="fas fa-user-md"></i>
+        </div>
+        <div class="message-content bot-message">
+            <div class="thinking-animation">
+                <div class="thinking-dot"></div>
+                <div class="thinking-dot"></div>
+                <div class="thinking-dot"></div>
+            </div>
+        </div>
+    `;
+    chatContainer.appendChild(thinkingDiv);
+    chatContainer.scrollTop = chatContainer.scrollHeight;
+    return thinkingDiv;
+}
+
+function removeThinkingAnimation(element) {
+    if (element && element.parentNode) {
+        element.parentNode.removeChild(element);
+    }
+}
+
+// 修改 submitForm 函数
+async function submitForm(formData = null) {
+    const textInput = document.getElementById('text_input');
+    const text = textInput.value.trim();
+
+    if (!formData) {
+        if (!text) {
+            alert('请输入内容');
+            return;
+        }
+        formData = new FormData();
+        formData.append('text_input', text);
+        addMessage(text, true);
+    }
+
+    const thinkingAnimation = showThinkingAnimation();
+
+    try {
+        const response = await fetch('/submit_stream', {
+            method: 'POST',
+            body: formData
+        });
+        if (response.status === 503) {
+            // 模型调用繁忙，按服务端给出的时间提示稍后重发，输入框内容保留
+            const busy = await response.json();
+            removeThinkingAnimation(thinkingAnimation);
+            addMessage(busy.error);
+            return;
+        }
+        if (!response.ok || !response.body) {
+            throw new Error(`HTTP ${response.status}`);
+        }
+        textInput.value = '';
+
+        // 边接收边渲染，首个分段到达即替换思考动画
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let answer = '';
+        let botMessage = null;
+        let recordJob = null;
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) {
+                break;
+            }
+            buffer += decoder.decode(value, { stream: true });
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const event = parseServerEvent(buffer.slice(0, boundary));
+                buffer = buffer.slice(boundary + 2);
+                if (!event) {
+                    continue;
+                }
+                if (event.type === 'record_job') {
+                    recordJob = event.text;
+                    continue;
+                }
+                answer = event.type === 'done' ? event.text : answer + event.text;
+                if (!botMessage) {
+                    removeThinkingAnimation(thinkingAnimation);
+                    botMessage = addMessage(answer);
+                } else {
+                    renderBotMessage(botMessage, answer);
+                }
+            }
+        }
+        if (!botMessage) {
+            throw new Error('空响应');
+        }
+        if (recordJob) {
+            watchRecordJob(recordJob, botMessage);
+        }
+    } catch (error) {
+        console.error('Error:', error);
+        removeThinkingAnimation(thinkingAnimation);
+        addMessage('抱歉，服务出现错误，请稍后重试。');
+    }
+}
+
+// 支持按回车发送消息
+document.getElementById('text_input').addEventListener('keypress', function(e) {
+    if (e.key === 'Enter') {
+        submitForm();
+    }
+});
+function submitPatientInfo() {
+    const gender = document.querySelector('input[name="gender"]:checked')?.value;
+    const age = document.getElementById('age').value;
+    const occupation = document.getElementById('occupation').value;
+    const maritalStatus = document.getElementById('marital-status').value;
+
+    if (!gender || !age || !occupation || !maritalStatus) {
+        alert('请填写所有必填信息');
+        return;
+    }
+
+    const patientInfo = `患者基本信息：
+- 性别：${gender}
+- 年龄：${age}岁
+- 职业：${occupation}
+- 婚育状况：${maritalStatus}`;
+
+    // 隐藏表单，显示聊天界面
+    document.getElementById('patient-info-form').style.display = 'none';
+    document.getElementById('chat-container').style.display = 'block';
+    document.getElementById('input-container').style.display = 'block';
+
+    // 发送患者信息
+    const formData = new FormData();
+    formData.append('text_input', patientInfo);
+    submitForm(formData);
+}
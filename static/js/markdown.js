@@ -0,0 +1,86 @@
+// 轻量 Markdown 渲染，覆盖导诊回复与病历用到的语法：标题、有序/无序列表（可嵌套一层）、
+// 引用、分隔线、粗体、斜体和行内代码；段落内的单个换行保留为 <br>。
+// 先转义 HTML 再转换，模型输出中的标签不会被浏览器执行。
+(function (global) {
+    const ESCAPES = { '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;' };
+
+    function escapeHtml(text) {
+        return text.replace(/[&<>"']/g, ch => ESCAPES[ch]);
+    }
+
+    function renderInline(text) {
+        return escapeHtml(text)
+            .replace(/`([^`]+)`/g, '<code>$1</code>')
+            .replace(/\*\*(.+?)\*\*/g, '<strong>$1</strong>')
+            .replace(/__(.+?)__/g, '<strong>$1</strong>')
+            .replace(/(^|[^*])\*([^*\s](?:[^*]*[^*\s])?)\*(?!\*)/g, '$1<em>$2</em>');
+    }
+
+    function renderList(list) {
+        const start = list.tag === 'ol' && list.start !== 1 ? ` start="${list.start}"` : '';
+        const items = list.items.map(item => `<li>${item.html}${item.sub ? renderList(item.sub) : ''}</li>`);
+        return `<${list.tag}${start}>${items.join('')}</${list.tag}>`;
+    }
+
+    function renderMarkdown(source) {
+        const html = [];
+        let paragraph = [];
+        let list = null;  // { tag, start, items: [{ html, sub }] }
+
+        function flush() {
+            if (paragraph.length) {
+                html.push(`<p>${paragraph.map(renderInline).join('<br>')}</p>`);
+                paragraph = [];
+            }
+            if (list) {
+                html.push(renderList(list));
+                list = null;
+            }
+        }
+
+        for (const line of String(source).replace(/\r\n?/g, '\n').split('\n')) {
+            let m;
+            if (!line.trim()) {
+                flush();
+            } else if ((m = line.match(/^ {0,3}(#{1,6})\s+(.*?)[\s#]*$/))) {
+                flush();
+                const level = m[1].length;
+                html.push(`<h${level}>${renderInline(m[2])}</h${level}>`);
+            } else if (/^ {0,3}([-*_])(\s*\1){2,}\s*$/.test(line)) {
+                flush();
+                html.push('<hr>');
+            } else if ((m = line.match(/^(\s*)([-*+]|\d+[.)])\s+(.*)$/))) {
+                const tag = /\d/.test(m[2]) ? 'ol' : 'ul';
+                const item = { html: renderInline(m[3]), sub: null };
+                const parent = list && list.items[list.items.length - 1];
+                if (m[1].length >= 2 && parent) {
+                    // 缩进的列表项归入上一项的子列表
+                    parent.sub = parent.sub && parent.sub.tag === tag ? parent.sub : { tag, start: 1, items: [] };
+                    parent.sub.items.push(item);
+                    continue;
+                }
+                if (paragraph.length || (list && list.tag !== tag)) {
+                    flush();
+                }
+                list = list || { tag, start: parseInt(m[2], 10) || 1, items: [] };
+                list.items.push(item);
+            } else if ((m = line.match(/^ {0,3}>\s?(.*)$/))) {
+                flush();
+                html.push(`<blockquote><p>${renderInline(m[1])}</p></blockquote>`);
+            } else if (list && /^\s{2,}/.test(line)) {
+                // 列表项的续行
+                const last = list.items[list.items.length - 1];
+                last.html += '<br>' + renderInline(line.trim());
+            } else {
+                if (list) {
+                    flush();
+                }
+                paragraph.push(line.trim());
+            }
+        }
+        flush();
+        return html.join('\n');
+    }
+
+    global.renderMarkdown = renderMarkdown;
+})(window);
@@ -0,0 +1,18 @@
+"""测试共用：加载应用模块与本地模拟的 Moonshot 接口（见 benchmarks/fake_moonshot.py）"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from fake_moonshot import serve  # noqa: E402
+
+LATENCY = 0.02  # 模拟接口的正常耗时（秒）
+
+
+@pytest.fixture(scope="session")
+def server():
+    server = serve(0, LATENCY)
+    yield server
+    server.shutdown()
@@ -0,0 +1,65 @@
+"""异步问诊：本轮出错或中途断开时，同时开始的摘要更新任务随之取消
+
+用法：python -m pytest tests
+"""
+import asyncio
+
+import pytest
+
+from _app import load_app
+
+
+@pytest.fixture
+def app(monkeypatch):
+    return load_app()
+
+
+@pytest.fixture
+def summary_tasks(app, monkeypatch):
+    """让本轮的模型调用失败，返回期间开始的摘要更新任务"""
+    tasks = []
+
+    def start_summary_update(history, summary):
+        # 摘要更新一直挂起，只有被取消才会结束
+        task = asyncio.create_task(asyncio.sleep(3600))
+        tasks.append(task)
+        return task
+
+    async def unavailable(*args):
+        raise app.LLMUnavailable("模型服务熔断中")
+
+    monkeypatch.setattr(app, "astart_summary_update", start_summary_update)
+    monkeypatch.setattr(app, "arun_turn", unavailable)
+    monkeypatch.setattr(app, "acheck_satisfaction", unavailable)
+    monkeypatch.setattr(app, "local_verdict", lambda history: None)
+    return tasks
+
+
+def history(app) -> list:
+    return app.new_history() + [
+        {"role": "user", "content": "患者基本信息：\n- 性别：男\n- 年龄：35岁"},
+        {"role": "assistant", "content": "请详细描述您目前的主要症状和不适感。"},
+    ]
+
+
+def test_failed_turn_cancels_summary_task(app, summary_tasks):
+    async def run():
+        reply = await app.arefine_response("我头痛三天了", history(app), app.new_summary())
+        await asyncio.sleep(0.01)
+        # 在事件循环结束（会取消所有剩余任务）之前检查
+        return reply, [task.cancelled() for task in summary_tasks]
+
+    reply, cancelled = asyncio.run(run())
+    assert reply  # 模型不可用时由本地规则兜底
+    assert cancelled == [True]
+
+
+def test_failed_stream_cancels_summary_task(app, summary_tasks):
+    async def run():
+        events = [event async for event in app.arefine_response_stream("我头痛三天了", history(app), app.new_summary())]
+        await asyncio.sleep(0.01)
+        return events, [task.cancelled() for task in summary_tasks]
+
+    events, cancelled = asyncio.run(run())
+    assert events[-1][0] == "done"
+    assert cancelled == [True]
@@ -0,0 +1,52 @@
+"""完整性检查的 JSON 结果：正常解析、字段清洗与格式错误时的处理
+
+用法：python -m pytest tests
+"""
+import pytest
+
+from _app import load_app
+
+app = load_app()
+
+
+def test_parses_incomplete_result_with_question():
+    response = '{"complete": false, "missing": ["诱因", "既往病史"], "next_question": " 有什么诱因吗？ "}'
+    assert app.parse_check_response(response) == (False, ["诱因", "既往病史"], "有什么诱因吗？")
+
+
+def test_complete_result_drops_question_and_unknown_slots():
+    response = '{"complete": true, "missing": ["体重", "诱因"], "next_question": "还有吗？"}'
+    assert app.parse_check_response(response) == (True, ["诱因"], "")
+
+
+def test_optional_fields_may_be_missing_or_mistyped():
+    assert app.parse_check_response('{"complete": false}') == (False, [], "")
+    assert app.parse_check_response('{"complete": false, "missing": "诱因", "next_question": 3}') == (False, [], "")
+
+
+@pytest.mark.parametrize("response", [
+    "",
+    "是|请问持续多久了？",
+    '{"complete": false, "next_question": "请问',
+    '{"complete": "false"}',
+    '{"missing": []}',
+    '[{"complete": true}]',
+    '```json\n{"complete": true}\n```',
+])
+def test_malformed_result_raises_value_error(response):
+    with pytest.raises(ValueError):
+        app.parse_check_response(response)
+
+
+def test_check_satisfaction_treats_malformed_result_as_incomplete(monkeypatch):
+    monkeypatch.setattr(app, "chat_completion", lambda *args, **kwargs: '{"complete": tru')
+    assert app.check_satisfaction("患者：头痛") == (False, "")
+
+
+def test_check_satisfaction_propagates_unavailable(monkeypatch):
+    def unavailable(*args, **kwargs):
+        raise app.LLMUnavailable("模型服务熔断中")
+
+    monkeypatch.setattr(app, "chat_completion", unavailable)
+    with pytest.raises(app.LLMUnavailable):
+        app.check_satisfaction("患者：头痛")
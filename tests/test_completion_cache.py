@@ -0,0 +1,65 @@
+"""模型回复缓存：LRU 淘汰、TTL 过期、键的归一化与持久化
+
+用法：python -m pytest tests
+"""
+import time
+
+from _app import load_app
+
+app = load_app()
+
+
+def test_lru_evicts_least_recently_used():
+    cache = app.CompletionCache(max_entries=2, ttl=60)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    assert cache.get("a") == "A"  # a 变为最近使用
+    cache.put("c", "C")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "A"
+    assert cache.get("c") == "C"
+    assert cache.stats() == {"entries": 2, "hits": 3, "misses": 1, "evictions": 1, "hit_rate": 0.75}
+
+
+def test_put_existing_key_refreshes_without_eviction():
+    cache = app.CompletionCache(max_entries=2, ttl=60)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    cache.put("a", "A2")
+    cache.put("c", "C")
+
+    assert cache.get("a") == "A2"
+    assert cache.get("b") is None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_expired_entries_miss_and_are_dropped():
+    cache = app.CompletionCache(max_entries=10, ttl=0.05)
+    cache.put("a", "A")
+    assert cache.get("a") == "A"
+    time.sleep(0.1)
+
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_key_ignores_whitespace_and_normalizes_early_text():
+    messages = [{"role": "system", "content": "追问"}, {"role": "user", "content": "头痛  三天"}]
+    spaced = [{"role": "system", "content": "追问 "}, {"role": "user", "content": "头痛 三天"}]
+    key = app.CompletionCache.make_key("moonshot-v1-8k", 0.3, messages)
+    assert app.CompletionCache.make_key("moonshot-v1-8k", 0.3, spaced) == key
+    assert app.CompletionCache.make_key("moonshot-v1-32k", 0.3, messages) != key
+    assert app.CompletionCache.make_key("moonshot-v1-8k", 0.7, messages) != key
+
+    early = app.CompletionCache.make_key("moonshot-v1-8k", 0.3, messages, "头痛。")
+    assert app.CompletionCache.make_key("moonshot-v1-8k", 0.3, messages, "头痛了！") == early
+
+
+def test_persisted_entries_survive_reload(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = app.CompletionCache(max_entries=10, ttl=60, path=path)
+    cache.put("a", "A")
+    cache.save()
+
+    assert app.CompletionCache(max_entries=10, ttl=60, path=path).get("a") == "A"
@@ -0,0 +1,48 @@
+"""会话存储：各后端的保存、读取、exists 与过期
+
+用法：python -m pytest tests
+"""
+import time
+
+import pytest
+
+from _app import load_app
+
+app = load_app()
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return app.MemoryConversationStore(ttl=0.5)
+    return app.SQLiteConversationStore(str(tmp_path / "sessions.db"), ttl=0.5)
+
+
+def session(text: str) -> dict:
+    return {"history": app.new_history() + [{"role": "user", "content": text}]}
+
+
+def test_round_trip_restores_system_message(store):
+    store.save("s1", session("头痛三天"))
+    assert store.load("s1") == session("头痛三天")
+    assert store.load("missing") == {"history": app.new_history()}
+
+
+def test_exists_tracks_save_delete_and_expiry(store):
+    assert not store.exists("s1")
+    store.save("s1", session("头痛三天"))
+    assert store.exists("s1")
+    store.delete("s1")
+    assert not store.exists("s1")
+
+    store.save("s2", session("咳嗽"))
+    time.sleep(0.6)
+    assert not store.exists("s2")
+
+
+def test_exists_does_not_refresh_last_access(store):
+    store.save("s1", session("头痛三天"))
+    time.sleep(0.3)
+    assert store.exists("s1")
+    time.sleep(0.3)
+    assert not store.exists("s1")
@@ -0,0 +1,82 @@
+"""问诊日志：重放时跳过写了一半的行，压缩可重复执行，启动恢复不覆盖已有会话
+
+用法：python -m pytest tests
+"""
+import os
+
+import pytest
+
+from _app import load_app
+
+app = load_app()
+RECORD = [["user", "我头痛三天了"], ["assistant", "### 建议就诊科室\n神经内科"]]
+
+
+@pytest.fixture
+def journal(tmp_path):
+    # 不攒批，每条事件直接写盘；段大小为 1 字节，每次写入后都封存换新段
+    archive = app.ConsultationArchive(str(tmp_path / "archive.db"))
+    journal = app.ConsultationJournal(str(tmp_path / "wal"), archive, flush_interval=0, segment_bytes=1)
+    yield journal
+    journal.close()
+
+
+def stop_rolling(journal) -> None:
+    """此后不再换段，压缩时写入的快照留在当前段"""
+    journal.segment_bytes = 1 << 20
+
+
+def test_torn_tail_line_is_skipped(journal):
+    path = journal.segment_path
+    journal.append("s1", "start", [["user", "患者基本信息"]])
+    journal.append("s1", "turn", [["user", "我头痛三天了"], ["assistant", "多久了？"]])
+    with open(journal.segment_path, "ab") as f:
+        f.write(journal._encode({"t": 0, "s": "s1", "e": "turn", "m": [["user", "崩溃"]]})[:-12])
+
+    events = journal.read_events(journal._segments())
+    assert [event["e"] for event in events] == ["start", "turn"]
+    assert events[0]["path"] == path
+    _, states, finished = journal._replay(journal._segments())
+    assert states["s1"]["messages"] == [["user", "患者基本信息"], ["user", "我头痛三天了"], ["assistant", "多久了？"]]
+    assert finished == []
+
+
+def test_compaction_is_idempotent(journal):
+    journal.append("s1", "start", [["user", "患者基本信息"]])
+    journal.append("s1", "record", RECORD)
+    journal.append("s2", "start", [["user", "咳嗽一周"]])
+    stop_rolling(journal)
+    sealed = {path: open(path, "rb").read() for path in journal._segments() if path != journal.segment_path}
+
+    assert journal.compact() == len(sealed)
+    assert journal.compact() == 0
+    # 模拟归档写入后、删除封存段前崩溃：封存段又出现了一次
+    for path, data in sealed.items():
+        with open(path, "wb") as f:
+            f.write(data)
+    journal.compact()
+
+    rows = journal.archive.query()
+    assert [(row["session_id"], row["department"]) for row in rows] == [("s1", "神经内科")]
+    _, states, finished = journal._replay(journal._segments())
+    assert list(states) == ["s2"]
+    assert states["s2"]["messages"] == [["user", "咳嗽一周"]]
+    assert finished == []
+
+
+def test_recover_restores_only_missing_sessions(journal):
+    store = app.MemoryConversationStore(ttl=60)
+    journal.append("s1", "start", [["user", "患者基本信息"]])
+    journal.append("s2", "start", [["user", "咳嗽一周"]])
+    journal.append("s3", "start", [["user", "发热"]])
+    journal.append("s3", "record", RECORD)
+    existing = {"history": app.new_history() + [{"role": "user", "content": "已在存储中"}]}
+    store.save("s2", existing)
+    stop_rolling(journal)
+
+    assert journal.recover(store) == 1
+    assert store.load("s1")["history"][1:] == [{"role": "user", "content": "患者基本信息"}]
+    assert store.load("s2") == existing
+    assert not store.exists("s3")
+    assert not [path for path in journal._segments() if path != journal.segment_path]
+    assert os.path.exists(journal.segment_path)
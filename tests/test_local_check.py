@@ -0,0 +1,70 @@
+"""本地完整性检查：只按患者自己的回答判断缺项，只能确定 "未完整"，其余交给模型
+
+用法：python -m pytest tests
+"""
+from _app import load_app
+
+app = load_app()
+ANSWERS = [
+    "我头痛三天了",
+    "最近加班熬夜后加重",
+    "有点恶心",
+    "有高血压，母亲有偏头痛",
+    "平时久坐，不抽烟",
+    "休息后会好转一些",
+]
+
+
+def history(answers: list, question: str = "还有什么症状？多久了？以前得过什么病吗？生活作息怎样？") -> list:
+    messages = app.new_history() + [{"role": "user", "content": "患者基本信息：\n- 性别：女\n- 年龄：42岁"}]
+    for answer in answers:
+        messages.append({"role": "assistant", "content": question})
+        messages.append({"role": "user", "content": answer})
+    return messages
+
+
+def test_too_few_rounds_is_certainly_incomplete():
+    verdict, missing = app.local_check_satisfaction(history(ANSWERS[:3]))
+    assert verdict is False
+    assert "既往病史" in missing
+
+
+def test_all_slots_answered_is_left_to_the_model():
+    verdict, missing = app.local_check_satisfaction(history(ANSWERS))
+    assert verdict is None
+    assert missing == []
+
+
+def test_non_answers_fill_no_slot():
+    answers = ["不知道", "不清楚。", "没有", "  ", "嗯", "忘了"]
+    verdict, missing = app.local_check_satisfaction(history(answers))
+    assert verdict is False
+    assert missing == list(app.SLOT_PATTERNS)
+
+
+def test_guide_questions_fill_no_slot():
+    # 模板追问里有各项的关键词，只有患者的回答才算数
+    answers = ["不知道"] * len(app.SLOT_QUESTIONS)
+    messages = app.new_history() + [{"role": "user", "content": "患者基本信息：\n- 性别：女\n- 年龄：42岁"}]
+    for question, answer in zip(app.SLOT_QUESTIONS.values(), answers):
+        messages += [{"role": "assistant", "content": question}, {"role": "user", "content": answer}]
+    assert app.scan_slots(messages) == (len(answers), list(app.SLOT_PATTERNS))
+
+
+def test_many_missing_slots_is_incomplete_until_max_rounds():
+    answers = ["我头痛三天了"] + ["还是那样"] * (app.LOCAL_CHECK_MAX_ROUNDS - 2)
+    assert app.local_check_satisfaction(history(answers))[0] is False
+    answers.append("还是那样")
+    assert app.local_check_satisfaction(history(answers))[0] is None
+
+
+def test_one_missing_slot_is_left_to_the_model():
+    answers = ["我头痛三天了", "受凉后加重", "有点恶心", "有高血压", "休息后会好转一些", "就这些"]
+    verdict, missing = app.local_check_satisfaction(history(answers))
+    assert verdict is None
+    assert missing == ["生活状况"]
+
+
+def test_never_certainly_complete():
+    for rounds in range(len(ANSWERS) + 1):
+        assert app.local_check_satisfaction(history(ANSWERS[:rounds]))[0] is not True
@@ -0,0 +1,42 @@
+"""模型路由：提示超出默认型号的上下文时换用更大的型号，长对话的每一轮都保留在病历提示中
+
+用法：python -m pytest tests
+"""
+from _app import load_app
+
+app = load_app()
+INTAKE = "患者基本信息：\n- 性别：男\n- 年龄：35岁"
+
+
+def long_history(rounds: int, chars: int = 150) -> list:
+    """rounds 轮问答，每条回答约 chars 个汉字，并带有可检索的编号"""
+    history = app.new_history() + [{"role": "user", "content": INTAKE}]
+    for i in range(rounds):
+        history.append({"role": "assistant", "content": f"第{i}个问题：请再描述一下头痛的情况？"})
+        history.append({"role": "user", "content": f"第{i}轮回答" + "头痛" * (chars // 2)})
+    return history
+
+
+def test_short_prompt_stays_on_routed_model():
+    messages = app.build_medical_record_messages(app.serialize_transcript(long_history(3)))
+    assert app.route_model("record", messages) == app.MODEL_ROUTES["record"]
+
+
+def test_long_history_keeps_every_turn_in_record_prompt():
+    history = long_history(80)  # 约 1.3 万 token，超出 8k 窗口
+    transcript = app.serialize_transcript(history)
+    messages = app.build_medical_record_messages(transcript)
+
+    for m in history[1:]:
+        assert m["content"].replace("\n", " ") in messages[-1]["content"]
+    assert "省略" not in transcript
+    model, max_tokens = app.route_model("record", messages)
+    assert model == "moonshot-v1-32k"
+    assert max_tokens == app.MODEL_ROUTES["record"][1]
+
+
+def test_escalates_to_smallest_window_that_fits():
+    messages = [{"role": "user", "content": "头" * 40000}]
+    assert app.route_model("record", messages)[0] == "moonshot-v1-128k"
+    messages = [{"role": "user", "content": "头" * 200000}]
+    assert app.route_model("record", messages)[0] == "moonshot-v1-128k"
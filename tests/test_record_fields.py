@@ -0,0 +1,64 @@
+"""结构化病历：字段 JSON 的解析、排版，以及格式不符时按原文整理
+
+用法：python -m pytest tests
+"""
+import json
+
+import pytest
+
+from _app import load_app
+
+app = load_app()
+
+
+def fields_json(**overrides) -> str:
+    data = {name: f"{name} 内容" for name in app.RECORD_FIELDS}
+    data.update(overrides)
+    return json.dumps(data, ensure_ascii=False)
+
+
+def test_parses_all_fields():
+    fields = app.parse_record_fields(fields_json(chief_complaint="  头痛三天  "))
+    assert list(fields) == list(app.RECORD_FIELDS)
+    assert fields["chief_complaint"] == "头痛三天"
+    assert fields["department"] == "department 内容"
+
+
+def test_missing_empty_and_list_fields():
+    response = json.dumps({
+        "chief_complaint": "头痛三天", "onset": "", "triggers": None,
+        "accompanying": ["恶心", " ", "畏光 "], "allergies": 0, "unknown": "忽略",
+    }, ensure_ascii=False)
+    fields = app.parse_record_fields(response)
+    assert fields["chief_complaint"] == "头痛三天"
+    assert fields["accompanying"] == "恶心；畏光"
+    assert fields["allergies"] == "0"
+    assert fields["onset"] == fields["triggers"] == fields["diagnosis"] == app.RECORD_MISSING
+    assert "unknown" not in fields
+
+
+@pytest.mark.parametrize("response", [
+    "",
+    "# 门诊病历记录\n\n## 主诉\n头痛三天",
+    '{"chief_complaint": "头痛',
+    '["头痛三天"]',
+    '"头痛三天"',
+])
+def test_malformed_fields_raise_value_error(response):
+    with pytest.raises(ValueError):
+        app.parse_record_fields(response)
+
+
+def test_finish_renders_structured_record(monkeypatch):
+    monkeypatch.setattr(app, "STRUCTURED_RECORD_MODE", True)
+    record = app.finish_medical_record(fields_json(chief_complaint="头痛<br>三天", department="神经内科"))
+    assert record.startswith("# 门诊病历记录")
+    assert "## 主诉\n头痛\n三天" in record
+    assert "1. **建议科室：** 神经内科" in record
+
+
+def test_finish_falls_back_to_cleaned_markdown(monkeypatch):
+    monkeypatch.setattr(app, "STRUCTURED_RECORD_MODE", True)
+    markdown = "# 门诊病历记录\n\n## 主诉\n<b>头痛</b>三天"
+    assert app.finish_medical_record(markdown) == "# 门诊病历记录\n\n## 主诉\n**头痛**三天"
+    assert app.finish_medical_record('{"chief_complaint": "头痛') == '{"chief_complaint": "头痛'
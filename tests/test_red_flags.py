@@ -0,0 +1,13 @@
+"""危急症状检测对否定与过去时间表述的处理，用例与 benchmarks/bench_red_flags.py 共用
+
+用法：python -m pytest tests
+"""
+import pytest
+
+from _app import load_app
+from bench_red_flags import CASES
+
+
+@pytest.mark.parametrize("text, expected", CASES.items())
+def test_detect_red_flags(text, expected):
+    assert [phrase for _, phrase in load_app().detect_red_flags(text)] == expected
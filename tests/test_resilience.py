@@ -0,0 +1,138 @@
+"""模型调用的超时重试、退避、熔断、本地兜底与对冲，对本地模拟接口逐项验证
+
+用法：python -m pytest tests
+"""
+import time
+import uuid
+
+import pytest
+from openai import OpenAI
+
+from _app import load_app
+from conftest import LATENCY
+from fake_moonshot import FOLLOW_UP, FakeMoonshotHandler
+
+
+@pytest.fixture
+def app(server, monkeypatch):
+    """每个用例使用新的熔断器、耗时样本与计数，模拟接口不注入任何故障"""
+    module = load_app()
+    port = server.server_address[1]
+    monkeypatch.setattr(module, "client", OpenAI(base_url=f"http://127.0.0.1:{port}/v1", api_key="test", max_retries=0))
+    monkeypatch.setattr(module, "llm_dispatcher", module.LLMDispatcher(rate=0))
+    monkeypatch.setattr(module, "llm_breaker", module.CircuitBreaker(failures=1000))
+    monkeypatch.setattr(module, "llm_latency", module.LatencyTracker())
+    monkeypatch.setattr(module, "llm_call_counters", dict.fromkeys(module.llm_call_counters, 0))
+    monkeypatch.setattr(module, "LLM_MAX_RETRIES", 2)
+    monkeypatch.setattr(module, "LLM_HEDGE_MODE", False)
+    monkeypatch.setattr(module, "LLM_TIMEOUT_SECONDS", 2.0)
+    monkeypatch.setattr(module, "LLM_BACKOFF_BASE", 0.01)
+    for name, value in {"error_rate": 0.0, "hang_rate": 0.0, "tail_rate": 0.0, "tail_latency": 1.0,
+                        "outage": False, "retry_after": None, "script": []}.items():
+        monkeypatch.setattr(FakeMoonshotHandler, name, value)
+    return module
+
+
+def ask(app) -> str:
+    """发起一次内容不同的追问调用，避免命中回复缓存"""
+    messages = [{"role": "system", "content": "追问"}, {"role": "user", "content": uuid.uuid4().hex}]
+    return app.chat_completion(messages, temperature=0.3, priority=app.PRIORITY_FOLLOW_UP)
+
+
+def test_timeout_is_retried(app, monkeypatch):
+    monkeypatch.setattr(app, "LLM_TIMEOUT_SECONDS", 0.3)
+    FakeMoonshotHandler.script = ["hang", "ok"]
+    calls = FakeMoonshotHandler.calls
+
+    assert ask(app) == FOLLOW_UP
+    assert FakeMoonshotHandler.calls - calls == 2
+    assert app.llm_call_counters["retries"] == 1
+    assert app.llm_breaker.stats()["state"] == "closed"
+
+
+def test_retries_exhausted_raise_unavailable(app, monkeypatch):
+    monkeypatch.setattr(app, "LLM_MAX_RETRIES", 1)
+    FakeMoonshotHandler.script = ["error", "error", "ok"]
+
+    with pytest.raises(app.LLMUnavailable):
+        ask(app)
+    assert app.llm_call_counters["failures"] == 2
+
+
+def test_backoff_honours_retry_after(app):
+    FakeMoonshotHandler.retry_after = 0.5
+    FakeMoonshotHandler.script = ["429", "ok"]
+
+    start = time.perf_counter()
+    assert ask(app)
+    # 退避间隔只有几十毫秒，等满 Retry-After 才会超过 0.5 秒
+    assert time.perf_counter() - start >= 0.5
+    assert app.llm_call_counters["retries"] == 1
+
+
+def test_breaker_opens_half_opens_and_closes(app, monkeypatch):
+    monkeypatch.setattr(app, "LLM_MAX_RETRIES", 0)
+    monkeypatch.setattr(app, "llm_breaker", app.CircuitBreaker(failures=3, cooldown=0.3))
+    FakeMoonshotHandler.outage = True
+
+    for _ in range(3):
+        with pytest.raises(app.LLMUnavailable):
+            ask(app)
+    assert app.llm_breaker.stats() == {"state": "open", "consecutive_failures": 3, "trips": 1}
+
+    # 熔断期间不再请求模拟接口
+    calls = FakeMoonshotHandler.calls
+    with pytest.raises(app.LLMUnavailable):
+        ask(app)
+    assert FakeMoonshotHandler.calls == calls
+    assert app.llm_call_counters["short_circuited"] == 1
+
+    # 冷却结束后放行一个探测请求，探测失败时重新熔断
+    time.sleep(0.3)
+    with pytest.raises(app.LLMUnavailable):
+        ask(app)
+    assert FakeMoonshotHandler.calls == calls + 1
+    assert app.llm_breaker.stats()["state"] == "open"
+
+    # 再次冷却后进入半开状态，探测请求成功即关闭熔断
+    time.sleep(0.3)
+    FakeMoonshotHandler.outage = False
+    assert app.llm_breaker.allow()
+    assert app.llm_breaker.stats()["state"] == "half_open"
+    assert not app.llm_breaker.allow()  # 探测期间其余调用仍直接失败
+    app.llm_breaker.opened_at -= 0.3  # 把探测名额让给下面这次调用
+    assert ask(app)
+    assert app.llm_breaker.stats() == {"state": "closed", "consecutive_failures": 0, "trips": 1}
+
+
+def test_open_breaker_falls_back_to_local_turn(app, monkeypatch):
+    monkeypatch.setattr(app, "llm_breaker", app.CircuitBreaker(failures=1, cooldown=60))
+    app.llm_breaker.failure()
+    history = app.new_history() + [
+        {"role": "user", "content": "患者基本信息：\n- 性别：男\n- 年龄：35岁"},
+        {"role": "assistant", "content": "感谢您提供基本信息。请详细描述您目前的主要症状和不适感。"},
+    ]
+    calls = FakeMoonshotHandler.calls
+
+    reply = app.refine_response("我头痛三天了", history)
+
+    # 已提到症状与持续时间，本地兜底按第一个缺项追问
+    assert reply == app.SLOT_QUESTIONS["诱因"]
+    assert history[-1] == {"role": "assistant", "content": reply}
+    assert app.llm_call_counters["fallbacks"] == 1
+    assert FakeMoonshotHandler.calls == calls
+
+
+def test_hedged_request_returns_faster_response(app, monkeypatch):
+    monkeypatch.setattr(app, "LLM_HEDGE_MODE", True)
+    for _ in range(app.LLM_HEDGE_MIN_SAMPLES):
+        app.llm_latency.record("follow_up", LATENCY)
+    FakeMoonshotHandler.script = ["tail", "ok"]
+
+    start = time.perf_counter()
+    assert ask(app) == FOLLOW_UP
+    elapsed = time.perf_counter() - start
+
+    assert elapsed < FakeMoonshotHandler.tail_latency / 2
+    assert app.llm_call_counters["hedged"] == 1
+    assert app.llm_call_counters["hedge_wins"] == 1
@@ -0,0 +1,42 @@
+"""推测执行：完整性检查失败时，推测发起的病历请求随之取消
+
+用法：python -m pytest tests
+"""
+from concurrent.futures import Future
+
+import pytest
+
+from _app import load_app
+
+
+@pytest.fixture
+def app(monkeypatch):
+    module = load_app()
+    monkeypatch.setattr(module, "local_check_satisfaction", lambda history: (None, []))
+    monkeypatch.setattr(module, "record_jobs_enabled", lambda: False)
+    return module
+
+
+def history(app) -> list:
+    return app.new_history() + [{"role": "user", "content": "患者基本信息：\n- 性别：男\n- 年龄：35岁"}] + [
+        {"role": role, "content": "头痛"} for role in ("assistant", "user") * (app.RECORD_MIN_HISTORY // 2)
+    ]
+
+
+@pytest.mark.parametrize("error_name", ["LLMUnavailable", "ValueError"])
+def test_failed_check_cancels_speculative_record(app, monkeypatch, error_name):
+    error = getattr(app, error_name, ValueError)("完整性检查失败")
+    futures = {}
+
+    def submit(executor, fn, *args):
+        # 病历请求保持未开始的状态，检查请求直接失败
+        future = Future()
+        if fn is app.check_satisfaction:
+            future.set_exception(error)
+        futures[fn.__name__] = future
+        return future
+
+    monkeypatch.setattr(app, "submit_with_context", submit)
+    with pytest.raises(type(error)):
+        app.run_turn_speculative(history(app), "患者：头痛")
+    assert futures["generate_medical_record"].cancelled()
@@ -0,0 +1,89 @@
+"""流式问诊：客户端中途断开时，本轮未作答的患者消息不写入会话
+
+用法：python -m pytest tests
+"""
+import asyncio
+import random
+from urllib.parse import urlencode
+
+import pytest
+from openai import AsyncOpenAI, OpenAI
+
+from _app import load_app
+from fake_moonshot import FakeMoonshotHandler
+
+
+@pytest.fixture
+def app(server, monkeypatch):
+    module = load_app()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    monkeypatch.setattr(module, "client", OpenAI(base_url=base_url, api_key="test", max_retries=0))
+    monkeypatch.setattr(module, "async_client", AsyncOpenAI(base_url=base_url, api_key="test", max_retries=0))
+    monkeypatch.setattr(module, "llm_dispatcher", module.LLMDispatcher(rate=0))
+    monkeypatch.setattr(module, "llm_breaker", module.CircuitBreaker(failures=1000))
+    monkeypatch.setattr(module, "conversation_store", module.MemoryConversationStore())
+    monkeypatch.setattr(FakeMoonshotHandler, "token_rate", 40.0)  # 追问分多段输出，留出中途断开的时机
+    return module
+
+
+def intake() -> str:
+    # 年龄每次不同，避免命中其他用例留下的回复缓存
+    return f"患者基本信息：\n- 性别：男\n- 年龄：{random.randint(20, 80)}岁"
+
+
+def session_history(app, client) -> list:
+    session_id = client.get_cookie(app.SESSION_COOKIE_NAME).value
+    return app.conversation_store.load(session_id)["history"]
+
+
+def test_disconnect_mid_stream_drops_unanswered_message(app):
+    client = app.app.test_client()
+    client.post("/submit", data={"text_input": intake()})
+    before = session_history(app, client)
+
+    response = client.post("/submit_stream", data={"text_input": "我头痛三天了"}, buffered=False)
+    first = next(iter(response.response))
+    assert first.startswith(b"event: delta")
+    response.close()
+
+    history = session_history(app, client)
+    assert history == before
+    assert history[-1]["role"] == "assistant"
+
+
+def test_completed_stream_saves_the_turn(app):
+    client = app.app.test_client()
+    client.post("/submit", data={"text_input": intake()})
+
+    body = client.post("/submit_stream", data={"text_input": "我头痛三天了"}).get_data(as_text=True)
+    assert "event: done" in body
+
+    history = session_history(app, client)
+    assert [m["role"] for m in history[-2:]] == ["user", "assistant"]
+    assert history[-2]["content"] == "我头痛三天了"
+
+
+def test_async_disconnect_mid_stream_drops_unanswered_message(app):
+    if getattr(app, "asgi_app", None) is None:
+        pytest.skip("未安装 quart")
+
+    async def run():
+        client = app.asgi_app.test_client()
+        await client.post("/submit", form={"text_input": intake()})
+        session_id = next(c.value for c in client.cookie_jar if c.name == app.SESSION_COOKIE_NAME)
+        before = list(app.conversation_store.load(session_id)["history"])
+
+        body = urlencode({"text_input": "我头痛三天了"}).encode()
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        async with client.request("/submit_stream", method="POST", headers=headers) as connection:
+            await connection.send(body)
+            await connection.send_complete()
+            first = await connection.receive()
+            assert first.startswith(b"event: delta")
+            await connection.disconnect()
+        await asyncio.sleep(0.1)  # 等待服务端结束本轮并保存
+        return before, app.conversation_store.load(session_id)["history"]
+
+    before, history = asyncio.run(run())
+    assert history == before
+    assert history[-1]["role"] == "assistant"
@@ -0,0 +1,53 @@
+"""对话记录序列化：紧凑格式与超出 token 预算时的截断
+
+用法：python -m pytest tests
+"""
+from _app import load_app
+
+app = load_app()
+INTAKE = "患者基本信息：\n- 性别：女\n- 年龄：42岁"
+
+
+def history(rounds: int) -> list:
+    messages = app.new_history() + [{"role": "user", "content": INTAKE}]
+    for i in range(rounds):
+        messages.append({"role": "assistant", "content": f"第{i}个问题？"})
+        messages.append({"role": "user", "content": f"第{i}轮回答：头痛，   偶尔恶心"})
+    return messages
+
+
+def test_compact_format_without_system_message():
+    transcript = app.serialize_transcript(history(1))
+    assert transcript.splitlines() == [
+        "患者：患者基本信息： - 性别：女 - 年龄：42岁",
+        "导诊员：第0个问题？",
+        "患者：第0轮回答：头痛， 偶尔恶心",
+    ]
+    assert app.SYSTEM_MESSAGE not in transcript
+
+
+def test_within_budget_is_not_truncated():
+    messages = history(5)
+    full = app.serialize_transcript(messages)
+    exact = sum(app.estimate_tokens(line) + 1 for line in full.splitlines())
+    assert app.serialize_transcript(messages, budget=exact) == full
+    assert app.serialize_transcript(messages, budget=exact - 1) != full
+
+
+def test_over_budget_keeps_intake_and_latest_turns():
+    budget = 80
+    transcript = app.serialize_transcript(history(20), budget=budget)
+    lines = transcript.splitlines()
+
+    assert lines[0].startswith("患者：患者基本信息：")
+    assert lines[-1] == "患者：第19轮回答：头痛， 偶尔恶心"
+    assert lines[-2] == "导诊员：第19个问题？"
+    omitted = 41 - (len(lines) - 1)  # 41 条非系统消息，除省略说明外都是原文
+    assert lines[1] == f"（省略较早的 {omitted} 条对话）"
+    assert omitted > 0
+    assert sum(app.estimate_tokens(line) + 1 for line in lines) <= budget
+
+
+def test_default_budget_follows_largest_context_window():
+    window = max(app.MODEL_CONTEXT_WINDOWS.values())
+    assert window - 2000 < app.transcript_token_budget() < window
@@ -0,0 +1,26 @@
+"""生产环境 WSGI 入口
+
+用法：gunicorn -c gunicorn.conf.py wsgi:app
+（主程序文件名含空格，无法直接 import，这里按路径加载）
+"""
+import importlib.util
+import os
+import sys
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Intelligent triage based on AI .py")
+
+
+def load_module(module_name: str = "triage_app"):
+    """按路径加载主程序模块，重复调用时返回同一个模块"""
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+triage_app = load_module()
+triage_app.check_config()
+app = triage_app.app